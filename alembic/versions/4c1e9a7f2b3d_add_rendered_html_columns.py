@@ -0,0 +1,48 @@
+"""add rendered html columns
+
+Revision ID: 4c1e9a7f2b3d
+Revises: 5673f248d387
+Create Date: 2026-10-18 10:12:43.201734
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4c1e9a7f2b3d'
+down_revision = '5673f248d387'
+
+from alembic import op
+import sqlalchemy as sa
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# (table, markdown column, html column)
+rendered = (
+    ('writing', 'text', 'text_html'),
+    ('writing', 'summary', 'summary_html'),
+    ('authors', 'bio', 'bio_html'),
+)
+
+def upgrade():
+    from contrivers.rendering import markdown_factory
+
+    for table, _, html_column in rendered:
+        op.add_column(table, sa.Column(html_column, sa.String()))
+
+    # Backfill the existing rows
+    conn = op.get_bind()
+    for table, column, html_column in rendered:
+        tbl = sa.table(table, sa.column('id'), sa.column(column), sa.column(html_column))
+        rows = conn.execute(sa.select(tbl.c.id, tbl.c[column]).where(tbl.c[column] != None))
+        for _id, source in rows.fetchall():
+            logger.info('Rendering %s.%s for id %s', table, column, _id)
+            conn.execute(
+                tbl.update().
+                where(tbl.c.id == _id).
+                values({html_column: markdown_factory().convert(source)}))
+
+
+def downgrade():
+    for table, _, html_column in rendered:
+        op.drop_column(table, html_column)
@@ -13,6 +13,7 @@ import subprocess
 import json
 import six
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 
 try:
     import click
@@ -40,9 +41,9 @@ except ImportError:
     raise click.ClickException('Cannot import yaml, have you installed PyYAML?')
 
 try:
-    from app import create_app, db
-    from app.core import models
-    from app.www.utils import uopen
+    from contrivers import create_app, db
+    from contrivers import models, rendering
+    from contrivers.utils import uopen
 except ImportError:
     error('Cannot import the contrivers python app, did you checkout the' +\
           'correct branch?')
@@ -52,7 +53,7 @@ except ImportError:
 
 DEFAULTS = dict(
     url='postgresql://contrivers@localhost/contrivers',
-    excluded = ['tsvector', 'create_date'],
+    excluded = ['tsvector', 'create_date', 'text_html', 'abstract_html', 'bio_html'],
 )
 
 
@@ -87,7 +88,7 @@ def parse_yaml(f):
         f.seek(pointer)
         return ''
     readline = iter(f.readline, '')
-    readline = iter(readline.next, '---\n')
+    readline = iter(readline.__next__, '---\n')
     return ''.join(readline)
 
 
@@ -257,13 +258,13 @@ def cli(obj, testing):
 
 
 @cli.command()
-@click.argument('filename', type=click.File('rb'))
+@click.argument('filename', type=click.File('r', encoding='utf-8'))
 @click.option('--confirm/--no-confirm', default=True, help='Do not prompt for confirmation')
 @click.pass_obj
 def add(obj, filename, confirm):
 
     # Pull out the yaml header info
-    headers = yaml.load(parse_yaml(filename))
+    headers = yaml.safe_load(parse_yaml(filename))
     text = filename.read()
 
     try:
@@ -296,7 +297,7 @@ def add(obj, filename, confirm):
 
 @cli.command()
 @click.argument('_id', type=int)
-@click.argument('filename', type=click.File('rb'))
+@click.argument('filename', type=click.File('r', encoding='utf-8'))
 @click.option(
     '-y', '--yes',
     is_flag=True,
@@ -315,7 +316,7 @@ def update(obj, _id, filename, yes):
 
     # Pull out the yaml header info and update from file
     headers = process_headers(
-        yaml.load(parse_yaml(filename)),
+        yaml.safe_load(parse_yaml(filename)),
         confirm=yes,
         )
     headers['text'] = filename.read()
@@ -503,5 +504,174 @@ def edit_author(obj, column):
         obj.get('db').session.commit()
 
 
+#
+# Bulk re-rendering
+#
+
+def init_render_worker(backend):
+    """ Select the markdown backend in a worker process """
+    rendering.set_backend(backend)
+
+
+def render_row(row):
+    """ Render the text and abstract of a (id, text, abstract) row
+
+    Runs in a worker process, so it bypasses the render cache.
+    """
+    _id, text, abstract = row
+    convert = rendering.get_backend().convert
+    return dict(
+        _id=_id,
+        _text_html=convert(text) if text else None,
+        _summary_html=convert(abstract) if abstract else None,
+    )
+
+
+def read_checkpoint(path, since):
+    """ Return the last committed id from a previous, interrupted run """
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return 0
+    if state.get('since') != since:
+        info('Ignoring checkpoint for a different --since')
+        return 0
+    return state.get('last_id', 0)
+
+
+def write_checkpoint(path, since, last_id):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(dict(since=since, last_id=last_id), f)
+    os.rename(tmp, path)
+
+
+@cli.command()
+@click.option('--since', type=click.DateTime(), default=None,
+    help='Only rerender writing edited on or after this date')
+@click.option('--chunk-size', type=int, default=100, help='Rows per batched UPDATE')
+@click.option('--workers', type=int, default=None, help='Processes, defaults to all cores')
+@click.option('--resume/--restart', default=True, help='Continue from the last checkpoint')
+@click.option('--checkpoint', default='.contrive-rerender.json', help='Path to the checkpoint file')
+@click.pass_obj
+def rerender(obj, since, chunk_size, workers, resume, checkpoint):
+    """ Rebuild the stored html of every writing """
+    app = obj.get('app')
+    db = obj.get('db')
+    writing = models.Writing.__table__
+    since_key = since.isoformat() if since else None
+    workers = workers or os.cpu_count()
+
+    last_id = read_checkpoint(checkpoint, since_key) if resume else 0
+    if last_id:
+        info('Resuming after id {}'.format(last_id))
+
+    def select(*columns):
+        query = sqlalchemy.select(*columns).where(writing.c.id > last_id)
+        if since is not None:
+            query = query.where(writing.c.last_edited_date >= since)
+        return query
+
+    update = writing.update().\
+        where(writing.c.id == sqlalchemy.bindparam('_id')).\
+        values(
+            text_html=sqlalchemy.bindparam('_text_html'),
+            summary_html=sqlalchemy.bindparam('_summary_html'),
+            # a rerender isn't an edit, so keep last_edited_date from onupdate
+            last_edited_date=writing.c.last_edited_date)
+
+    with app.test_request_context():
+        total = db.session.execute(
+            select(sqlalchemy.func.count()).select_from(writing)).scalar()
+        info('Rerendering {} rows'.format(total))
+
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_render_worker,
+            initargs=(app.config.get('MARKDOWN_BACKEND', 'python-markdown'),))
+        with executor, click.progressbar(length=total, label='Rendering') as bar:
+            while True:
+                rows = db.session.execute(
+                    select(writing.c.id, writing.c.text, writing.c.summary).
+                    order_by(writing.c.id).
+                    limit(chunk_size)).fetchall()
+                if not rows:
+                    break
+                rendered = list(executor.map(
+                    render_row, [tuple(row) for row in rows],
+                    chunksize=max(1, len(rows) // (workers * 4))))
+                db.session.execute(update, rendered)
+                db.session.commit()
+                last_id = rows[-1][0]
+                write_checkpoint(checkpoint, since_key, last_id)
+                bar.update(len(rows))
+
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    info('Done')
+
+
+#
+# Static export
+#
+
+@cli.command('export')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--base-url', default='https://www.contrivers.org/',
+    help='Scheme and host for links in the exported pages')
+@click.option('--workers', type=int, default=None, help='Processes, defaults to all cores')
+@click.option('--force', is_flag=True, default=False,
+    help='Render every page, even if it has not changed')
+@click.pass_obj
+def export_cmd(obj, directory, base_url, workers, force):
+    """ Render the public site to static files in DIRECTORY """
+    from contrivers.export import export_site
+    app = obj.get('app')
+    config = dict(SQLALCHEMY_DATABASE_URI=obj.get('url'), CACHE_TYPE='null')
+    result = export_site(
+        app, directory, base_url=base_url, processes=workers, config=config,
+        force=force, progress=lambda key: app.logger.debug('exported %s', key))
+    info('Rendered {}, kept {} unchanged, removed {} files'.format(*result))
+
+
+#
+# Cache warming
+#
+
+@cli.command('warm')
+@click.option('--base-url', default=None,
+    help='Warm a running site over http, which also fills its workers\' caches')
+@click.option('--concurrency', type=int, default=4, help='Requests in flight')
+@click.option('--slowest', type=int, default=10, help='List this many of the slowest pages')
+@click.pass_obj
+def warm_cmd(obj, base_url, concurrency, slowest):
+    """ Request every page of the sitemap and the feeds, newest first """
+    from contrivers import warm
+    app = obj.get('app')
+    with app.test_request_context():
+        feeds = warm.feed_paths()
+    paths = warm.plan_paths(warm.read_sitemap(app, base_url), feeds)
+    if base_url:
+        fetch = warm.http_fetcher(base_url)
+    else:
+        fetch = warm.app_fetcher(app)
+    info('Warming {} pages, {} at a time'.format(len(paths), concurrency))
+
+    def report(timing):
+        status = timing.status or 'error'
+        click.echo('{:>5} {:8.1f} ms  {}'.format(status, timing.seconds * 1000, timing.path))
+
+    timings = warm.warm(fetch, paths, concurrency=concurrency, progress=report)
+    total = sum(timing.seconds for timing in timings)
+    failed = [timing for timing in timings if timing.status != 200]
+    info('Warmed {} pages in {:.1f} s of requests, {} not ok'.format(
+        len(timings), total, len(failed)))
+    if slowest:
+        info('Slowest pages:')
+        for timing in sorted(timings, key=lambda t: t.seconds, reverse=True)[:slowest]:
+            report(timing)
+
+
 if __name__ == '__main__':
     cli(obj={})
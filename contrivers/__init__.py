@@ -8,12 +8,18 @@ defines create_app factory function and performs setup for the application.
 """
 
 import os
+import time
 from . import config as config
 import importlib
 from datetime import datetime
 from flask import Flask
+from jinja2 import FileSystemBytecodeCache, TemplateError
 
-from .ext import db
+from .ext import db, response_cache, query_cache, invalidation_bus
+from .rendering import render_cache, set_backend
+from .caching import FragmentCacheExtension, NullCache, cache_from_config
+from .utils import asset_cache, private_directory, s3
+from .middleware import MicroCache
 
 __version__ = "0.3.0"
 __authors__ = ['Luke Thomas Mergner <lmergner@gmail.com']
@@ -75,6 +81,9 @@ def create_app(
     # run ext.init_app(app) all in one place
     configure_ext(app)
 
+    # must run before anything touches app.jinja_env
+    configure_templates(app)
+
     # Register our blueprints
     if blueprints is None:
         blueprints = default_blueprints
@@ -91,6 +100,11 @@ def create_app(
     def context():
         return dict(year=str(datetime.today().year))
 
+    if app.config.get('PRELOAD_TEMPLATES'):
+        preload_templates(app)
+
+    configure_middleware(app)
+
     return app
 
 
@@ -100,6 +114,74 @@ def configure_ext(app):
     # flask-sqlalchemy
     db.init_app(app)
 
+    # markdown backend and render cache
+    set_backend(app.config.get('MARKDOWN_BACKEND', 'python-markdown'))
+    render_cache.init_app(app)
+
+    # full-page cache for the public views, and the results of the
+    # queries they repeat
+    response_cache.init_app(app)
+    query_cache.init_app(app)
+
+    # tells the workers of every dyno what a commit changed
+    invalidation_bus.init_app(app)
+
+    # S3 client and assets stored on disk
+    s3.init_app(app)
+    asset_cache.init_app(app)
+
+
+def configure_middleware(app):
+    """ Wrap the wsgi app """
+    ttl = app.config.get('MICRO_CACHE_TTL')
+    if ttl and not app.debug:
+        app.wsgi_app = MicroCache(
+            app.wsgi_app,
+            ttl=ttl,
+            max_entries=app.config.get('MICRO_CACHE_MAX_ENTRIES', 512),
+            max_bytes=app.config.get('MICRO_CACHE_MAX_BYTES', 16 * 1024 * 1024),
+            report_interval=app.config.get('MICRO_CACHE_REPORT_INTERVAL', 60))
+
+
+def configure_templates(app):
+    """ Add the fragment cache to the jinja environment, and store compiled
+    templates on disk so workers can share them """
+    app.jinja_options = dict(
+        app.jinja_options,
+        extensions=list(app.jinja_options.get('extensions', ())) + [FragmentCacheExtension])
+
+    if app.config.get('TEMPLATE_CACHE', True):
+        cache_dir = app.config.get('TEMPLATE_CACHE_DIR')
+        if cache_dir:
+            private_directory(cache_dir)
+            bytecode_cache = FileSystemBytecodeCache(cache_dir)
+        else:
+            # jinja makes and checks a directory of the user's own
+            bytecode_cache = FileSystemBytecodeCache()
+        app.jinja_options = dict(app.jinja_options, bytecode_cache=bytecode_cache)
+
+    fragment_cache = cache_from_config(app.config, ':fragment:')
+    if not isinstance(fragment_cache, NullCache):
+        fragment_cache.default_timeout = app.config.get('FRAGMENT_CACHE_TIMEOUT')
+        app.jinja_env.fragment_cache = fragment_cache
+
+
+def preload_templates(app):
+    """ Compile every template now instead of on the first request
+
+    :returns: the number of templates loaded
+    """
+    start = time.time()
+    names = app.jinja_env.list_templates()
+    for name in names:
+        try:
+            app.jinja_env.get_template(name)
+        except TemplateError:
+            app.logger.exception('Could not preload template {}'.format(name))
+    app.logger.info('Preloaded {} templates in {:.1f}ms'.format(
+        len(names), (time.time() - start) * 1000))
+    return len(names)
+
 
 def configure_error_handlers(app):
     # TODO: configure error handlers
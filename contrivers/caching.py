@@ -0,0 +1,1526 @@
+# -*- coding: utf-8 -*-
+"""
+    contrivers.caching
+    ------------------
+
+    Cache backends shared by the rendering and view layers, and the
+    full-page response cache.
+
+    Every backend exposes the same small interface: `get`, `set`, `delete`
+    and `clear`. Values are strings; callers are responsible for any
+    serialization. `lock` returns a lock shared by everything that uses
+    the backend, so one worker can fill an entry while the others wait.
+    Backends can be stacked with `TieredCache`, so that the workers of a
+    host share a memory mapped file in front of redis.
+"""
+
+import os
+import json
+import mmap
+import time
+import struct
+import hashlib
+import tempfile
+import logging
+import threading
+from contextlib import contextmanager
+from functools import wraps
+import uuid
+from collections import Counter, OrderedDict
+from itertools import chain
+
+from flask import (current_app, request, make_response, has_request_context, g,
+                   abort)
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from sqlalchemy import Table, event, inspect
+from sqlalchemy.sql.util import find_tables
+
+try:
+    import redis
+    from redis import RedisError
+except ImportError:
+    redis = None
+    RedisError = Exception
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class BaseCache(object):
+    """ Interface for cache backends. """
+
+    def __init__(self, prefix='', default_timeout=None):
+        self.prefix = prefix
+        self.default_timeout = default_timeout
+
+    def make_key(self, key):
+        return self.prefix + key
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        """ Return the values of `keys`, None for each one missing """
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, timeout=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def tag(self, key, tags, timeout=None):
+        """ Record that `key` is to be deleted when any of `tags` is purged """
+        raise NotImplementedError
+
+    def purge(self, tags):
+        """ Delete every key recorded under `tags`
+
+        :returns: the number of keys deleted
+        """
+        raise NotImplementedError
+
+    def tagged(self, tags):
+        """ Return the set of keys recorded under any of `tags` """
+        raise NotImplementedError
+
+    def forget(self, tags=(), keys=()):
+        """ Drop the copies this backend keeps of entries that were purged
+        or deleted on another host
+
+        Only backends that keep copies of a shared tier have any.
+        """
+
+    def lock(self, key, timeout=None):
+        """ Return a lock on `key`, released after `timeout` seconds at most
+
+        Only the threads of this process share the lock.
+        """
+        return LocalLock(self.make_key('lock:' + key), timeout)
+
+
+class RedisCache(BaseCache):
+    """ A backend that stores values in redis
+
+    Redis errors are logged and treated as cache misses so that an
+    unavailable redis server degrades to uncached rendering instead of
+    failing the request.
+    """
+
+    def __init__(self, url, prefix='', default_timeout=None, client=None):
+        super(RedisCache, self).__init__(prefix, default_timeout)
+        if client is None:
+            if redis is None:
+                raise RuntimeError('Cannot import redis, is it installed?')
+            client = redis.StrictRedis.from_url(url)
+        self.client = client
+
+    def get(self, key):
+        try:
+            value = self.client.get(self.make_key(key))
+        except RedisError as err:
+            logger.warning('redis get failed: %s', err)
+            return None
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        return value
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        try:
+            values = self.client.mget([self.make_key(key) for key in keys])
+        except RedisError as err:
+            logger.warning('redis mget failed: %s', err)
+            return [None] * len(keys)
+        return [value.decode('utf-8') if isinstance(value, bytes) else value
+                for value in values]
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        try:
+            if timeout:
+                self.client.setex(self.make_key(key), int(timeout), value)
+            else:
+                self.client.set(self.make_key(key), value)
+        except RedisError as err:
+            logger.warning('redis set failed: %s', err)
+
+    def delete(self, key):
+        try:
+            self.client.delete(self.make_key(key))
+        except RedisError as err:
+            logger.warning('redis delete failed: %s', err)
+
+    def clear(self):
+        """ Delete every key under this backend's prefix """
+        try:
+            keys = list(self.client.scan_iter(match=self.prefix + '*'))
+            if keys:
+                self.client.delete(*keys)
+        except RedisError as err:
+            logger.warning('redis clear failed: %s', err)
+
+    def tag(self, key, tags, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for tag in tags:
+                tag_key = self.make_key('tag:' + tag)
+                pipe.sadd(tag_key, key)
+                if timeout:
+                    # outlive the entries recorded under it
+                    pipe.expire(tag_key, int(timeout) * 2)
+            pipe.execute()
+        except RedisError as err:
+            logger.warning('redis tag failed: %s', err)
+
+    def purge(self, tags):
+        try:
+            tag_keys = [self.make_key('tag:' + tag) for tag in tags]
+            keys = [self.make_key(key) for key in self._members(tag_keys)]
+            if keys or tag_keys:
+                self.client.delete(*(keys + tag_keys))
+            return len(keys)
+        except RedisError as err:
+            logger.warning('redis purge failed: %s', err)
+            return 0
+
+    def tagged(self, tags):
+        try:
+            return self._members([self.make_key('tag:' + tag) for tag in tags])
+        except RedisError as err:
+            logger.warning('redis smembers failed: %s', err)
+            return set()
+
+    def _members(self, tag_keys):
+        pipe = self.client.pipeline(transaction=False)
+        for tag_key in tag_keys:
+            pipe.smembers(tag_key)
+        return set(member.decode('utf-8') for member
+                   in chain.from_iterable(pipe.execute()))
+
+    def lock(self, key, timeout=None):
+        """ Return a lock on `key` shared by every process using this redis """
+        return RedisLock(self.client, self.make_key('lock:' + key), timeout)
+
+
+class NullCache(BaseCache):
+    """ A backend that never stores anything """
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, timeout=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    def tag(self, key, tags, timeout=None):
+        pass
+
+    def purge(self, tags):
+        return 0
+
+    def tagged(self, tags):
+        return set()
+
+    def lock(self, key, timeout=None):
+        # nothing is stored, so waiting for another fill gains nothing
+        return NullLock()
+
+
+class SimpleCache(BaseCache):
+    """ An in-process backend for development and tests
+
+    Entries are not shared between workers. When more than `threshold`
+    entries are stored the expired ones are dropped, then the oldest.
+    """
+
+    def __init__(self, prefix='', default_timeout=None, threshold=500):
+        super(SimpleCache, self).__init__(prefix, default_timeout)
+        self.threshold = threshold
+        self._entries = {}
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(self.make_key(key))
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires and expires < time.time():
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = time.time() + timeout if timeout else 0
+        with self._lock:
+            self._prune()
+            self._entries[self.make_key(key)] = (expires, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(self.make_key(key), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def tag(self, key, tags, timeout=None):
+        with self._lock:
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+
+    def purge(self, tags):
+        with self._lock:
+            keys = set()
+            for tag in tags:
+                keys.update(self._tags.pop(tag, ()))
+            deleted = 0
+            for key in keys:
+                if self._entries.pop(self.make_key(key), None) is not None:
+                    deleted += 1
+            return deleted
+
+    def tagged(self, tags):
+        with self._lock:
+            return set(chain.from_iterable(self._tags.get(tag, ()) for tag in tags))
+
+    def _prune(self):
+        if len(self._entries) < self.threshold:
+            return
+        now = time.time()
+        for key, (expires, _) in list(self._entries.items()):
+            if expires and expires < now:
+                del self._entries[key]
+        while len(self._entries) >= self.threshold:
+            oldest = min(self._entries, key=lambda k: self._entries[k][0])
+            del self._entries[oldest]
+
+
+#
+# Shared memory
+#
+# The workers of a host map the same file, under /dev/shm on linux so it
+# never touches the disk. The file is divided into size classes of fixed
+# size slots, and each class into sets of `ways` slots. A key is stored in
+# at most one slot of the set its hash picks in each class, so a worker
+# only locks those sets, with a record lock on their range of the file.
+#
+
+# (slot bytes, slots): 56MB, mostly for pages
+SHARED_MEMORY_SLOTS = ((1024, 8192), (16 * 1024, 1024), (128 * 1024, 256))
+
+
+class SharedMemory(object):
+    """ A file mapped by every worker on the host
+
+    Open it with `SharedMemory.open`, which maps each file once in each
+    process, so that the threads of a process share its lock.
+    """
+
+    MAGIC = b'CTRVSHM1'
+    HEADER = struct.Struct('<8sII')
+    SIZE_CLASS = struct.Struct('<II')
+    HEADER_BYTES = 4096
+
+    _opened = {}
+    _opened_lock = threading.Lock()
+
+    def __init__(self, path, slots=SHARED_MEMORY_SLOTS, ways=8):
+        self.path = path
+        self.ways = ways
+        # (slot bytes, sets, offset)
+        self.classes = []
+        offset = self.HEADER_BYTES
+        for slot_size, count in sorted(slots):
+            sets = max(1, count // ways)
+            self.classes.append((slot_size, sets, offset))
+            offset += slot_size * ways * sets
+        self.size = offset
+        self.header = self.HEADER.pack(self.MAGIC, ways, len(self.classes)) + \
+            b''.join(self.SIZE_CLASS.pack(slot_size, sets)
+                     for slot_size, sets, _ in self.classes)
+        # record locks belong to the process, so its threads take turns
+        self.lock = threading.Lock()
+        self.fd = self._open()
+        self.map = mmap.mmap(self.fd, self.size)
+
+    @classmethod
+    def open(cls, path, slots=SHARED_MEMORY_SLOTS, ways=8):
+        # a forked worker maps the file again, the lock may have been held
+        key = (path, tuple(slots), ways, os.getpid())
+        with cls._opened_lock:
+            memory = cls._opened.get(key)
+            if memory is None:
+                memory = cls._opened[key] = cls(path, slots, ways)
+            return memory
+
+    def _open(self):
+        """ Open the file, making it if it is missing or laid out otherwise
+
+        Pages are served from the file as they are, so one that another
+        user owns or can write to is refused.
+        """
+        guard = self._open_private(self.path + '.lock', os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(guard, fcntl.LOCK_EX)
+            try:
+                fd = self._open_private(self.path, os.O_RDWR)
+            except FileNotFoundError:
+                fd = None
+            if fd is not None:
+                if os.fstat(fd).st_size == self.size and \
+                        os.pread(fd, len(self.header), 0) == self.header:
+                    return fd
+                os.close(fd)
+                logger.info('replacing %s, its layout changed', self.path)
+            # workers that mapped the old file keep it until they exit
+            directory, name = os.path.split(self.path)
+            fd, temp = tempfile.mkstemp(prefix=name + '.', dir=directory or None)
+            os.ftruncate(fd, self.size)
+            os.pwrite(fd, self.header, 0)
+            os.replace(temp, self.path)
+            return fd
+        finally:
+            os.close(guard)
+
+    @staticmethod
+    def _open_private(path, flags):
+        fd = os.open(path, flags | os.O_NOFOLLOW, 0o600)
+        stat = os.fstat(fd)
+        # lock files made before this check are 0644, and still safe
+        if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+            os.close(fd)
+            raise RuntimeError(
+                '{} must be a file owned by this user, that only it can write'.format(path))
+        return fd
+
+    def sets(self, digest):
+        """ Yield the slot size and offset of the set `digest` picks in
+        each class """
+        n = int.from_bytes(digest[:8], 'little')
+        for slot_size, sets, offset in self.classes:
+            yield slot_size, offset + (n % sets) * slot_size * self.ways
+
+    def all_sets(self):
+        for slot_size, sets, offset in self.classes:
+            for n in range(sets):
+                yield slot_size, offset + n * slot_size * self.ways
+
+    @contextmanager
+    def locked(self, slot_size, offset, exclusive=True):
+        """ Hold a lock on the set of slots at `offset` """
+        length = slot_size * self.ways
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH,
+                        length, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, length, offset)
+
+
+class SharedMemoryCache(BaseCache):
+    """ A backend in a file shared by the workers of a host
+
+    Each slot holds the hash of the key, its expiry and the time it was
+    last read, then the key, its tags and the value. Setting a key drops
+    its tags; callers tag an entry after they set it. A set is full when
+    each of its slots is taken; a new entry replaces an expired one, or
+    the one read least recently. Values too large for the largest slot
+    are not stored.
+
+    The tags of an entry are stored with it, so `purge` reads every slot.
+    It is meant for the rare commit, not for each request.
+    """
+
+    SLOT = struct.Struct('<16sddIII')
+    EMPTY = bytes(16)
+
+    def __init__(self, path, prefix='', default_timeout=None,
+                 slots=SHARED_MEMORY_SLOTS, ways=8):
+        super(SharedMemoryCache, self).__init__(prefix, default_timeout)
+        if fcntl is None:
+            raise RuntimeError('Cannot import fcntl, shared memory needs unix')
+        self.path = path
+        self.slots = slots
+        self.ways = ways
+
+    @property
+    def memory(self):
+        return SharedMemory.open(self.path, self.slots, self.ways)
+
+    @staticmethod
+    def digest(key):
+        return hashlib.blake2b(key, digest_size=16).digest()
+
+    def _read(self, memory, slot):
+        """ Return the header, key, tags and value at `slot` """
+        header = self.SLOT.unpack_from(memory.map, slot)
+        key_len, tags_len, value_len = header[3:]
+        start = slot + self.SLOT.size
+        key = memory.map[start:start + key_len]
+        start += key_len
+        tags = memory.map[start:start + tags_len]
+        start += tags_len
+        return header, key, tags, memory.map[start:start + value_len]
+
+    def _find(self, memory, slot_size, offset, key, digest):
+        """ Return the slot of the set at `offset` that holds `key` """
+        start = self.SLOT.size
+        for n in range(memory.ways):
+            slot = offset + n * slot_size
+            if memory.map[slot:slot + 16] != digest:
+                continue
+            key_len = self.SLOT.unpack_from(memory.map, slot)[3]
+            if key_len == len(key) and \
+                    memory.map[slot + start:slot + start + key_len] == key:
+                return slot
+        return None
+
+    def _victim(self, memory, slot_size, offset, now):
+        """ Return the empty, expired or least recently read slot of a set """
+        victim = used = None
+        for n in range(memory.ways):
+            slot = offset + n * slot_size
+            digest, expires, last_used = self.SLOT.unpack_from(memory.map, slot)[:3]
+            if digest == self.EMPTY or (expires and expires < now):
+                return slot
+            if victim is None or last_used < used:
+                victim, used = slot, last_used
+        return victim
+
+    def _write(self, memory, slot, digest, expires, key, tags, value):
+        self.SLOT.pack_into(memory.map, slot, digest, expires, time.time(),
+                            len(key), len(tags), len(value))
+        start = slot + self.SLOT.size
+        memory.map[start:start + len(key) + len(tags) + len(value)] = key + tags + value
+
+    def _empty(self, memory, slot):
+        memory.map[slot:slot + self.SLOT.size] = bytes(self.SLOT.size)
+
+    def get(self, key):
+        key = self.make_key(key).encode('utf-8')
+        digest = self.digest(key)
+        memory = self.memory
+        for slot_size, offset in memory.sets(digest):
+            with memory.locked(slot_size, offset, exclusive=False):
+                slot = self._find(memory, slot_size, offset, key, digest)
+                if slot is None:
+                    continue
+                header, _, _, value = self._read(memory, slot)
+                now = time.time()
+                if header[1] and header[1] < now:
+                    return None
+                # written under the shared lock, a lost update only makes
+                # the choice of victim less exact
+                struct.pack_into('<d', memory.map, slot + 24, now)
+                return value.decode('utf-8')
+        return None
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = time.time() + timeout if timeout else 0
+        key = self.make_key(key).encode('utf-8')
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        digest = self.digest(key)
+        size = self.SLOT.size + len(key) + len(value)
+        memory = self.memory
+        stored = False
+        for slot_size, offset in memory.sets(digest):
+            with memory.locked(slot_size, offset):
+                slot = self._find(memory, slot_size, offset, key, digest)
+                if stored or size > slot_size:
+                    # the old value may have been in another class
+                    if slot is not None:
+                        self._empty(memory, slot)
+                    continue
+                if slot is None:
+                    slot = self._victim(memory, slot_size, offset, time.time())
+                self._write(memory, slot, digest, expires, key, b'', value)
+                stored = True
+
+    def delete(self, key):
+        key = self.make_key(key).encode('utf-8')
+        digest = self.digest(key)
+        memory = self.memory
+        for slot_size, offset in memory.sets(digest):
+            with memory.locked(slot_size, offset):
+                slot = self._find(memory, slot_size, offset, key, digest)
+                if slot is not None:
+                    self._empty(memory, slot)
+
+    def _sweep(self, drop):
+        """ Empty the slots under this backend's prefix for which
+        `drop(tags)` is true
+
+        :returns: the number of slots emptied
+        """
+        prefix = self.prefix.encode('utf-8')
+        memory = self.memory
+        dropped = 0
+        for slot_size, offset in memory.all_sets():
+            with memory.locked(slot_size, offset):
+                for n in range(memory.ways):
+                    slot = offset + n * slot_size
+                    if memory.map[slot:slot + 16] == self.EMPTY:
+                        continue
+                    _, key, tags, _ = self._read(memory, slot)
+                    if key.startswith(prefix) and drop(tags):
+                        self._empty(memory, slot)
+                        dropped += 1
+        return dropped
+
+    def clear(self):
+        """ Delete every key under this backend's prefix """
+        self._sweep(lambda tags: True)
+
+    def tag(self, key, tags, timeout=None):
+        key = self.make_key(key).encode('utf-8')
+        digest = self.digest(key)
+        memory = self.memory
+        for slot_size, offset in memory.sets(digest):
+            with memory.locked(slot_size, offset):
+                slot = self._find(memory, slot_size, offset, key, digest)
+                if slot is None:
+                    continue
+                header, _, old, value = self._read(memory, slot)
+                names = set(old.decode('utf-8').split()) | set(tags)
+                new = u' '.join(sorted(names)).encode('utf-8')
+                if self.SLOT.size + len(key) + len(new) + len(value) > slot_size:
+                    # it couldn't be purged
+                    self._empty(memory, slot)
+                else:
+                    self._write(memory, slot, digest, header[1], key, new, value)
+                return
+
+    def purge(self, tags):
+        tags = set(tags)
+        return self._sweep(
+            lambda names: not tags.isdisjoint(names.decode('utf-8').split()))
+
+
+class TieredCache(BaseCache):
+    """ A stack of backends, the fastest first
+
+    Reads go down the stack and fill the tiers above the one that had
+    the entry; writes, deletes and purges go to every tier. The tiers
+    above the last are not told of changes made on other hosts, so their
+    entries expire after `timeout` seconds at most. Locks are taken in
+    the last tier, which every host shares.
+    """
+
+    # the tag of entries filled from a lower tier, which are stored
+    # without their own tags
+    FILLED = '-filled'
+
+    def __init__(self, tiers, timeout=30):
+        super(TieredCache, self).__init__(tiers[-1].prefix, tiers[-1].default_timeout)
+        self.tiers = tiers
+        self.timeout = timeout
+
+    def front_timeout(self, timeout):
+        if timeout is None:
+            timeout = self.tiers[-1].default_timeout
+        return min(timeout, self.timeout) if timeout else self.timeout
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        values = [None] * len(keys)
+        missing = list(range(len(keys)))
+        for depth, tier in enumerate(self.tiers):
+            if not missing:
+                break
+            found = tier.get_many([keys[i] for i in missing])
+            for i, value in zip(missing, found):
+                if value is None:
+                    continue
+                values[i] = value
+                for above in self.tiers[:depth]:
+                    above.set(keys[i], value, self.timeout)
+                    above.tag(keys[i], [self.FILLED], self.timeout)
+            missing = [i for i in missing if values[i] is None]
+        return values
+
+    def set(self, key, value, timeout=None):
+        for tier in self.tiers[:-1]:
+            tier.set(key, value, self.front_timeout(timeout))
+        self.tiers[-1].set(key, value, timeout)
+
+    def delete(self, key):
+        for tier in self.tiers:
+            tier.delete(key)
+
+    def clear(self):
+        for tier in self.tiers:
+            tier.clear()
+
+    def tag(self, key, tags, timeout=None):
+        for tier in self.tiers:
+            tier.tag(key, tags, timeout)
+
+    def purge(self, tags):
+        # entries filled from the last tier were stored without their tags
+        keys = self.tiers[-1].tagged(tags)
+        for tier in self.tiers[:-1]:
+            tier.purge(tags)
+            for key in keys:
+                tier.delete(key)
+        return self.tiers[-1].purge(tags)
+
+    def tagged(self, tags):
+        return self.tiers[-1].tagged(tags)
+
+    def forget(self, tags=(), keys=()):
+        for tier in self.tiers[:-1]:
+            if tags:
+                # the last tier's tags are gone, so drop every filled entry
+                tier.purge(list(tags) + [self.FILLED])
+            for key in keys:
+                tier.delete(key)
+
+    def lock(self, key, timeout=None):
+        return self.tiers[-1].lock(key, timeout)
+
+
+#
+# Locks
+#
+# All locks have the interface of `threading.Lock`: `acquire(blocking,
+# timeout)` and `release`. Releasing a lock that has expired, or that is
+# no longer held, does nothing.
+#
+
+class LocalLock(object):
+    """ A lock shared by the threads of this process
+
+    Like a redis lock it expires after `timeout` seconds, and is dropped
+    when released, so any number of names can be locked.
+    """
+
+    _held = {}
+    _condition = threading.Condition()
+
+    def __init__(self, name, timeout=None):
+        self.name = name
+        self.timeout = timeout
+        self._token = None
+
+    def acquire(self, blocking=True, timeout=None):
+        # monotonic, so that tests can move time.time
+        now = time.monotonic()
+        deadline = None if timeout is None else now + timeout
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                holder = self._held.get(self.name)
+                if holder is None or (holder[1] and holder[1] <= now):
+                    break
+                if not blocking or (deadline is not None and deadline <= now):
+                    return False
+                waits = [t - now for t in (holder[1], deadline) if t]
+                self._condition.wait(min(waits) if waits else None)
+            self._token = object()
+            expires = now + self.timeout if self.timeout else 0
+            self._held[self.name] = (self._token, expires)
+            return True
+
+    def release(self):
+        with self._condition:
+            holder = self._held.get(self.name)
+            if holder is not None and holder[0] is self._token:
+                del self._held[self.name]
+                self._condition.notify_all()
+        self._token = None
+
+
+class NullLock(object):
+    """ A lock that is always free """
+
+    def acquire(self, blocking=True, timeout=None):
+        return True
+
+    def release(self):
+        pass
+
+
+class RedisLock(object):
+    """ A lock shared by every process using the redis server
+
+    The lock expires after `timeout` seconds, so a worker that dies while
+    holding it cannot block the others for long. If redis is unavailable
+    the lock falls back to a `LocalLock`, which still keeps the threads
+    of this process from repeating each other's work.
+    """
+
+    def __init__(self, client, name, timeout=None):
+        self.name = name
+        self.timeout = timeout
+        self._lock = client.lock(name, timeout=timeout)
+        self._fallback = None
+
+    def acquire(self, blocking=True, timeout=None):
+        try:
+            return self._lock.acquire(blocking=blocking, blocking_timeout=timeout)
+        except RedisError as err:
+            logger.warning('redis lock failed: %s', err)
+            self._fallback = LocalLock(self.name, self.timeout)
+            return self._fallback.acquire(blocking, timeout)
+
+    def release(self):
+        if self._fallback is not None:
+            self._fallback.release()
+            return
+        try:
+            self._lock.release()
+        except RedisError:
+            # expired, and perhaps taken by another worker since
+            pass
+
+
+def cache_from_config(config, prefix=''):
+    """ Return the backend named by CACHE_TYPE
+
+    With SHARED_CACHE_PATH set a redis backend is put behind the shared
+    memory at that path, and 'shared' uses the shared memory alone.
+
+    :param config: the app config
+    :param prefix: appended to CACHE_KEY_PREFIX to give the backend a
+        namespace of its own
+    """
+    cache_type = config.get('CACHE_TYPE', 'null')
+    key_prefix = config.get('CACHE_KEY_PREFIX', '') + prefix
+    timeout = config.get('CACHE_DEFAULT_TIMEOUT')
+    path = config.get('SHARED_CACHE_PATH')
+    if cache_type in ('redis', 'shared') and path and fcntl is not None:
+        shared = SharedMemoryCache(
+            path, prefix=key_prefix, default_timeout=timeout,
+            slots=config.get('SHARED_CACHE_SLOTS', SHARED_MEMORY_SLOTS),
+            ways=config.get('SHARED_CACHE_WAYS', 8))
+    else:
+        shared = None
+    if cache_type == 'redis':
+        url = config.get('CACHE_REDIS_URL')
+        if url is None:
+            logger.warning('CACHE_TYPE is redis but CACHE_REDIS_URL is not set')
+            return NullCache()
+        backend = RedisCache(url, prefix=key_prefix, default_timeout=timeout)
+        if shared is None:
+            return backend
+        return TieredCache([shared, backend], config.get('SHARED_CACHE_TIMEOUT', 30))
+    elif cache_type == 'shared':
+        if shared is None:
+            logger.warning('CACHE_TYPE is shared but SHARED_CACHE_PATH is not set')
+            return NullCache()
+        return shared
+    elif cache_type == 'simple':
+        return SimpleCache(prefix=key_prefix, default_timeout=timeout)
+    elif cache_type == 'null':
+        return NullCache()
+    raise ValueError('Unknown CACHE_TYPE {!r}'.format(cache_type))
+
+
+#
+# Response cache
+#
+# Responses are tagged with surrogate keys naming the rows they were
+# rendered from: `writing:42` for a row, and `writing` for pages that list
+# a table. A commit purges the responses tagged with the keys of the rows
+# it changed, and the keys are sent in a Surrogate-Key header for a CDN.
+#
+
+def surrogate_key(obj):
+    """ Return the surrogate key of a model instance, e.g. `writing:42` """
+    return u'{}:{}'.format(collection_key(type(obj)), obj.id)
+
+
+def collection_key(model):
+    """ Return the surrogate key of every row of `model`, e.g. `writing`
+
+    Subclasses share the key of the model they inherit from.
+    """
+    return inspect(model).base_mapper.class_.__name__.lower()
+
+
+def add_surrogate_keys(*keys):
+    """ Record that the current response depends on `keys` """
+    if has_request_context():
+        g.setdefault('surrogate_keys', set()).update(keys)
+
+
+class ResponseCache(object):
+    """ Cache whole responses of public GET views
+
+    Views opt in with the `cached` decorator. Entries expire after
+    CACHE_DEFAULT_TIMEOUT, and are purged by their surrogate keys when a
+    session that changed one of the watched models commits.
+
+    RESPONSE_CACHE_POLICIES can give an endpoint a `soft` and a `hard`
+    ttl. An entry older than its soft ttl is still served, marked STALE,
+    while a background thread renders it again; the hard ttl caps how long
+    it is kept.
+
+    A miss is filled under a lock on its key, so that a page is rendered
+    once however many workers ask for it at the same time. The others wait
+    up to RESPONSE_CACHE_LOCK_WAIT seconds for the entry; the lock expires
+    after RESPONSE_CACHE_LOCK_TIMEOUT.
+    """
+
+    # the surrogate keys a session's commit will purge, in `session.info`
+    PENDING = 'response_cache_purge'
+
+    def __init__(self, app=None):
+        self.backend = NullCache()
+        self.policies = {}
+        self.lock_timeout = 30
+        self.lock_wait = 5
+        self.metrics = Counter()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.backend = cache_from_config(app.config, ':view:')
+        self.policies = app.config.get('RESPONSE_CACHE_POLICIES', {})
+        self.lock_timeout = app.config.get('RESPONSE_CACHE_LOCK_TIMEOUT', 30)
+        self.lock_wait = app.config.get('RESPONSE_CACHE_LOCK_WAIT', 5)
+        app.extensions['response_cache'] = self
+
+    def make_key(self):
+        return request.url
+
+    def policy(self, endpoint):
+        """ Return the soft and hard ttl for `endpoint`; None if unset """
+        policy = self.policies.get(endpoint, {})
+        return policy.get('soft'), policy.get('hard')
+
+    def count(self, endpoint, outcome):
+        with self._lock:
+            self.metrics[(endpoint, outcome)] += 1
+
+    def stats(self):
+        """ Return the number of hits, misses, stale serves, background
+        refreshes and lock waits, by endpoint """
+        with self._lock:
+            stats = {}
+            for (endpoint, outcome), value in self.metrics.items():
+                stats.setdefault(endpoint, {})[outcome] = value
+            return stats
+
+    def cached(self, timeout=None):
+        """ Decorate a view to serve its responses from the cache """
+
+        def decorator(fn):
+
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                if request.method not in ('GET', 'HEAD'):
+                    return fn(*args, **kwargs)
+                endpoint = request.endpoint
+                soft, hard = self.policy(endpoint)
+                hard = hard or timeout
+                key = self.make_key()
+                entry = self.backend.get(key)
+                if entry is not None:
+                    entry = json.loads(entry)
+                    age = time.time() - entry.get('stored', 0)
+                    if soft is not None and age > soft:
+                        self.count(endpoint, 'stale')
+                        logger.debug('serving %s %ds past its soft ttl', key, age - soft)
+                        self.refresh(key, fn, args, kwargs, hard)
+                        return self.load(entry, 'STALE')
+                    self.count(endpoint, 'hit')
+                    return self.load(entry)
+                return self.fill(key, fn, args, kwargs, hard)
+
+            return wrapper
+
+        return decorator
+
+    def fill(self, key, fn, args, kwargs, timeout=None):
+        """ Render the view for a miss and store it
+
+        If another request is filling the key, wait for its entry instead;
+        if none appears in time, render the view anyway.
+        """
+        endpoint = request.endpoint
+        lock = self.backend.lock(key, self.lock_timeout)
+        if not lock.acquire(blocking=False):
+            self.count(endpoint, 'contended')
+            if lock.acquire(timeout=self.lock_wait):
+                entry = self.backend.get(key)
+                if entry is not None:
+                    lock.release()
+                    self.count(endpoint, 'coalesced')
+                    return self.load(json.loads(entry))
+            else:
+                logger.debug('gave up waiting for %s to be filled', key)
+                self.count(endpoint, 'lock_timeout')
+                lock = NullLock()
+        self.count(endpoint, 'miss')
+        try:
+            g.surrogate_keys = set()
+            response = make_response(fn(*args, **kwargs))
+            if self.is_cacheable(response):
+                self.store(key, response, timeout)
+        except Exception:
+            lock.release()
+            raise
+        if response.is_streamed:
+            # a streamed entry is stored once its body has been sent
+            response.call_on_close(lock.release)
+        else:
+            lock.release()
+        response.headers['X-Cache'] = 'MISS'
+        return response
+
+    def refresh(self, key, fn, args, kwargs, timeout=None):
+        """ Render the view again in a background thread and store it
+
+        Only one refresh of a key runs at a time, across all workers
+        sharing the backend.
+        :returns: the thread, or None if a refresh is already running
+        """
+        with self._lock:
+            if key in self._refreshing:
+                return None
+            self._refreshing.add(key)
+        app = current_app._get_current_object()
+        environ = dict(request.environ)
+        endpoint = request.endpoint
+
+        def run():
+            lock = self.backend.lock(key, self.lock_timeout)
+            try:
+                if not lock.acquire(blocking=False):
+                    # another worker is refreshing it
+                    self.count(endpoint, 'contended')
+                    return
+                with app.request_context(environ):
+                    g.surrogate_keys = set()
+                    response = make_response(fn(*args, **kwargs))
+                    # render a streamed body now
+                    response.make_sequence()
+                    if self.is_cacheable(response):
+                        self.store(key, response, timeout)
+                self.count(endpoint, 'refresh')
+            except Exception:
+                logger.exception('refreshing %s failed', key)
+                self.count(endpoint, 'refresh_error')
+            finally:
+                lock.release()
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        thread = threading.Thread(target=run, name='response-cache-refresh')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    @staticmethod
+    def is_cacheable(response):
+        return response.status_code == 200 and 'Set-Cookie' not in response.headers
+
+    def store(self, key, response, timeout=None):
+        """ Save `response` once its body has been produced
+
+        A streamed body is passed through to the client and saved when it
+        has been sent in full; its Surrogate-Key header only names the
+        rows loaded before the first chunk.
+        """
+        headers = [(name, value) for name, value in response.headers.items()
+                   if name not in ('Content-Length', 'X-Cache', 'Surrogate-Key')]
+        # still filled in while a streamed body renders
+        surrogate_keys = g.setdefault('surrogate_keys', set())
+        chunks = []
+
+        def save():
+            keys = sorted(surrogate_keys)
+            entry = json.dumps({
+                'status': response.status_code,
+                'headers': headers,
+                'keys': keys,
+                'stored': time.time(),
+                'body': b''.join(chunks).decode('utf-8')})
+            self.backend.set(key, entry, timeout)
+            self.backend.tag(key, keys, timeout)
+
+        if not response.is_streamed:
+            chunks.append(response.get_data())
+            save()
+        else:
+            def tee(iterable):
+                for chunk in iterable:
+                    chunks.append(chunk)
+                    yield chunk
+                save()
+
+            response.response = tee(response.iter_encoded())
+        response.headers['Surrogate-Key'] = u' '.join(sorted(surrogate_keys))
+
+    @staticmethod
+    def load(entry, status='HIT'):
+        response = current_app.response_class(
+            entry['body'], status=entry['status'], headers=entry['headers'])
+        response.headers['Surrogate-Key'] = u' '.join(entry['keys'])
+        response.headers['Age'] = str(int(time.time() - entry.get('stored', time.time())))
+        response.headers['X-Cache'] = status
+        return response
+
+    def invalidate(self):
+        """ Drop every cached response """
+        self.backend.clear()
+
+    def purge(self, keys):
+        """ Drop the responses tagged with any of `keys` """
+        deleted = self.backend.purge(keys)
+        logger.debug('purged %d responses for %s', deleted, ' '.join(sorted(keys)))
+        return deleted
+
+    def forget(self, keys, tables):
+        """ Drop the copies this host keeps of responses another host purged """
+        self.backend.forget(tags=keys)
+
+    def watch(self, session, models, listed_by=()):
+        """ Tag responses with the rows of `models` they load, and purge them
+        after a commit that changed those rows
+
+        Adding or deleting a row, or changing one of the `listed_by`
+        attributes, also purges the pages that list its table. Changing a
+        relationship purges the pages of the rows added or removed.
+
+        :param session: a session, sessionmaker or scoped session
+        :param models: the model classes views are rendered from
+        :param listed_by: attributes that decide which lists show a row
+        """
+        models = tuple(models)
+
+        def on_load(target, *args):
+            add_surrogate_keys(surrogate_key(target))
+
+        for model in models:
+            event.listen(model, 'load', on_load, propagate=True)
+            event.listen(model, 'refresh', on_load, propagate=True)
+
+        def changed_keys(obj, listed):
+            state = inspect(obj)
+            yield surrogate_key(obj)
+            if listed or any(state.attrs[attr].history.has_changes()
+                             for attr in listed_by if attr in state.attrs):
+                yield collection_key(type(obj))
+            # pages that list the rows this one was added to or removed
+            # from; pages that already showed it have its own key
+            for rel in state.mapper.relationships:
+                history = state.attrs[rel.key].history
+                for other in chain(history.added or (), history.deleted or ()):
+                    if isinstance(other, models):
+                        yield surrogate_key(other)
+
+        def after_flush(session, flush_context):
+            keys = session.info.setdefault(self.PENDING, set())
+            for objs, listed in ((session.new, True), (session.dirty, False),
+                                 (session.deleted, True)):
+                for obj in objs:
+                    if isinstance(obj, models):
+                        keys.update(changed_keys(obj, listed))
+
+        def after_commit(session):
+            keys = session.info.pop(self.PENDING, None)
+            if keys:
+                self.purge(keys)
+
+        def after_rollback(session):
+            session.info.pop(self.PENDING, None)
+
+        event.listen(session, 'after_flush', after_flush)
+        event.listen(session, 'after_commit', after_commit)
+        event.listen(session, 'after_rollback', after_rollback)
+
+
+#
+# Query cache
+#
+# Results are stored by the primary keys of the rows a query returned,
+# under a key naming the query and the generation of every table it reads.
+# A commit gives the tables it wrote a new generation, so the entries of
+# older generations are never read again and expire on their own.
+#
+
+def compile_query(query):
+    return query.statement.compile(dialect=query.session.get_bind().dialect)
+
+
+def query_tables(query, compiled=None):
+    """ Return the names of the tables a query reads """
+    compiled = compiled if compiled is not None else compile_query(query)
+    # joins along relationships are only resolved when compiled
+    elements = [query.statement] + list(getattr(compiled.compile_state, 'froms', ()))
+    return sorted(set(
+        table.name for element in elements for table in find_tables(
+            element, include_aliases=True, include_joins=True,
+            check_columns=True)
+        if isinstance(table, Table)))
+
+
+class CachedPage(object):
+    """ A page of results, with the attributes of a Flask-SQLAlchemy
+    Pagination that the templates use """
+
+    def __init__(self, page, per_page, total, items):
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+        self.items = items
+
+    @property
+    def pages(self):
+        return max(0, self.total - 1) // self.per_page + 1 if self.total else 0
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+    @property
+    def prev_num(self):
+        return self.page - 1 if self.has_prev else None
+
+    @property
+    def has_next(self):
+        return self.page < self.pages
+
+    @property
+    def next_num(self):
+        return self.page + 1 if self.has_next else None
+
+
+class QueryCache(object):
+    """ Cache the results of the queries views run again and again
+
+    A small LRU in each process is consulted first, then the shared
+    backend. Entries are found by the current generation of their tables,
+    which is read from the backend once per request, so no worker serves
+    a result from before another worker's commit.
+
+    Without a shared backend queries always run.
+    """
+
+    # the tables a session's commit will bump, in `session.info`
+    PENDING = 'query_cache_bump'
+
+    def __init__(self, app=None):
+        self.backend = NullCache()
+        self.timeout = None
+        self.local_size = 256
+        self.metrics = Counter()
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.backend = cache_from_config(app.config, ':query:')
+        self.timeout = app.config.get('QUERY_CACHE_TIMEOUT')
+        self.local_size = app.config.get('QUERY_CACHE_LOCAL_SIZE', self.local_size)
+        self.clear_local()
+        app.extensions['query_cache'] = self
+
+    @property
+    def enabled(self):
+        return not isinstance(self.backend, NullCache)
+
+    def clear_local(self):
+        with self._lock:
+            self._local.clear()
+            self.metrics.clear()
+
+    def stats(self):
+        """ Return the number of local and shared hits, and misses """
+        with self._lock:
+            return dict(self.metrics, local_entries=len(self._local))
+
+    def generations(self, tables):
+        """ Return the current generation of each of `tables`
+
+        Generations are read once per request. A table without one, new or
+        evicted from the backend, is given one.
+        """
+        known = g.setdefault('query_generations', {}) if has_request_context() else {}
+        missing = [table for table in tables if table not in known]
+        if missing:
+            values = self.backend.get_many(['gen:' + table for table in missing])
+            for table, value in zip(missing, values):
+                if value is None:
+                    value = self.bump(table)
+                known[table] = value
+        return [known[table] for table in tables]
+
+    def bump(self, table):
+        """ Give `table` a new generation and return it """
+        generation = uuid.uuid4().hex[:12]
+        self.backend.set('gen:' + table, generation, 0)
+        if has_request_context():
+            g.setdefault('query_generations', {})[table] = generation
+        return generation
+
+    def forget(self, keys, tables):
+        """ Drop the copies this host keeps of generations another host
+        bumped """
+        self.backend.forget(keys=['gen:' + table for table in tables])
+
+    def make_key(self, query, *extra):
+        compiled = compile_query(query)
+        tables = query_tables(query, compiled)
+        parts = [str(compiled), repr(sorted(compiled.params.items()))]
+        parts.extend(repr(part) for part in extra)
+        parts.extend(u'{}:{}'.format(table, generation) for table, generation
+                     in zip(tables, self.generations(tables)))
+        return hashlib.sha1(u'|'.join(parts).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._local:
+                self._local.move_to_end(key)
+                self.metrics['local_hits'] += 1
+                return self._local[key]
+        value = self.backend.get(key)
+        if value is None:
+            with self._lock:
+                self.metrics['misses'] += 1
+            return None
+        value = json.loads(value)
+        with self._lock:
+            self.metrics['shared_hits'] += 1
+        self._store_local(key, value)
+        return value
+
+    def set(self, key, value):
+        self._store_local(key, value)
+        self.backend.set(key, json.dumps(value), self.timeout)
+
+    def _store_local(self, key, value):
+        with self._lock:
+            self._local[key] = value
+            self._local.move_to_end(key)
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+
+    def cached(self, query, compute, *extra):
+        """ Return compute(), or its json-able result from the cache """
+        if not self.enabled:
+            return compute()
+        key = self.make_key(query, *extra)
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.set(key, value)
+        return value
+
+    @staticmethod
+    def primary_key(obj):
+        return inspect(obj).mapper.primary_key_from_instance(obj)[0]
+
+    @staticmethod
+    def load(query, ids):
+        """ Return the rows of `query`'s model with primary keys `ids`, in
+        that order
+
+        The rows are loaded by `query` itself, less its order and limits,
+        so they come with the relationships its loader options name.
+        """
+        if not ids:
+            return []
+        model = query.column_descriptions[0]['entity']
+        column = inspect(model).primary_key[0]
+        rows = query.enable_assertions(False).\
+            order_by(None).limit(None).offset(None).\
+            filter(column.in_(ids)).all()
+        by_id = dict((QueryCache.primary_key(row), row) for row in rows)
+        return [by_id[id_] for id_ in ids if id_ in by_id]
+
+    def all(self, query):
+        """ Return the rows of a query of one model, like `query.all()` """
+        loaded = []
+
+        def compute():
+            loaded.extend(query.all())
+            return [self.primary_key(row) for row in loaded]
+
+        ids = self.cached(query, compute)
+        return loaded or self.load(query, ids)
+
+    def paginate(self, query, page=1, per_page=20):
+        """ Return a page of a query of one model, like `query.paginate()`
+
+        Pages past the last are not found.
+        """
+        loaded = []
+
+        def compute():
+            loaded.extend(query.limit(per_page).offset((page - 1) * per_page).all())
+            total = query.order_by(None).count()
+            return {'ids': [self.primary_key(row) for row in loaded], 'total': total}
+
+        if page < 1:
+            abort(404)
+        value = self.cached(query, compute, 'page', page, per_page)
+        items = loaded or self.load(query, value['ids'])
+        if not items and page != 1:
+            abort(404)
+        return CachedPage(page, per_page, value['total'], items)
+
+    def scalar(self, query):
+        """ Return `query.scalar()`, which must be json-able """
+        return self.cached(query, query.scalar, 'scalar')
+
+    def watch(self, session):
+        """ Give the tables a session writes a new generation after it
+        commits
+
+        :param session: a session, sessionmaker or scoped session
+        """
+        def changed_tables(obj, created_or_deleted):
+            state = inspect(obj)
+            tables = set(table.name for table in state.mapper.tables)
+            for rel in state.mapper.relationships:
+                if rel.secondary is None:
+                    continue
+                if created_or_deleted or state.attrs[rel.key].history.has_changes():
+                    tables.add(rel.secondary.name)
+            return tables
+
+        def pending(session):
+            return session.info.setdefault(self.PENDING, set())
+
+        def after_flush(session, flush_context):
+            tables = pending(session)
+            for obj in session.new | session.deleted:
+                tables.update(changed_tables(obj, True))
+            for obj in session.dirty:
+                if session.is_modified(obj):
+                    tables.update(changed_tables(obj, False))
+
+        def do_orm_execute(state):
+            # bulk statements skip the flush
+            if state.is_insert or state.is_update or state.is_delete:
+                table = getattr(state.statement, 'table', None)
+                if isinstance(table, Table):
+                    pending(state.session).add(table.name)
+
+        def after_commit(session):
+            for table in session.info.pop(self.PENDING, ()):
+                self.bump(table)
+
+        def after_rollback(session):
+            session.info.pop(self.PENDING, None)
+
+        event.listen(session, 'after_flush', after_flush)
+        event.listen(session, 'do_orm_execute', do_orm_execute)
+        event.listen(session, 'after_commit', after_commit)
+        event.listen(session, 'after_rollback', after_rollback)
+
+
+#
+# Fragment cache
+#
+
+def fragment_key_part(value):
+    """ Return the part of a fragment key that stands for `value`
+
+    Models are identified by type, id and last edit, so an edit changes
+    the key. Returns None for models that have not been saved.
+    """
+    if hasattr(value, '__table__'):
+        if value.id is None or value.last_edited_date is None:
+            return None
+        return u'{}:{}:{}'.format(
+            type(value).__name__, value.id, value.last_edited_date.isoformat())
+    if isinstance(value, (list, tuple)):
+        parts = [fragment_key_part(item) for item in value]
+        if None in parts:
+            return None
+        return u'[{}]'.format(u','.join(parts))
+    return repr(value)
+
+
+class FragmentCacheExtension(Extension):
+    """ A `{% cache %}` tag that caches the html of its body
+
+        {% cache article, article.authors, show_abstract %}
+            ...
+        {% endcache %}
+
+    The key is built from the template's source, where the tag is, the
+    host and the arguments. Entries are never invalidated, since an edit
+    to the template or to the arguments changes the key; they expire
+    after FRAGMENT_CACHE_TIMEOUT. Nothing is cached while the
+    environment's `fragment_cache` is None.
+    """
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=None)
+        self._checksums = {}
+
+    def preprocess(self, source, name, filename=None):
+        # the parser isn't given the source, so keep its checksum for parse
+        self._checksums[name] = hashlib.sha1(source.encode('utf-8')).hexdigest()[:12]
+        return source
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        # number the tags so that two on one line get different keys
+        index = parser.fragment_cache_tags = getattr(parser, 'fragment_cache_tags', -1) + 1
+        name = nodes.Const(u'{}:{}:{}:{}'.format(
+            parser.name, self._checksums.get(parser.name), lineno, index))
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        call = self.call_method('_cache', [name, nodes.List(args)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _cache(self, name, args, caller):
+        cache = self.environment.fragment_cache
+        if cache is None:
+            return caller()
+        parts = [fragment_key_part(arg) for arg in args]
+        if None in parts:
+            return caller()
+        if has_request_context():
+            parts.insert(0, request.host_url)
+        parts.insert(0, name)
+        key = hashlib.sha1(u'|'.join(parts).encode('utf-8')).hexdigest()
+        html = cache.get(key)
+        if html is None:
+            html = caller()
+            cache.set(key, str(html))
+        return Markup(html)
@@ -2,6 +2,7 @@
 
 import os
 import codecs
+import tempfile
 
 
 class Config(object):
@@ -25,10 +26,80 @@ class Config(object):
     CACHE_TYPE = 'redis'
     CACHE_KEY_PREFIX = 'contrivers-www'
     CACHE_DEFAULT_TIMEOUT = 60 * 15 # invalidate cache every 15 minutes
+    # stale-while-revalidate by endpoint: past `soft` seconds a cached page
+    # is served while it is rendered again, past `hard` it is dropped
+    RESPONSE_CACHE_POLICIES = {
+        'www.index': {'soft': 60 * 5, 'hard': 60 * 60},
+        'www.rss_index': {'soft': 60 * 5, 'hard': 60 * 60 * 6},
+        'www.sitemap': {'soft': 60 * 15, 'hard': 60 * 60 * 24},
+    }
+    # a miss is rendered by one worker while the others wait for it; the
+    # lock expires after TIMEOUT seconds, waiters give up after WAIT
+    RESPONSE_CACHE_LOCK_TIMEOUT = 30
+    RESPONSE_CACHE_LOCK_WAIT = 5
+    # list queries, versioned by their tables so a commit retires them
+    QUERY_CACHE_TIMEOUT = 60 * 60
+    QUERY_CACHE_LOCAL_SIZE = 256 # results kept in each worker
+    # how lists of writing load the relationships they show: selectin,
+    # joined, subquery, lazy or raise, by relationship
+    LIST_LOADERS = {'authors': 'selectin', 'tags': 'selectin'}
+    # the workers of a host share a memory mapped file in front of redis;
+    # it isn't told of changes made on other hosts, so its entries expire
+    # after TIMEOUT seconds. SLOTS are (bytes, count) pairs, 56MB in all
+    SHARED_CACHE_PATH = os.environ.get(
+        'SHARED_CACHE_PATH',
+        '/dev/shm/contrivers-cache' if os.path.isdir('/dev/shm') else None)
+    SHARED_CACHE_SLOTS = ((1024, 8192), (16 * 1024, 1024), (128 * 1024, 256))
+    SHARED_CACHE_WAYS = 8
+    SHARED_CACHE_TIMEOUT = 30
+    # commits are sent to every worker with NOTIFY on this channel, so
+    # the shared memory drops what they changed within a second
+    INVALIDATION_BUS = True
+    INVALIDATION_CHANNEL = 'contrivers_invalidate'
+    # anonymous GETs are answered from each worker for TTL seconds before
+    # flask sees them, 0 disables; the hit ratio is logged every INTERVAL
+    MICRO_CACHE_TTL = 2
+    MICRO_CACHE_MAX_ENTRIES = 512
+    MICRO_CACHE_MAX_BYTES = 16 * 1024 * 1024 # per worker
+    MICRO_CACHE_REPORT_INTERVAL = 60
+
+    # MARKDOWN
+    # 'python-markdown' or 'commonmark' (needs markdown-it-py)
+    MARKDOWN_BACKEND = os.environ.get('MARKDOWN_BACKEND', 'python-markdown')
+    MARKDOWN_CACHE_BYTES = 32 * 1024 * 1024 # per worker
+    MARKDOWN_CACHE_SHARED = False # also store rendered html in redis
+    MARKDOWN_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+    # TEMPLATES
+    # compiled templates are shared by the workers through a directory,
+    # jinja's own under the temp dir unless one is given. Either is made
+    # private to the user, since jinja loads the code it finds there
+    TEMPLATE_CACHE = True
+    TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR')
+    PRELOAD_TEMPLATES = False # compile every template when the app is created
+    STREAM_TEMPLATES = False # stream article pages instead of buffering them
+    STREAM_BUFFER_SIZE = 5 # template chunks per write when streaming
+    FRAGMENT_CACHE_TIMEOUT = 60 * 60 * 24 # {% cache %} blocks, keyed by last edit
+
+    # HTTP VALIDATORS
+    # changes every etag on deploy, so template changes reach returning readers
+    ETAG_SALT = os.environ.get('HEROKU_SLUG_COMMIT', '')
 
     # WTFORMS
     WTF_CSRF_ENABLED = True
 
+    # S3 ASSETS
+    # aopen keeps objects here for the workers, and revalidates them with
+    # a conditional get every INTERVAL seconds. The directory is the user's
+    # own, and refused if another user could write to it
+    ASSET_CACHE_DIR = os.environ.get(
+        'ASSET_CACHE_DIR',
+        os.path.join(tempfile.gettempdir(), 'contrivers-assets-{}'.format(os.getuid())))
+    ASSET_REVALIDATE_INTERVAL = 60 * 5
+    S3_MAX_POOL_CONNECTIONS = 10 # per process, botocore's default
+    S3_MAX_ATTEMPTS = 5 # including the first, with standard backoff
+    S3_MAX_WORKERS = 8 # threads for the *_many helpers
+
     # AWS S3 - heroku only
     AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID', None)
     AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY', None)
@@ -39,6 +110,11 @@ class TestConfig(Config):
     WTF_CSRF_ENABLED = False
     TESTING = True
     CACHE_TYPE = 'null'
+    TEMPLATE_CACHE = False
+    ASSET_CACHE_DIR = None
+    SHARED_CACHE_PATH = None
+    INVALIDATION_BUS = False
+    MICRO_CACHE_TTL = 0
     SECRET_KEY = os.environ.get('SECRET_KEY', codecs.encode(os.urandom(64), 'hex').decode())
     SQLALCHEMY_ECHO = True
     SQLALCHEMY_DATABASE_URI = os.environ.get(
@@ -48,3 +124,6 @@ class TestConfig(Config):
 class ProductionConfig(Config):
     SECRET_KEY = os.environ.get('SECRET_KEY', None)
     CACHE_REDIS_URL = os.environ.get('REDIS_URL', None)
+    MARKDOWN_CACHE_SHARED = CACHE_REDIS_URL is not None
+    STREAM_TEMPLATES = True
+    PRELOAD_TEMPLATES = True
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    contrivers.export
+    -----------------
+
+    Render the public site to a directory of static files.
+
+    The pages are every GET rule of the url map that needs no arguments,
+    every page of the paginated lists, and the pages and feeds of each
+    published writing, author and tag. Each page is fingerprinted with its
+    view's freshness, the newest `last_edited_date` of the rows it shows,
+    and the fingerprints are kept in a manifest in the export directory.
+    A later export only renders the pages whose fingerprint changed.
+
+    Pages are rendered through the test client, in a pool of processes
+    that each create their own app.
+"""
+
+import os
+import json
+import shutil
+import logging
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit
+
+from flask import current_app, url_for
+
+from .models import Writing, Author, Tag
+
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = '.export-manifest.json'
+
+# search needs a query, and static files are copied as they are
+SKIPPED_ENDPOINTS = ('static', 'www.search')
+
+# stop following a paginated list here, whatever it returns
+MAX_PAGES = 1000
+
+
+class Page(namedtuple('Page', 'key path endpoint fingerprint')):
+    """ A page to export
+
+    `path` is None for a paginated list; its pages are found by building
+    `endpoint` with page=2, 3... until one is not found. The fingerprint
+    is None for pages rendered on every export.
+    """
+
+
+def fingerprint(endpoint, **values):
+    """ Return a string that changes when the rows a page shows change,
+    or None if its view has no freshness """
+    view = current_app.view_functions.get(endpoint)
+    get_freshness = getattr(view, 'freshness', None)
+    if get_freshness is None:
+        return None
+    newest, count = get_freshness(**values)
+    return u'{}|{}|{}'.format(
+        newest.isoformat() if newest else '',
+        count,
+        current_app.config.get('ETAG_SALT', ''))
+
+
+def plan_pages():
+    """ Return a Page for everything the export writes
+
+    Call in a request context, the paths are built with `url_for`.
+    """
+    pages = {}
+
+    def add(endpoint, path=None, **values):
+        key = path or 'pages:' + endpoint
+        if key not in pages:
+            pages[key] = Page(key, path, endpoint, fingerprint(endpoint, **values))
+
+    for rule in current_app.url_map.iter_rules():
+        if 'GET' not in rule.methods or rule.endpoint in SKIPPED_ENDPOINTS:
+            continue
+        required = rule.arguments - set(rule.defaults or ())
+        if not required:
+            add(rule.endpoint, rule.rule)
+        elif required == set(['page']):
+            add(rule.endpoint)
+
+    for writing in Writing.query.filter_by(hidden=False):
+        endpoint = 'www.' + writing.route
+        # intros have no pages of their own
+        if endpoint in current_app.view_functions:
+            add(endpoint, urlsplit(writing.url()).path, id_=writing.id)
+
+    for author in Author.query.filter_by(hidden=False):
+        add('www.authors', urlsplit(author.url()).path, id_=author.id)
+        add('www.rss_author', url_for('www.rss_author', id_=author.id), id_=author.id)
+
+    for tag in Tag.query:
+        # Tag.route names the url, not the endpoint
+        add('www.tags', url_for('www.tags', id_=tag.id, slug=tag.slug), id_=tag.id)
+        add('www.rss_tag', url_for('www.rss_tag', id_=tag.id), id_=tag.id)
+
+    return list(pages.values())
+
+
+def file_name(path, response):
+    """ Return the file a page at `path` is written to, relative to the
+    export directory """
+    name = path.lstrip('/')
+    if not name or name.endswith('/'):
+        # the feeds are sent as text/html
+        is_xml = response.mimetype.endswith('xml') or \
+            response.get_data().startswith(b'<?xml')
+        name += 'index.xml' if is_xml else 'index.html'
+    return name
+
+
+def write_page(directory, path, response):
+    """ Write a response body under `directory` and return its file name """
+    name = file_name(path, response)
+    target = os.path.join(directory, name)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(target), delete=False) as f:
+        f.write(response.get_data())
+    # a server reading the directory never sees a partly written page
+    os.replace(f.name, target)
+    return name
+
+
+#
+# Rendering
+#
+# `render_page` runs in the worker processes, with the app and client made
+# by `init_worker`, or in this process when the export is not parallel.
+#
+
+_worker = {}
+
+
+def init_worker(config, directory, base_url):
+    """ Create an app for a worker process """
+    from . import create_app
+    app = create_app(additional_config_vars=config)
+    set_worker(app, directory, base_url)
+
+
+def set_worker(app, directory, base_url):
+    _worker.update(
+        app=app, client=app.test_client(),
+        directory=directory, base_url=base_url)
+
+
+def render_page(page):
+    """ Render a page, or each page of a paginated list
+
+    :returns: the page's key and the names of the files written
+    """
+    app, client = _worker['app'], _worker['client']
+    directory, base_url = _worker['directory'], _worker['base_url']
+    if page.path is not None:
+        paths = [page.path]
+    else:
+        with app.test_request_context(base_url=base_url):
+            paths = [url_for(page.endpoint, page=n) for n in range(2, MAX_PAGES)]
+    files = []
+    for path in paths:
+        try:
+            response = client.get(path, base_url=base_url)
+        except Exception:
+            # a broken view shouldn't stop the export
+            logger.exception('rendering %s failed', path)
+            break
+        try:
+            if response.status_code != 200:
+                if page.path is not None:
+                    logger.info('skipping %s, %d', path, response.status_code)
+                # a paginated list ends at its first missing page
+                break
+            files.append(write_page(directory, path, response))
+        finally:
+            response.close()
+    return page.key, files
+
+
+#
+# Manifest
+#
+
+def read_manifest(directory):
+    """ Return {key: {'fingerprint': ..., 'files': [...]}} from the last
+    export into `directory` """
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def is_current(page, entry, directory):
+    """ Return True if a page from the last export can be kept """
+    if entry is None or page.fingerprint is None:
+        return False
+    if entry.get('fingerprint') != page.fingerprint:
+        return False
+    return all(os.path.exists(os.path.join(directory, name))
+               for name in entry.get('files', ()))
+
+
+ExportResult = namedtuple('ExportResult', 'rendered kept removed')
+
+
+def export_site(app, directory, base_url='http://localhost/', processes=None,
+                config=None, force=False, progress=None):
+    """ Render the public site into `directory`
+
+    :param app: the app to plan the export with
+    :param directory: where pages, static files and the manifest are written
+    :param base_url: the scheme and host external links are built with
+    :param processes: the size of the process pool, 1 renders in this
+        process with `app`, None uses every core
+    :param config: passed to `create_app` in the worker processes
+    :param force: render every page, even if its rows did not change
+    :param progress: called with the key of each page as it is done
+    :returns: an ExportResult of the number of pages rendered and kept,
+        and the number of files removed
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest = read_manifest(directory)
+    with app.test_request_context(base_url=base_url):
+        pages = plan_pages()
+
+    kept = {}
+    todo = []
+    for page in pages:
+        entry = manifest.get(page.key)
+        if not force and is_current(page, entry, directory):
+            kept[page.key] = entry
+        else:
+            todo.append(page)
+    logger.info('rendering %d pages, keeping %d', len(todo), len(kept))
+
+    fingerprints = dict((page.key, page.fingerprint) for page in todo)
+    rendered = {}
+
+    def done(key, files):
+        rendered[key] = {'fingerprint': fingerprints[key], 'files': files}
+        if progress is not None:
+            progress(key)
+
+    processes = processes or os.cpu_count()
+    if processes == 1:
+        set_worker(app, directory, base_url)
+        for page in todo:
+            done(*render_page(page))
+    else:
+        executor = ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=init_worker,
+            initargs=(config or {}, directory, base_url))
+        with executor:
+            chunksize = max(1, len(todo) // (processes * 4))
+            for key, files in executor.map(render_page, todo, chunksize=chunksize):
+                done(key, files)
+
+    # drop the files of pages that are gone, or now not found
+    current = dict(kept, **rendered)
+    written = set(name for entry in current.values() for name in entry['files'])
+    removed = 0
+    for entry in manifest.values():
+        for name in entry.get('files', ()):
+            if name not in written and os.path.exists(os.path.join(directory, name)):
+                os.remove(os.path.join(directory, name))
+                removed += 1
+
+    if app.static_folder and os.path.isdir(app.static_folder):
+        shutil.copytree(
+            app.static_folder,
+            os.path.join(directory, app.static_url_path.lstrip('/')),
+            dirs_exist_ok=True)
+
+    write_manifest(directory, current)
+    return ExportResult(len(rendered), len(kept), removed)
@@ -8,3 +8,10 @@
 
 from flask_sqlalchemy import SQLAlchemy
 db = SQLAlchemy()
+
+from .caching import ResponseCache, QueryCache
+response_cache = ResponseCache()
+query_cache = QueryCache()
+
+from .invalidation import InvalidationBus
+invalidation_bus = InvalidationBus()
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+    contrivers.invalidation
+    -----------------------
+
+    Tell the workers of every dyno what a commit changed.
+
+    After a session commits, the surrogate keys of the rows it changed and
+    the names of the tables it wrote are sent with postgres' NOTIFY, as are
+    the keys of the S3 objects a worker, or `contrive.py`, saves. Each
+    worker listens on a thread of its own and passes them to the handlers
+    subscribed to the bus, which drop what the worker, or its host, keeps
+    of the rows. Caches shared by every host need no message; the worker
+    that committed has purged them already.
+
+    Messages sent while a listener reconnects are lost, and the entries
+    they name expire as they would without the bus.
+"""
+
+import os
+import json
+import select
+import logging
+import threading
+
+from flask import has_app_context
+from sqlalchemy import event, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from .caching import QueryCache, ResponseCache
+
+
+logger = logging.getLogger(__name__)
+
+# postgres refuses payloads of 8000 bytes or more
+MAX_PAYLOAD = 7000
+
+
+def encode(message):
+    return json.dumps(message, separators=(',', ':'))
+
+
+def payloads(keys, tables):
+    """ Return the messages for `keys` and `tables`, split to fit a NOTIFY """
+    messages = []
+    message = {'keys': [], 'tables': []}
+    size = len(encode(message))
+    for field, names in (('keys', sorted(keys)), ('tables', sorted(tables))):
+        for name in names:
+            # the name, its quotes and a comma
+            length = len(encode(name)) + 1
+            if size + length > MAX_PAYLOAD and (message['keys'] or message['tables']):
+                messages.append(encode(message))
+                message = {'keys': [], 'tables': []}
+                size = len(encode(message))
+            message[field].append(name)
+            size += length
+    if message['keys'] or message['tables']:
+        messages.append(encode(message))
+    return messages
+
+
+class InvalidationBus(object):
+    """ Send what each commit changed to every worker, with LISTEN/NOTIFY
+
+    Handlers are called with the changed keys and tables, on the listener
+    thread and outside of any app context. The listener starts with the
+    first request a worker serves, so that a forked worker has its own.
+
+    Without INVALIDATION_BUS, or a postgres database, nothing is sent.
+    """
+
+    PENDING = 'invalidation_bus_publish'
+
+    def __init__(self, app=None):
+        self.channel = 'contrivers_invalidate'
+        self.enabled = False
+        self.reconnect_interval = 5
+        self.handlers = []
+        self._pid = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.channel = app.config.get('INVALIDATION_CHANNEL', self.channel)
+        self.enabled = app.config.get('INVALIDATION_BUS', False)
+        if self.enabled:
+            app.before_request(self.start)
+
+    def subscribe(self, handler):
+        """ Call `handler(keys, tables)` with each message, usable as a
+        decorator """
+        self.handlers.append(handler)
+        return handler
+
+    def dispatch(self, payload):
+        """ Pass a message to every handler """
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            logger.warning('ignoring invalidation message %r', payload)
+            return
+        keys = set(message.get('keys', ()))
+        tables = set(message.get('tables', ()))
+        for handler in self.handlers:
+            try:
+                handler(keys, tables)
+            except Exception:
+                # the others still have their entries to drop
+                logger.exception('invalidation handler %r failed', handler)
+
+    def publish(self, engine, keys, tables):
+        """ Send `keys` and `tables` to every listening worker """
+        if not self.enabled or engine.dialect.name != 'postgresql':
+            return
+        try:
+            with engine.begin() as connection:
+                for payload in payloads(keys, tables):
+                    connection.execute(
+                        text('SELECT pg_notify(:channel, :payload)'),
+                        {'channel': self.channel, 'payload': payload})
+        except SQLAlchemyError as err:
+            # the commit went through, only the other workers are behind
+            logger.warning('invalidation notify failed: %s', err)
+
+    def announce(self, keys=(), tables=()):
+        """ Publish changes made outside of a session, such as to S3
+        objects, with the engine of the current app """
+        if not has_app_context():
+            return
+        from .ext import db
+        self.publish(db.engine, keys, tables)
+
+    def watch(self, session):
+        """ Publish what a session changed after it commits
+
+        The response and query caches record what a commit changes in
+        `session.info`, and pop it when they purge. It is read before they
+        run, and published after, so that no worker refills its copies from
+        entries this one hasn't purged yet. Call this after the caches'
+        `watch`.
+
+        :param session: a session, sessionmaker or scoped session
+        """
+        def snapshot(session):
+            session.info[self.PENDING] = (
+                set(session.info.get(ResponseCache.PENDING, ())),
+                set(session.info.get(QueryCache.PENDING, ())))
+
+        def after_commit(session):
+            keys, tables = session.info.pop(self.PENDING, ((), ()))
+            if keys or tables:
+                self.publish(session.get_bind(), keys, tables)
+
+        def after_rollback(session):
+            session.info.pop(self.PENDING, None)
+
+        event.listen(session, 'after_commit', snapshot, insert=True)
+        event.listen(session, 'after_commit', after_commit)
+        event.listen(session, 'after_rollback', after_rollback)
+
+    #
+    # Listening
+    #
+
+    def start(self, engine=None):
+        """ Start this process's listener, if it hasn't been """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if engine is None:
+                from .ext import db
+                engine = db.engine
+            if engine.dialect.name != 'postgresql':
+                return
+            self._pid = os.getpid()
+            # a listener that was stopped may still be polling
+            self._stopped = threading.Event()
+            thread = threading.Thread(
+                target=self.listen, args=(engine, self._stopped),
+                name='invalidation-listener')
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """ Stop the listener after its next poll """
+        self._stopped.set()
+        self._pid = None
+
+    def listen(self, engine, stopped):
+        """ Dispatch messages until `stopped` is set, reconnecting after
+        errors """
+        while not stopped.is_set():
+            try:
+                # a connection of its own, not one the pool lends out
+                connection = engine.raw_connection()
+                connection.detach()
+                try:
+                    self._listen(connection.dbapi_connection, stopped)
+                finally:
+                    connection.close()
+            except Exception as err:
+                logger.warning('invalidation listener failed: %s', err)
+                stopped.wait(self.reconnect_interval)
+
+    def _listen(self, dbapi_connection, stopped):
+        dbapi_connection.autocommit = True
+        with dbapi_connection.cursor() as cursor:
+            cursor.execute('LISTEN "{}"'.format(self.channel.replace('"', '""')))
+        logger.info('listening for invalidations on %s', self.channel)
+        while not stopped.is_set():
+            # wake up now and then to see if we were stopped
+            if not select.select([dbapi_connection], [], [], 1.0)[0]:
+                continue
+            dbapi_connection.poll()
+            while dbapi_connection.notifies:
+                self.dispatch(dbapi_connection.notifies.pop(0).payload)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+    contrivers.middleware
+    ---------------------
+
+    WSGI middleware wrapped around the flask app in `create_app`.
+"""
+
+import time
+import logging
+import threading
+from collections import Counter, OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+class MicroCache(object):
+    """ Keep whole responses to anonymous GETs for a few seconds
+
+    A link from an aggregator brings hundreds of identical requests a
+    second. For `ttl` seconds after the first is rendered the rest are
+    answered from this process, before flask routes them, opens a session
+    or touches the database.
+
+    Requests with a cookie or an authorization header, conditional
+    requests and anything but GET and HEAD go to the app. Only 200s are
+    kept, and not those that set a cookie, are private or no-store, or
+    vary on anything but the cookie. A streamed body is kept once it has
+    been sent in full.
+
+    The hit ratio and the bytes served from the cache are logged every
+    `report_interval` seconds, and returned by `stats`.
+    """
+
+    BYPASS_HEADERS = ('HTTP_COOKIE', 'HTTP_AUTHORIZATION',
+                      'HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE')
+
+    def __init__(self, app, ttl=2, max_entries=512, max_bytes=16 * 1024 * 1024,
+                 report_interval=60):
+        self.app = app
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.report_interval = report_interval
+        self.metrics = Counter()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._reported = time.monotonic()
+
+    def __call__(self, environ, start_response):
+        if not self.is_cacheable(environ):
+            self.count('bypass')
+            return self.app(environ, start_response)
+        key = self.make_key(environ)
+        entry = self.get(key)
+        if entry is not None:
+            status, headers, body = entry
+            self.count('hit', len(body))
+            start_response(status, list(headers))
+            return [body] if environ['REQUEST_METHOD'] == 'GET' else []
+        self.count('miss')
+        if environ['REQUEST_METHOD'] != 'GET':
+            return self.app(environ, start_response)
+        return self.fill(key, environ, start_response)
+
+    def is_cacheable(self, environ):
+        return self.ttl > 0 and \
+            environ.get('REQUEST_METHOD') in ('GET', 'HEAD') and \
+            not any(environ.get(header) for header in self.BYPASS_HEADERS)
+
+    @staticmethod
+    def make_key(environ):
+        return (environ.get('wsgi.url_scheme'), environ.get('HTTP_HOST'),
+                environ.get('SCRIPT_NAME', ''), environ.get('PATH_INFO', ''),
+                environ.get('QUERY_STRING', ''))
+
+    @staticmethod
+    def is_storable(status, headers):
+        if not status.startswith('200'):
+            return False
+        for name, value in headers:
+            name = name.lower()
+            if name == 'set-cookie':
+                return False
+            if name == 'cache-control' and \
+                    ('private' in value or 'no-store' in value):
+                return False
+            if name == 'vary' and any(
+                    field.strip().lower() != 'cookie' for field in value.split(',')):
+                return False
+        return True
+
+    def fill(self, key, environ, start_response):
+        """ Call the app, and keep its response if it can be """
+        response = {}
+
+        def capture(status, headers, exc_info=None):
+            response.update(status=status, headers=headers)
+            return start_response(status, headers, exc_info)
+
+        iterable = self.app(environ, capture)
+        if not self.is_storable(response.get('status', ''), response.get('headers', ())):
+            return iterable
+        return Tee(iterable, lambda body: self.set(
+            key, (response['status'], response['headers'], body)))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, response = entry
+            if expires <= time.monotonic():
+                self._drop(key)
+                return None
+            return response
+
+    def set(self, key, response):
+        size = len(response[2])
+        if size > self.max_bytes // 16:
+            # a few large bodies shouldn't push out everything else
+            return
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, response)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[1][2])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def count(self, outcome, size=0):
+        with self._lock:
+            self.metrics[outcome] += 1
+            if size:
+                self.metrics['bytes_served'] += size
+            now = time.monotonic()
+            report = self.report_interval and \
+                now - self._reported >= self.report_interval
+            if report:
+                self._reported = now
+        if report:
+            stats = self.stats()
+            logger.info(
+                'micro cache: %.0f%% hits, %d bytes served, %d entries',
+                stats['hit_ratio'] * 100, stats['bytes_served'], stats['entries'])
+
+    def stats(self):
+        """ Return the hits, misses and bypasses, the hit ratio of the
+        requests that could be cached, and the bytes served from it """
+        with self._lock:
+            stats = dict(
+                (outcome, self.metrics[outcome])
+                for outcome in ('hit', 'miss', 'bypass', 'bytes_served'))
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        looked_up = stats['hit'] + stats['miss']
+        stats['hit_ratio'] = float(stats['hit']) / looked_up if looked_up else 0.0
+        return stats
+
+
+class Tee(object):
+    """ Pass a response body through, and hand it to `done` if it was sent
+    in full """
+
+    def __init__(self, iterable, done):
+        self.iterable = iterable
+        self.done = done
+        self.chunks = []
+        self.finished = False
+
+    def __iter__(self):
+        for chunk in self.iterable:
+            self.chunks.append(chunk)
+            yield chunk
+        self.finished = True
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            if self.finished:
+                self.done(b''.join(self.chunks))
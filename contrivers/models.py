@@ -6,7 +6,7 @@
     SQLAlchemy ORM Declarative models
 """
 
-from flask import url_for
+from flask import url_for, current_app
 from sqlalchemy import (
     Integer,
     String,
@@ -19,13 +19,24 @@ from sqlalchemy import (
     CheckConstraint,
     types,
 )
-from sqlalchemy.orm import relationship, backref, validates
+from sqlalchemy import event
+from sqlalchemy.orm import (
+    relationship,
+    backref,
+    validates,
+    selectinload,
+    joinedload,
+    subqueryload,
+    lazyload,
+    raiseload,
+)
 from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.sql import func
 from sqlalchemy.ext.hybrid import hybrid_property
 
-from .utils import with_utc
-from .ext import db
+from .utils import asset_handlers, forget_assets, with_utc
+from .rendering import render
+from .ext import db, response_cache, query_cache, invalidation_bus
 from .validators import validate_isbn
 
 
@@ -61,7 +72,7 @@ class BaseMixin(object):
     last_edited_date = Column(
         'last_edited_date',
         UTCDateTime,
-        server_onupdate=func.now(),
+        onupdate=func.now(),
         server_default=func.now(),
     )
 
@@ -131,10 +142,9 @@ class Tag(BaseMixin, db.Model):
 
     @property
     def count(self):
-        cnt = func.count('*').label('cnt')
-        return db.session.query(func.count('*')).\
-                filter(self.id==tag_to_writing.c.tag_id).\
-                scalar()
+        return query_cache.scalar(
+            db.session.query(func.count('*')).
+            filter(self.id==tag_to_writing.c.tag_id))
 
     @classmethod
     def ordered_query(self, page=1):
@@ -144,10 +154,11 @@ class Tag(BaseMixin, db.Model):
                 filter(self.id==tag_to_writing.c.tag_id).\
                 group_by(self.id).\
                 subquery()
-        return self.query.\
-                outerjoin(subq, self.id == subq.c.id).\
-                order_by(subq.c.cnt.desc(), self.tag).\
-                paginate(page)
+        return query_cache.paginate(
+            self.query.
+            outerjoin(subq, self.id == subq.c.id).
+            order_by(subq.c.cnt.desc(), self.tag),
+            page)
 
 
 class Author(BaseMixin, db.Model):
@@ -159,6 +170,7 @@ class Author(BaseMixin, db.Model):
     email = Column('email', String, unique=True, nullable=False)
     twitter = Column('twitter', String, unique=True)
     bio = Column('bio', String)
+    bio_html = Column('bio_html', String)
     hidden = Column('hidden', Boolean, default=False)
 
     def __repr__(self):
@@ -177,10 +189,9 @@ class Author(BaseMixin, db.Model):
 
     @property
     def count(self):
-        cnt = func.count('*').label('cnt')
-        return db.session.query(func.count('*')).\
-                filter(self.id==author_to_writing.c.author_id).\
-                scalar()
+        return query_cache.scalar(
+            db.session.query(func.count('*')).
+            filter(self.id==author_to_writing.c.author_id))
 
     @classmethod
     def ordered_query(self, page=1):
@@ -190,10 +201,11 @@ class Author(BaseMixin, db.Model):
                 filter(self.id==author_to_writing.c.author_id).\
                 group_by(self.id).\
                 subquery()
-        return self.query.\
-                outerjoin(subq, self.id == subq.c.id).\
-                order_by(subq.c.cnt.desc(), self.name).\
-                paginate(page)
+        return query_cache.paginate(
+            self.query.
+            outerjoin(subq, self.id == subq.c.id).
+            order_by(subq.c.cnt.desc(), self.name),
+            page)
 
 
 class Writing(BaseMixin, db.Model):
@@ -205,12 +217,15 @@ class Writing(BaseMixin, db.Model):
     __tablename__ = 'writing'
     route = 'archive'
 
-    # type is the polymorphic discriminator
+    # type is the polymorphic discriminator. Rows are loaded as their
+    # subclass by type alone; the subclass tables add no columns, so a
+    # query of Writing selects from the writing table and the others are
+    # only joined by a query of a subclass, or one that asks for them with
+    # `sqlalchemy.orm.with_polymorphic`
     type = Column(String, nullable=False)
     __mapper_args__ = {
         'polymorphic_identity': 'writing',
         'polymorphic_on': type,
-        'with_polymorphic': '*'
     }
 
     # track basic attributes of all writing:
@@ -221,6 +236,11 @@ class Writing(BaseMixin, db.Model):
     text = Column('text', String)
     abstract = Column('summary', String)
 
+    # html rendered from text and abstract, kept current by the
+    # listeners at the bottom of this module
+    text_html = Column('text_html', String)
+    abstract_html = Column('summary_html', String)
+
     # PostgreSQL Full Text Search field
     # http://www.postgresql.org/docs/current/static/datatype-textsearch.html
     tsvector = Column(TSVECTOR)
@@ -253,6 +273,12 @@ class Writing(BaseMixin, db.Model):
         backref='respondees'
     )
 
+    @classmethod
+    def listed(cls):
+        """ Return a query of rows shown in a list, with the relationships
+        the list shows loaded with them """
+        return cls.query.options(*list_options(cls))
+
 #
 # Writing inherited models
 #
@@ -333,3 +359,62 @@ class Book(BaseMixin, db.Model):
         if isbn is None:
             return True
         return validate_isbn(isbn, 13)
+
+
+#
+# Lists
+#
+# Pages and feeds that list writing show the authors and tags of each
+# row. Loading them with the rows, in one query per relationship for the
+# whole list, keeps the number of queries the same however long it is.
+#
+
+LOADERS = {
+    'selectin': selectinload,
+    'joined': joinedload,
+    'subquery': subqueryload,
+    'lazy': lazyload,
+    'raise': raiseload,
+}
+
+
+def list_options(model):
+    """ Return the loader options LIST_LOADERS gives the relationships of
+    `model` in lists """
+    loaders = current_app.config.get('LIST_LOADERS', {})
+    return [LOADERS[strategy](getattr(model, name))
+            for name, strategy in sorted(loaders.items())]
+
+
+#
+# Rendered HTML
+#
+# Markdown columns are rendered to html when they are set, so views and
+# feeds never have to parse markdown on the request path.
+#
+
+def render_on_set(html_attr):
+    """ Return an attribute listener that stores rendered html in `html_attr` """
+    def listener(target, value, oldvalue, initiator):
+        setattr(target, html_attr, render(value) if value else None)
+    return listener
+
+event.listen(Writing.text, 'set', render_on_set('text_html'), propagate=True)
+event.listen(Writing.abstract, 'set', render_on_set('abstract_html'), propagate=True)
+event.listen(Author.bio, 'set', render_on_set('bio_html'))
+
+
+# cached pages are rendered from these models
+response_cache.watch(
+    db.session, (Writing, Author, Tag, Book),
+    listed_by=('hidden', 'featured', 'publish_date'))
+query_cache.watch(db.session)
+
+# and other hosts drop the copies they keep
+invalidation_bus.watch(db.session)
+invalidation_bus.subscribe(response_cache.forget)
+invalidation_bus.subscribe(query_cache.forget)
+
+# as do the workers that keep saved S3 objects
+asset_handlers.append(invalidation_bus.announce)
+invalidation_bus.subscribe(forget_assets)
@@ -0,0 +1,653 @@
+# -*- coding: utf-8 -*-
+"""
+    contrivers.rendering
+    --------------------
+
+    Markdown to HTML rendering with pluggable backends and a
+    content-addressed cache.
+
+    Rendered HTML is keyed by a hash of the source text, the extension list
+    and the backend version, so an entry never needs to be invalidated: a
+    change to any of them produces a new key. Each worker keeps a
+    byte-budgeted LRU; an optional shared backend (redis) lets workers reuse
+    each other's work.
+"""
+
+import re
+import sys
+import hashlib
+import logging
+import threading
+from collections import Counter, OrderedDict
+
+import markdown
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EXTENSIONS = (
+    'footnotes',
+    # 'headerid',
+    'smarty',
+    'tables',
+)
+
+
+def markdown_factory(extensions=None):
+    """ return an initialized `markdown.Markdown` object
+
+    Converters are expensive to build because every extension registers its
+    processors. Prefer `PythonMarkdownBackend`, which pools converters per
+    thread and calls `Markdown.reset()` between documents.
+    :params extensions: a list of extension names as strings to be loaded
+        into the markdown converter. Defaults to footnotes, smarty and tables
+    :returns: a Markdown object
+    """
+    if extensions is None:
+        extensions = list(DEFAULT_EXTENSIONS)
+    return markdown.Markdown(extensions=extensions)
+
+
+def make_key(text, extensions, engine=None):
+    """ Return a content hash for `text` rendered with `extensions`
+
+    :param engine: a string naming the backend and its version, defaults to
+        the Python-Markdown version.
+    """
+    if engine is None:
+        engine = PythonMarkdownBackend.engine()
+    digest = hashlib.sha1()
+    digest.update(engine.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update('|'.join(extensions).encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(text.encode('utf-8'))
+    return digest.hexdigest()
+
+
+#
+# Backends
+#
+
+class MarkdownBackend(object):
+    """ Interface for a markdown engine
+
+    A backend converts markdown to html with a fixed list of extensions and
+    must be safe to call from several threads.
+    """
+    name = None
+    incremental = False
+
+    def __init__(self, extensions=None):
+        if extensions is None:
+            extensions = DEFAULT_EXTENSIONS
+        self.extensions = tuple(extensions)
+
+    @classmethod
+    def engine(cls):
+        """ Return a string that changes whenever the html output might """
+        raise NotImplementedError
+
+    def convert(self, text):
+        raise NotImplementedError
+
+
+class PythonMarkdownBackend(MarkdownBackend):
+    """ Python-Markdown with a per-thread pool of reusable converters """
+    name = 'python-markdown'
+    incremental = True
+
+    def __init__(self, extensions=None):
+        super(PythonMarkdownBackend, self).__init__(extensions)
+        self._local = threading.local()
+
+    @classmethod
+    def engine(cls):
+        return '{}-{}'.format(cls.name, markdown.__version__)
+
+    def _pool(self):
+        pool = getattr(self._local, 'pool', None)
+        if pool is None:
+            pool = self._local.pool = []
+        return pool
+
+    def convert(self, text):
+        pool = self._pool()
+        converter = pool.pop() if pool else markdown_factory(list(self.extensions))
+        try:
+            return converter.convert(text)
+        finally:
+            converter.reset()
+            pool.append(converter)
+
+
+class CommonMarkBackend(MarkdownBackend):
+    """ markdown-it-py, a fast CommonMark engine
+
+    The footnote and table markup is rewritten to match Python-Markdown so
+    that stylesheets and littlefoot keep working when the backends are
+    swapped. Requires the optional markdown-it-py and mdit-py-plugins
+    packages.
+    """
+    name = 'commonmark'
+    supported = ('footnotes', 'smarty', 'tables')
+
+    def __init__(self, extensions=None):
+        super(CommonMarkBackend, self).__init__(extensions)
+        unsupported = set(self.extensions) - set(self.supported)
+        if unsupported:
+            raise ValueError('{} does not support {}'.format(
+                self.name, ', '.join(sorted(unsupported))))
+
+        from markdown_it import MarkdownIt
+        parser = MarkdownIt('commonmark', {'typographer': 'smarty' in self.extensions})
+        if 'smarty' in self.extensions:
+            parser.enable(['replacements', 'smartquotes'])
+        if 'tables' in self.extensions:
+            parser.enable('table')
+        if 'footnotes' in self.extensions:
+            from mdit_py_plugins.footnote import footnote_plugin
+            parser.use(footnote_plugin)
+            for rule in ('footnote_ref', 'footnote_block_open',
+                         'footnote_block_close', 'footnote_open',
+                         'footnote_anchor'):
+                parser.add_render_rule(rule, getattr(self, '_render_' + rule))
+        self.parser = parser
+
+    @classmethod
+    def engine(cls):
+        import markdown_it
+        return '{}-{}'.format(cls.name, markdown_it.__version__)
+
+    def convert(self, text):
+        env = {}
+        tokens = self.parser.parse(text, env)
+        for token in tokens:
+            if token.type in ('th_open', 'td_open'):
+                style = token.attrGet('style')
+                if style:
+                    token.attrSet('style', style.replace(':', ': ') + ';')
+        return self.parser.renderer.render(tokens, self.parser.options, env).rstrip('\n')
+
+    #
+    # Python-Markdown compatible footnote markup. markdown-it binds render
+    # rules to its renderer, so these are plain functions.
+    #
+
+    @staticmethod
+    def _label(token):
+        label = token.meta.get('label')
+        return label if label is not None else str(token.meta['id'] + 1)
+
+    @staticmethod
+    def _refid(token):
+        sub_id = token.meta.get('subId', 0)
+        prefix = 'fnref{}'.format(sub_id + 1) if sub_id > 0 else 'fnref'
+        return '{}:{}'.format(prefix, CommonMarkBackend._label(token))
+
+    @staticmethod
+    def _render_footnote_ref(renderer, tokens, idx, options, env):
+        token = tokens[idx]
+        return '<sup id="{}"><a class="footnote-ref" href="#fn:{}">{}</a></sup>'.format(
+            CommonMarkBackend._refid(token),
+            CommonMarkBackend._label(token),
+            token.meta['id'] + 1)
+
+    @staticmethod
+    def _render_footnote_block_open(renderer, tokens, idx, options, env):
+        return '<div class="footnote">\n<hr />\n<ol>\n'
+
+    @staticmethod
+    def _render_footnote_block_close(renderer, tokens, idx, options, env):
+        return '</ol>\n</div>\n'
+
+    @staticmethod
+    def _render_footnote_open(renderer, tokens, idx, options, env):
+        return '<li id="fn:{}">\n'.format(CommonMarkBackend._label(tokens[idx]))
+
+    @staticmethod
+    def _render_footnote_anchor(renderer, tokens, idx, options, env):
+        token = tokens[idx]
+        return '{}<a class="footnote-backref" href="#{}" title="Jump back to footnote {} in the text">&#8617;</a>'.format(
+            '&#160;' if token.meta['subId'] == 0 else '',
+            CommonMarkBackend._refid(token),
+            token.meta['id'] + 1)
+
+
+backends = {
+    PythonMarkdownBackend.name: PythonMarkdownBackend,
+    CommonMarkBackend.name: CommonMarkBackend,
+}
+
+_backend_name = PythonMarkdownBackend.name
+_backend_instances = {}
+_backend_lock = threading.Lock()
+
+
+def set_backend(name):
+    """ Select the markdown backend used by `render` """
+    global _backend_name
+    if name not in backends:
+        raise ValueError('Unknown markdown backend {}'.format(name))
+    _backend_name = name
+
+
+def get_backend(extensions=None, name=None):
+    """ Return a shared backend instance for `extensions` """
+    if name is None:
+        name = _backend_name
+    if extensions is None:
+        extensions = DEFAULT_EXTENSIONS
+    key = (name, tuple(extensions))
+    backend = _backend_instances.get(key)
+    if backend is None:
+        with _backend_lock:
+            backend = _backend_instances.get(key)
+            if backend is None:
+                backend = _backend_instances[key] = backends[name](extensions)
+    return backend
+
+
+#
+# Cache
+#
+
+class RenderCache(object):
+    """ A byte-budgeted LRU of rendered HTML with an optional shared tier
+
+    :param max_bytes: the approximate memory budget for the local tier.
+    :param backend: an optional `contrivers.caching.BaseCache` consulted on a
+        local miss and filled after a render.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, backend=None):
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def init_app(self, app):
+        """ Configure the cache from the app config
+
+        MARKDOWN_CACHE_BYTES sets the local budget, 0 disables the local
+        tier. MARKDOWN_CACHE_SHARED enables the redis tier at
+        CACHE_REDIS_URL.
+        """
+        self.max_bytes = app.config.get('MARKDOWN_CACHE_BYTES', self.max_bytes)
+        if app.config.get('MARKDOWN_CACHE_SHARED'):
+            from .caching import RedisCache
+            self.backend = RedisCache(
+                app.config.get('CACHE_REDIS_URL'),
+                prefix='{}:md:'.format(app.config.get('CACHE_KEY_PREFIX', '')),
+                default_timeout=app.config.get('MARKDOWN_CACHE_TIMEOUT'))
+        else:
+            self.backend = None
+        self.clear()
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return html
+        if self.backend is not None:
+            html = self.backend.get(key)
+            if html is not None:
+                with self._lock:
+                    self.shared_hits += 1
+                self._store(key, html)
+                return html
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, html):
+        self._store(key, html)
+        if self.backend is not None:
+            self.backend.set(key, html)
+
+    def _store(self, key, html):
+        size = sys.getsizeof(html)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = html
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= sys.getsizeof(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        """ Empty the local tier and reset the counters """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = self.shared_hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """ Return a dictionary of counters for sizing the cache """
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                shared_hits=self.shared_hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                entries=len(self._entries),
+                bytes=self._bytes,
+                max_bytes=self.max_bytes,
+            )
+
+
+render_cache = RenderCache()
+
+
+#
+# Incremental rendering
+#
+# Long documents are split into top-level blocks that are rendered and
+# cached one at a time, so an edit to one paragraph only re-renders that
+# paragraph. Link and footnote definitions are document-wide: each block is
+# rendered together with the definitions it needs, and the footnote list
+# is rendered once from all of them. Blank lines within a merged block are
+# kept as they were. Documents with what can't be split safely, such as
+# html starting partway through a block, a footnote defined twice or code
+# followed by a list, are converted whole. Only Python-Markdown is split
+# this way; tests compare random documents with converting them whole.
+#
+
+INCREMENTAL_MIN_LENGTH = 8 * 1024
+
+LIST_ITEM = re.compile(r'^[ ]{0,3}(?:[*+-]|\d+\.)[ ]+')
+LINK_DEF = re.compile(r'^[ ]{0,3}\[([^\[\]^][^\[\]]*)\]:[ ]*\S+.*$')
+FOOTNOTE_DEF = re.compile(r'^[ ]{0,3}\[\^([^\]]*)\]:', re.MULTILINE)
+HTML_OPEN = re.compile(r'^<([a-zA-Z][a-zA-Z0-9]*)')
+QUOTE = re.compile(r'^[ ]{0,3}>')
+HTML_COMMENT = u'<!--'
+WHITESPACE = re.compile(r'\s+')
+# a paragraph rendered after every block to capture the whitespace that
+# follows the block in the full document
+BLOCK_BOUNDARY = u'contriversblockboundary'
+FOOTNOTE_REF_ID = re.compile(r'<sup id="fnref\d*:([^"]*)">')
+FOOTNOTE_DIV = '<div class="footnote">'
+BLOCK_LEVEL_ELEMENTS = frozenset(markdown.Markdown().block_level_elements)
+
+
+class Block(object):
+    """ A top-level chunk of markdown source
+
+    :param gap: the number of blank lines before it, kept when it is
+        merged into the chunk before it, where raw html or code would show
+        the difference
+    """
+
+    def __init__(self, lines, gap=1):
+        self.lines = lines
+        self.gap = gap
+
+    @property
+    def source(self):
+        return u'\n'.join(self.lines)
+
+    @property
+    def first(self):
+        return self.lines[0]
+
+    def extend(self, other):
+        self.lines = self.lines + [u''] * other.gap + other.lines
+
+
+def normalize(text):
+    """ Apply Python-Markdown's whitespace normalization """
+    text = text.replace(u'\r\n', u'\n').replace(u'\r', u'\n').expandtabs(4)
+    return re.sub(r'(?<=\n) +\n', u'\n', u'\n' + text + u'\n')
+
+
+def split_blocks(text):
+    """ Split markdown into chunks separated by blank lines
+
+    Indented chunks are continuations of the chunk before them (code,
+    list items, footnotes) and raw html runs until its tag or comment is
+    closed, so both are merged into the previous chunk.
+    """
+    chunks, current, gap = [], [], 0
+    for line in normalize(text).split(u'\n'):
+        if line.strip():
+            current.append(line)
+        elif current:
+            chunks.append(Block(current, gap))
+            current, gap = [], 1
+        else:
+            gap += 1
+    if current:
+        chunks.append(Block(current, gap))
+
+    blocks = []
+    for chunk in chunks:
+        if blocks and (chunk.first.startswith(u'    ') or open_html_tag(blocks[-1])):
+            blocks[-1].extend(chunk)
+        else:
+            blocks.append(chunk)
+    return blocks
+
+
+def open_html_tag(block):
+    """ Return the raw html tag `block` opens and leaves open, or None """
+    if block.first.startswith(HTML_COMMENT):
+        return HTML_COMMENT if u'-->' not in block.source else None
+    match = HTML_OPEN.match(block.first)
+    if match is None or match.group(1).lower() not in BLOCK_LEVEL_ELEMENTS:
+        return None
+    tag = match.group(1)
+    source = block.source
+    opened = len(re.findall(r'<{}[\s>]'.format(tag), source + ' ', re.IGNORECASE))
+    closed = len(re.findall(r'</{}\s*>'.format(tag), source, re.IGNORECASE))
+    return tag if opened > closed else None
+
+
+def squash(text):
+    """ Return `text` lowercased, with each run of whitespace one space """
+    return WHITESPACE.sub(u' ', text.lower())
+
+
+def is_block_html(line):
+    """ Return True if `line` opens a block-level html tag """
+    match = HTML_OPEN.match(line)
+    return match is not None and match.group(1).lower() in BLOCK_LEVEL_ELEMENTS
+
+
+def trails_html(block):
+    """ Return True if `block` opens raw html and goes on after it closes """
+    last = block.lines[-1]
+    if block.first.startswith(HTML_COMMENT):
+        return u'-->' not in last
+    match = HTML_OPEN.match(block.first)
+    if match is None or match.group(1).lower() not in BLOCK_LEVEL_ELEMENTS:
+        return False
+    return not re.search(r'</{}\s*>\s*$'.format(match.group(1)), last, re.IGNORECASE)
+
+
+def starts_within(block):
+    """ Return True if a list or blockquote in `block` follows a line of
+    code, which Python-Markdown renders as a block of its own """
+    return any(
+        (LIST_ITEM.match(line) or QUOTE.match(line)) and before.startswith(u'    ')
+        for before, line in zip(block.lines, block.lines[1:]))
+
+
+def continues(previous, block):
+    """ Return True if `block` continues the list or blockquote before it """
+    if LIST_ITEM.match(previous.first) and LIST_ITEM.match(block.first):
+        return True
+    # a quote may start partway through a paragraph
+    if block.first.lstrip().startswith(u'>') and \
+            any(QUOTE.match(line) for line in previous.lines):
+        return True
+    return False
+
+
+class Document(object):
+    """ A document split into content blocks and definitions """
+
+    def __init__(self, blocks, link_defs, footnotes):
+        self.blocks = blocks
+        self.link_defs = link_defs      # [(label, source line)]
+        self.footnotes = footnotes      # [definition block source]
+        self.labels = list(OrderedDict.fromkeys(
+            label for note in footnotes for label in FOOTNOTE_DEF.findall(note)))
+
+    def augment(self, block):
+        """ Return the source to render for `block`
+
+        The block is followed by the boundary paragraph and the definitions
+        it refers to.
+        :returns: the source and whether footnote placeholders were added
+        """
+        parts = [block.source, BLOCK_BOUNDARY]
+        # labels are matched as Python-Markdown does, ignoring case and
+        # runs of whitespace, which may wrap a label across lines
+        lowered = squash(block.source)
+        defs = [line for label, line in self.link_defs
+                if u'[{}]'.format(squash(label)) in lowered]
+        if defs:
+            parts.append(u'\n'.join(defs))
+        placeholders = bool(self.labels) and u'[^' in block.source
+        if placeholders:
+            # a reference renders as its position in the footnote list,
+            # never as the footnote's text
+            parts.append(u'\n'.join(u'[^{}]: _'.format(label) for label in self.labels))
+        return u'\n\n'.join(parts), placeholders
+
+
+def parse_document(text):
+    """ Return a `Document`, or None when `text` cannot be split safely
+
+    Python-Markdown removes definitions before it builds lists and
+    blockquotes, so those merge across definitions too.
+    """
+    blocks, link_defs, footnotes = [], [], []
+    for block in split_blocks(text):
+        if HTML_COMMENT in block.source[1:] or (
+                not HTML_OPEN.match(block.first) and
+                any(is_block_html(line) for line in block.lines[1:])):
+            # raw html that starts a line splits the block it is in, and a
+            # comment within a block may be html or text depending on what
+            # comes before it
+            return None
+        if trails_html(block) or starts_within(block):
+            # what follows html or code in the same block may continue the
+            # block after it
+            return None
+        if FOOTNOTE_DEF.match(block.first):
+            if u'\n\n\n' in block.source or any(
+                    LINK_DEF.match(line) or line.startswith(u'>')
+                    for line in block.lines[1:]) or \
+                    block.source.count(u'[^') > len(FOOTNOTE_DEF.findall(block.source)):
+                # after two blank lines indented text isn't part of the
+                # footnote, quotes and definitions never are, and references
+                # within footnotes are numbered by the full render
+                return None
+            footnotes.append(block.source)
+        elif all(LINK_DEF.match(line) for line in block.lines):
+            link_defs.extend(
+                (LINK_DEF.match(line).group(1), line) for line in block.lines)
+        elif FOOTNOTE_DEF.search(block.source) or \
+                any(LINK_DEF.match(line) for line in block.lines):
+            # definitions mixed into content
+            return None
+        elif blocks and continues(blocks[-1], block):
+            blocks[-1].extend(block)
+        else:
+            blocks.append(block)
+    document = Document(blocks, link_defs, footnotes)
+    if len(document.labels) != sum(
+            len(FOOTNOTE_DEF.findall(note)) for note in footnotes):
+        # a footnote defined twice
+        return None
+    return document
+
+
+def _convert_block(backend, document, block):
+    """ Return the html of `block` and the whitespace that follows it
+
+    Returns None if the block swallowed the boundary paragraph.
+    """
+    source, placeholders = document.augment(block)
+    key = make_key(source, backend.extensions, backend.engine() + ':block')
+    html = render_cache.get(key)
+    if html is None:
+        html = backend.convert(source)
+        if placeholders:
+            html = html.rsplit(u'\n' + FOOTNOTE_DIV, 1)[0]
+        html, boundary, tail = html.rpartition(u'<p>{}</p>'.format(BLOCK_BOUNDARY))
+        if not boundary or tail.strip():
+            return None
+        render_cache.set(key, html)
+    return html
+
+
+def render_blocks(text, backend):
+    """ Render `text` block by block, reusing cached blocks """
+    document = parse_document(text)
+    if document is None:
+        return backend.convert(text)
+
+    parts = []
+    for block in document.blocks:
+        html = _convert_block(backend, document, block)
+        if html is None:
+            return backend.convert(text)
+        parts.append(html)
+
+    counts = Counter(FOOTNOTE_REF_ID.findall(u''.join(parts)))
+    if any(count > 1 for count in counts.values()):
+        # Python-Markdown numbers repeated references in tree order, not
+        # document order, so leave those documents to a full render
+        return backend.convert(text)
+
+    if document.footnotes:
+        # one reference per footnote so that every one gets its backlink
+        refs = u''.join(
+            u'[^{}]'.format(label) for label in document.labels)
+        source = u'\n\n'.join(
+            [refs] + document.footnotes + [line for _, line in document.link_defs])
+        key = make_key(source, backend.extensions, backend.engine() + ':block')
+        notes = render_cache.get(key)
+        if notes is None:
+            notes = backend.convert(source)
+            notes = notes[notes.find(FOOTNOTE_DIV):]
+            render_cache.set(key, notes)
+        parts.append(notes)
+
+    return u''.join(parts).strip()
+
+
+def render(text, extensions=None):
+    """ Return `text` converted to HTML, using the render cache
+
+    :param text: a Markdown string, None renders as an empty string.
+    :param extensions: a list of Markdown extension names, defaults to
+        `DEFAULT_EXTENSIONS`.
+
+    The html comes from the backend selected with `set_backend`, usually
+    from the MARKDOWN_BACKEND config value.
+    """
+    if not text:
+        return u''
+    backend = get_backend(extensions)
+    key = make_key(text, backend.extensions, backend.engine())
+    html = render_cache.get(key)
+    if html is None:
+        if len(text) >= INCREMENTAL_MIN_LENGTH and backend.incremental:
+            html = render_blocks(text, backend)
+        else:
+            html = backend.convert(text)
+        render_cache.set(key, html)
+    return html
@@ -4,39 +4,97 @@
     contrivers.utils
     ---------
 """
+import os
+import json
+import time
+import inspect
+import hashlib
 import logging
 import codecs
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
 from urllib.parse import urlencode
 import boto3
 import botocore
+import botocore.config
+from concurrent.futures import ThreadPoolExecutor
 from functools import update_wrapper
 import datetime
 from pytz import timezone
 from ._compat import iteritems
 
 
-def cache(fn):
-    """ Simple in-memory memoizer for caching network calls """
-    _cache = {}
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
 
-    def build_key(name, args, kwargs):
-        key = name + '::'
-        key += '|'.join([str(arg) for arg in args])
-        key += '+'.join(
-            ['{}={}'.format(key, val) for key, val in iteritems(kwargs)]
-        )
+
+def cache(fn=None, maxsize=128, ttl=None):
+    """ Thread-safe in-memory memoizer for caching network calls
+
+    Use as `@cache` or `@cache(maxsize=32, ttl=3600)`. The least recently
+    used result is evicted past `maxsize` entries (None for no limit), and
+    results older than `ttl` seconds are fetched again.
+
+    The wrapper has `cache_info()`, `cache_clear()`, and `invalidate()`,
+    which takes the same arguments as the wrapped function and drops that
+    one result. Calls with unhashable arguments are not cached.
+    """
+    if fn is None:
+        return lambda fn: cache(fn, maxsize=maxsize, ttl=ttl)
+
+    signature = inspect.signature(fn)
+    entries = OrderedDict()
+    counts = {'hits': 0, 'misses': 0}
+    lock = threading.Lock()
+
+    def make_key(args, kwargs):
+        # bind so that f(1), f(x=1) and a defaulted f() share a key
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = bound.args + tuple(sorted(iteritems(bound.kwargs)))
+        hash(key)
         return key
 
     def wrapper(*args, **kwargs):
-        logging.debug('cache %s', _cache)
-        key = build_key(fn.__name__, args, kwargs)
-        if key in _cache:
-            return _cache[key]
-        else:
-            res = fn(*args, **kwargs)
-            _cache[key] = res
-            return res
+        try:
+            key = make_key(args, kwargs)
+        except TypeError:
+            return fn(*args, **kwargs)
+        now = time.monotonic()
+        with lock:
+            entry = entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > now):
+                entries.move_to_end(key)
+                counts['hits'] += 1
+                return entry[1]
+            counts['misses'] += 1
+        # call outside the lock, a slow fetch shouldn't block other keys
+        value = fn(*args, **kwargs)
+        with lock:
+            entries[key] = (now + ttl if ttl else None, value)
+            entries.move_to_end(key)
+            while maxsize is not None and len(entries) > maxsize:
+                entries.popitem(last=False)
+        return value
+
+    def cache_info():
+        with lock:
+            return CacheInfo(counts['hits'], counts['misses'], maxsize, len(entries))
+
+    def cache_clear():
+        with lock:
+            entries.clear()
+            counts['hits'] = counts['misses'] = 0
 
+    def invalidate(*args, **kwargs):
+        """ Drop the result for these arguments; True if there was one """
+        key = make_key(args, kwargs)
+        with lock:
+            return entries.pop(key, None) is not None
+
+    wrapper.cache_info = cache_info
+    wrapper.cache_clear = cache_clear
+    wrapper.invalidate = invalidate
     update_wrapper(wrapper, fn)
     return wrapper
 
@@ -82,13 +140,192 @@ def instapaper_url(url, title, abstract):
     return base + urlencode(params)
 
 
-@cache
+def private_directory(path):
+    """ Make `path` a directory only this user can use, or refuse one that
+    another user could have written to """
+    try:
+        os.makedirs(path, mode=0o700)
+    except OSError:
+        # another worker got there first
+        if not os.path.isdir(path):
+            raise
+    stat = os.lstat(path)
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+        raise RuntimeError(
+            '{} must be a directory owned by this user, with mode 0700'.format(path))
+
+
+class AssetCache(object):
+    """ S3 objects kept on local disk, shared by the workers of a machine
+
+    A body is stored with its ETag and LastModified. Once it has not been
+    checked for `interval` seconds it is revalidated with a conditional
+    get, so an unchanged object costs a 304 instead of a download. If S3
+    can't be reached the stored body is served.
+
+    :param directory: where bodies are stored, None to always download
+    :param interval: seconds between revalidations
+    """
+
+    def __init__(self, directory=None, interval=300):
+        self.directory = directory
+        self.interval = interval
+
+    def init_app(self, app):
+        self.directory = app.config.get('ASSET_CACHE_DIR')
+        self.interval = app.config.get('ASSET_REVALIDATE_INTERVAL', self.interval)
+        if self.directory:
+            # stored bodies are served as they are
+            private_directory(self.directory)
+
+    def path(self, bucket_name, key_name):
+        name = u'{}/{}'.format(bucket_name, key_name).encode('utf-8')
+        return os.path.join(self.directory, hashlib.sha1(name).hexdigest())
+
+    def read(self, path):
+        """ Return the metadata, body and time last checked of a stored
+        object, or Nones """
+        try:
+            with open(path, 'rb') as f:
+                # the file's mtime is when it was last revalidated
+                checked = os.fstat(f.fileno()).st_mtime
+                meta = json.loads(f.readline().decode('utf-8'))
+                return meta, f.read(), checked
+        except (IOError, OSError, ValueError):
+            return None, None, None
+
+    def write(self, path, meta, body):
+        """ Store an object; an unwritable directory only logs a warning """
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                    dir=self.directory, delete=False) as f:
+                f.write(json.dumps(meta).encode('utf-8') + b'\n')
+                f.write(body)
+            # workers never see a partly written file
+            os.replace(f.name, path)
+        except (IOError, OSError) as err:
+            logging.warning('could not store %s: %s', path, err)
+
+    def discard(self, bucket_name, key_name):
+        """ Drop the stored copy of an object, for every worker on the host """
+        if not self.directory:
+            return
+        path = self.path(bucket_name, key_name)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            logging.warning('could not remove %s: %s', path, err)
+
+    def fetch(self, client, bucket_name, key_name):
+        """ Return the body of an S3 object, from disk while it is fresh """
+        if not self.directory:
+            obj = client.get_object(Bucket=bucket_name, Key=key_name)
+            return obj['Body'].read()
+        path = self.path(bucket_name, key_name)
+        meta, body, checked = self.read(path)
+        if meta is not None and time.time() - checked < self.interval:
+            return body
+        params = dict(Bucket=bucket_name, Key=key_name)
+        if meta is not None and meta.get('etag'):
+            params['IfNoneMatch'] = meta['etag']
+        try:
+            obj = client.get_object(**params)
+        except botocore.exceptions.ClientError as err:
+            status = err.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+            if meta is None or status != 304:
+                raise
+            logging.debug('%s not modified', key_name)
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return body
+        except botocore.exceptions.BotoCoreError as err:
+            if meta is None:
+                raise
+            logging.warning('could not revalidate %s: %s', key_name, err)
+            return body
+        body = obj['Body'].read()
+        last_modified = obj.get('LastModified')
+        self.write(path, {
+            'etag': obj.get('ETag'),
+            'last_modified': last_modified and last_modified.isoformat(),
+        }, body)
+        return body
+
+
+asset_cache = AssetCache()
+
+
+class S3(object):
+    """ The S3 client and thread pool of this process
+
+    Both are created on first use, and again in a forked worker, so
+    credentials are resolved and connections pooled once per process.
+    """
+
+    def __init__(self, max_pool_connections=10, max_attempts=5, max_workers=8):
+        self.max_pool_connections = max_pool_connections
+        self.max_attempts = max_attempts
+        self.max_workers = max_workers
+        self._pid = None
+        self._client = None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.max_pool_connections = app.config.get(
+            'S3_MAX_POOL_CONNECTIONS', self.max_pool_connections)
+        self.max_attempts = app.config.get('S3_MAX_ATTEMPTS', self.max_attempts)
+        self.max_workers = app.config.get('S3_MAX_WORKERS', self.max_workers)
+        self.reset()
+
+    def reset(self):
+        """ Drop the client and pool; they are made again on next use """
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False)
+            self._pid = self._client = self._executor = None
+
+    def _setup(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                config = botocore.config.Config(
+                    max_pool_connections=self.max_pool_connections,
+                    retries={'max_attempts': self.max_attempts, 'mode': 'standard'})
+                # clients are thread-safe, sessions are not
+                self._client = boto3.session.Session().client('s3', config=config)
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix='s3')
+                self._pid = os.getpid()
+
+    @property
+    def client(self):
+        self._setup()
+        return self._client
+
+    def map(self, fn, *iterables):
+        """ Return the results of `fn` run concurrently on the pool """
+        self._setup()
+        return list(self._executor.map(fn, *iterables))
+
+
+s3 = S3()
+
+
+@cache(maxsize=32, ttl=60)
 def aopen(key_name, bucket_name='contrivers-assets'):
-    """ Return the contents of a S3 key object """
+    """ Return the contents of a S3 key object
+
+    Contents are kept for a minute in each process and in the
+    `asset_cache` on disk. `aopen.invalidate(key_name)` fetches a key
+    again on its next use.
+    """
     try:
-        s3 = boto3.client('s3')
-        obj = s3.get_object(Bucket=bucket_name, Key=key_name)
-        contents = obj.get('Body').read()
+        contents = asset_cache.fetch(s3.client, bucket_name, key_name)
         utf = contents.decode('utf-8')
         logging.debug('boto3 get_object decodes properly from utf-8')
         return utf
@@ -100,11 +337,47 @@ def aopen(key_name, bucket_name='contrivers-assets'):
         raise err
 
 
-def asave(key_name, bucket_name='contrivers-assets'):
+def asset_key(key_name, bucket_name='contrivers-assets'):
+    """ Return the invalidation key of a S3 object """
+    return u'asset:{}/{}'.format(bucket_name, key_name)
+
+
+def forget_assets(keys, tables=()):
+    """ Drop what this host keeps of the S3 objects named in `keys`
+
+    Other keys are ignored, so this can be subscribed to the invalidation
+    bus as it is.
+    """
+    for key in keys:
+        if key.startswith(u'asset:'):
+            bucket_name, _, key_name = key[len(u'asset:'):].partition(u'/')
+            asset_cache.discard(bucket_name, key_name)
+            aopen.invalidate(key_name, bucket_name)
+
+
+# called with the keys of the objects saved or removed by this process,
+# to tell the other hosts
+asset_handlers = []
+
+
+def assets_changed(key_names, bucket_name='contrivers-assets'):
+    """ Drop this host's copies of changed objects, and pass their keys to
+    the `asset_handlers` """
+    keys = set(asset_key(key_name, bucket_name) for key_name in key_names)
+    forget_assets(keys)
+    for handler in asset_handlers:
+        handler(keys)
+
+
+def _put(key_name, bucket_name, body):
+    s3.client.put_object(Bucket=bucket_name, Key=key_name, Body=body)
+
+
+def asave(key_name, bucket_name='contrivers-assets', body=b''):
     """ Save string to a S3 key object """
     try:
-        s3 = boto3.client('s3')
-        s3.put_object(Bucket=bucket_name, Key=key_name)
+        _put(key_name, bucket_name, body)
+        assets_changed([key_name], bucket_name)
     except botocore.exceptions.ClientError as err:
         # TODO: handle ClientError
         raise err
@@ -115,12 +388,54 @@ def aremove(key_name, bucket_name='contrivers-assets'):
     Remove a S3 key from a bucket
     """
     try:
-        s3 = boto3.client('s3')
-        s3.delete_object(Bucket=bucket_name, Key=key_name)
+        s3.client.delete_object(Bucket=bucket_name, Key=key_name)
+        assets_changed([key_name], bucket_name)
     except botocore.exceptions.ClientError as err:
         # TODO: handle ClientError
         raise err
 
+
+def aopen_many(key_names, bucket_name='contrivers-assets'):
+    """ Return a dict of the contents of S3 keys, fetched concurrently """
+    key_names = list(key_names)
+    contents = s3.map(lambda key_name: aopen(key_name, bucket_name), key_names)
+    return dict(zip(key_names, contents))
+
+
+def asave_many(items, bucket_name='contrivers-assets'):
+    """ Save a dict of key names to bodies, concurrently """
+    items = list(iteritems(items))
+    try:
+        s3.map(lambda item: _put(item[0], bucket_name, item[1]), items)
+    finally:
+        # the handlers run here, in the caller's app context
+        assets_changed([key_name for key_name, _ in items], bucket_name)
+
+
+# delete_objects takes at most this many keys
+DELETE_BATCH_SIZE = 1000
+
+
+def aremove_many(key_names, bucket_name='contrivers-assets'):
+    """ Remove S3 keys from a bucket, a thousand per request
+
+    :returns: a list of the errors S3 reported, one per key not removed
+    """
+    key_names = list(key_names)
+    errors = []
+    try:
+        for i in range(0, len(key_names), DELETE_BATCH_SIZE):
+            batch = key_names[i:i + DELETE_BATCH_SIZE]
+            response = s3.client.delete_objects(Bucket=bucket_name, Delete={
+                'Objects': [{'Key': key_name} for key_name in batch],
+                'Quiet': True})
+            errors.extend(response.get('Errors', []))
+    finally:
+        assets_changed(key_names, bucket_name)
+    for error in errors:
+        logging.warning('could not remove %s: %s', error.get('Key'), error.get('Message'))
+    return errors
+
 def has_timezone(dt):
     """ Return True if datetime object has a tzinfo attribute """
     if not isinstance(dt, datetime.datetime):
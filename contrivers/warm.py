@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    contrivers.warm
+    ---------------
+
+    Request the pages of the sitemap, and the feeds, to fill the caches
+    after a deploy.
+
+    Pages are requested newest first, by the sitemap's lastmod, with a
+    bounded number in flight. Requests go through the app's test client,
+    which fills the shared redis cache, or over http to a running site,
+    which also fills the caches of each of its workers.
+"""
+
+import time
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+from xml.etree import ElementTree
+
+from flask import current_app
+
+
+logger = logging.getLogger(__name__)
+
+SITEMAP_NS = '{http://www.sitemaps.org/schemas/sitemap/0.9}'
+
+Timing = namedtuple('Timing', 'path status seconds')
+
+
+def parse_sitemap(xml):
+    """ Return (path, lastmod) pairs from a sitemap, newest first """
+    entries = []
+    for url in ElementTree.fromstring(xml).iter(SITEMAP_NS + 'url'):
+        loc = url.findtext(SITEMAP_NS + 'loc', '').strip()
+        lastmod = url.findtext(SITEMAP_NS + 'lastmod', '').strip()
+        if loc:
+            # static pages are listed by path, the rest by url
+            entries.append((urlsplit(loc).path or '/', lastmod))
+    # iso dates sort as strings
+    entries.sort(key=lambda entry: entry[1], reverse=True)
+    return entries
+
+
+def feed_paths():
+    """ Return the paths of the feeds that need no arguments """
+    return sorted(
+        rule.rule for rule in current_app.url_map.iter_rules()
+        if rule.endpoint.startswith('www.rss_') and 'GET' in rule.methods
+        and not rule.arguments - set(rule.defaults or ()))
+
+
+def plan_paths(sitemap_xml, feeds=()):
+    """ Return the paths to warm, newest first
+
+    The feeds show the newest writing, so they go with it, after the index.
+    """
+    entries = parse_sitemap(sitemap_xml)
+    paths = ['/'] + list(feeds) + [path for path, _ in entries]
+    seen = set()
+    return [path for path in paths if not (path in seen or seen.add(path))]
+
+
+def app_fetcher(app):
+    """ Return a fetch(path) that requests through `app`'s test client """
+    def fetch(path):
+        with app.test_client().get(path) as response:
+            response.get_data()
+            return response.status_code
+    return fetch
+
+
+def http_fetcher(base_url, timeout=30):
+    """ Return a fetch(path) that requests `base_url` over http """
+    import requests
+    sessions = threading.local()
+
+    def fetch(path):
+        # sessions pool connections, but aren't shared between threads
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+        response = sessions.session.get(urljoin(base_url, path), timeout=timeout)
+        return response.status_code
+    return fetch
+
+
+def read_sitemap(app, base_url=None):
+    """ Return the sitemap of `app`, or of the site at `base_url` """
+    if base_url is not None:
+        import requests
+        response = requests.get(urljoin(base_url, '/sitemap.xml'), timeout=30)
+        response.raise_for_status()
+        return response.content
+    with app.test_client().get('/sitemap.xml') as response:
+        if response.status_code != 200:
+            raise RuntimeError('/sitemap.xml returned {}'.format(response.status_code))
+        return response.get_data()
+
+
+def warm(fetch, paths, concurrency=4, progress=None):
+    """ Request `paths`, at most `concurrency` at a time
+
+    :param fetch: called with a path, returns the status code
+    :param progress: called with each Timing as it finishes
+    :returns: a list of Timings, in the order of `paths`
+    """
+    def timed(path):
+        start = time.perf_counter()
+        try:
+            status = fetch(path)
+        except Exception as err:
+            logger.warning('warming %s failed: %s', path, err)
+            status = None
+        timing = Timing(path, status, time.perf_counter() - start)
+        if progress is not None:
+            progress(timing)
+        return timing
+
+    # map submits in order, so the newest pages are requested first
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(timed, paths))
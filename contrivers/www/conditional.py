@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    contrivers.www.conditional
+    --------------------------
+
+    ETag and Last-Modified validators for the public views.
+
+    A view's validators come from one query that returns the newest
+    `last_edited_date` and the number of rows it is rendered from. A
+    request whose If-None-Match or If-Modified-Since still matches is
+    answered with 304 before the view runs.
+"""
+
+import hashlib
+from functools import wraps
+
+from flask import current_app, request, make_response
+from sqlalchemy import func, union_all
+
+from ..ext import db
+from ..models import (Writing, Author, Tag, Book, author_to_writing,
+                      tag_to_writing)
+from ..utils import with_utc
+
+
+def freshness(*queries):
+    """ Return the newest last_edited_date and the row count of `queries`
+
+    Each query selects `max(last_edited_date)` and `count(*)`; they are
+    sent to the database as a single statement.
+    """
+    stmt = union_all(*[q.statement for q in queries]).subquery()
+    newest, count = db.session.query(
+        func.max(stmt.c.newest), func.sum(stmt.c.count)).one()
+    return newest, int(count or 0)
+
+
+def newest(model):
+    """ Return a query for the freshness of `model`'s rows
+
+    The query selects from the model's own table, so it stays cheap for
+    polymorphic models.
+    """
+    table = model.__table__
+    return db.session.query(
+        func.max(table.c.last_edited_date).label('newest'),
+        func.count(table.c.id).label('count')).\
+        select_from(table)
+
+
+def site_freshness(**kwargs):
+    """ Lists, feeds and the sitemap may show any row """
+    return freshness(newest(Writing), newest(Author), newest(Tag), newest(Book))
+
+
+def writing_freshness(id_=None, **kwargs):
+    """ A writing page shows the writing, its authors, tags and books """
+    if id_ is None:
+        return site_freshness()
+    return freshness(
+        newest(Writing).filter(Writing.__table__.c.id == id_),
+        newest(Author).join(author_to_writing).
+            filter(author_to_writing.c.writing_id == id_),
+        newest(Tag).join(tag_to_writing).
+            filter(tag_to_writing.c.writing_id == id_),
+        newest(Book).filter(Book.__table__.c.review_id == id_))
+
+
+def author_freshness(id_=None, **kwargs):
+    """ An author page shows the author and their writing """
+    if id_ is None:
+        return site_freshness()
+    return freshness(
+        newest(Author).filter(Author.__table__.c.id == id_),
+        newest(Writing).join(author_to_writing).
+            filter(author_to_writing.c.author_id == id_))
+
+
+def tag_freshness(id_=None, **kwargs):
+    """ A tag page shows the tag and its writing """
+    if id_ is None:
+        return site_freshness()
+    return freshness(
+        newest(Tag).filter(Tag.__table__.c.id == id_),
+        newest(Writing).join(tag_to_writing).
+            filter(tag_to_writing.c.tag_id == id_))
+
+
+def make_etag(last_modified, count):
+    """ Return an etag for this url at `last_modified` """
+    value = u'|'.join((
+        request.full_path,
+        last_modified.isoformat(),
+        str(count),
+        current_app.config.get('ETAG_SALT', '')))
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+def is_fresh(etag, last_modified):
+    """ Return True if the client's copy is current """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return with_utc(request.if_modified_since) >= last_modified
+    return False
+
+
+def conditional(get_freshness):
+    """ Decorate a view to send validators and answer conditional requests
+
+    :param get_freshness: called with the view's arguments, returns the
+        newest last_edited_date and the number of rows the view shows
+    """
+    def decorator(fn):
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return fn(*args, **kwargs)
+            last_modified, count = get_freshness(**kwargs)
+            if last_modified is None:
+                return fn(*args, **kwargs)
+            last_modified = with_utc(last_modified)
+            etag = make_etag(last_modified, count)
+            # http dates have no fractional seconds
+            last_modified = last_modified.replace(microsecond=0)
+            if is_fresh(etag, last_modified):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(fn(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            response.last_modified = last_modified
+            return response
+
+        # the static export fingerprints pages with it too
+        wrapper.freshness = get_freshness
+        return wrapper
+
+    return decorator
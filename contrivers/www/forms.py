@@ -7,13 +7,15 @@
     Web forms via WTForms.
 """
 
-from flask_wtf import FlaskForm
-from wtforms import TextField
+from wtforms import Form, TextField
 
 class SearchField(TextField):
     # Should set type to 'search' for css selectors
     pass
 
 
-class SearchForm(FlaskForm):
-    search_term = TextField("Search")
\ No newline at end of file
+class SearchForm(Form):
+    # searching changes nothing, so the form is sent with GET and has no
+    # csrf token; every page that renders it is the same for every reader
+    # and can be cached, and so can /search/?q=...
+    q = SearchField("Search")
@@ -7,37 +7,26 @@
 
 """
 
-import markdown
-
 from . import www
-
-def markdown_factory(extensions=None):
-    """ return an initialized `markdown.Markdown` object
-
-    Use an factory pattern to create a new markdown parser per request or
-    unit of work. If you try to reuse a converter, it spits out cached
-    results and that is not what we want.
-    :params extensions: a list of extension names as strings to be loaded
-        into the markdown converter. Defaults to footnotes, headerid, smarty
-        and toc
-    :returns: a Markdown object
-    """
-
-    if extensions is None:
-        extensions = [
-            'footnotes',
-            # 'headerid',
-            'smarty',
-            'tables'
-    ]
-    return markdown.Markdown(extensions=extensions)
+from ..rendering import markdown_factory, render
 
 
 @www.app_template_filter()
 def md(txt):
     """Markdown Jinja2 template filter"""
-    md = markdown_factory()
-    return md.convert(txt)
+    return render(txt)
+
+@www.app_template_filter()
+def html(obj, attr):
+    """ Return the stored html for a markdown column of `obj`
+
+    Models keep a rendered copy of their markdown columns in `<attr>_html`;
+    fall back to rendering the markdown when that copy is missing.
+    """
+    stored = getattr(obj, attr + '_html', None)
+    if stored:
+        return stored
+    return render(getattr(obj, attr))
 
 @www.app_template_test()
 def empty(ls):
@@ -13,7 +13,7 @@ from urllib.parse import urljoin
 
 from flask import url_for
 
-from .jinja_helpers import markdown_factory
+from ..rendering import render
 
 class BaseFeedGenerator(object):
     """
@@ -87,8 +87,7 @@ class RssGenerator(BaseFeedGenerator):
                 'uri': url_for('www.authors', author_id=author.id),
                 'email': 'editors@contrivers.org'
                 } for author in elem.authors ])
-            md = markdown_factory()
-            fe.content(content=md.convert(elem.text), type='html')
+            fe.content(content=elem.text_html or render(elem.text), type='html')
             fe.link(href=canonical_url, rel='alternate', title=elem.title)
             fe.description(description=elem.abstract, isSummary=True)
             for tag in elem.tags:
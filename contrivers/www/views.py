@@ -10,13 +10,18 @@ from collections import namedtuple
 
 from flask import (
     render_template, request, url_for, redirect, make_response, abort,
-    current_app, g
+    current_app, g, Response, stream_with_context, template_rendered
 )
 from sqlalchemy import desc, func
 from .forms import SearchForm
 from .rss import RssGenerator
 from . import www
-from ..models import Writing, Article, Review, Tag, Author, db, Reading
+from ..models import (Writing, Article, Review, Tag, Author, db, Reading,
+                      list_options, tag_to_writing)
+from ..ext import response_cache, query_cache
+from ..caching import add_surrogate_keys
+from .conditional import (conditional, site_freshness, writing_freshness,
+                          author_freshness, tag_freshness)
 from ..utils import aopen
 
 
@@ -24,36 +29,73 @@ from ..utils import aopen
 def set_site_info():
     return dict(search=SearchForm())
 
-# @cache.cached(timeout=50)
+
+def stream_template(template_name, **context):
+    """ Return a generator that renders the template in chunks
+
+    Like `render_template`, but the response can start before the whole
+    page is rendered.
+    """
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    template_rendered.send(app, template=template, context=context)
+    stream = template.stream(context)
+    stream.enable_buffering(app.config.get('STREAM_BUFFER_SIZE', 5))
+    return stream
+
+
+def render_writing(template_name, **context):
+    """ Render a writing detail page
+
+    With STREAM_TEMPLATES set the head and header are sent while the body
+    is still being converted, which lowers the time to first byte of long
+    essays.
+    """
+    if not current_app.config.get('STREAM_TEMPLATES'):
+        return render_template(template_name, **context)
+    return Response(stream_with_context(stream_template(template_name, **context)))
+
 @www.route('/')
+@conditional(site_freshness)
+@response_cache.cached()
 def index():
     """ return the index page """
+    add_surrogate_keys('writing')
     return render_template(
         'index.html',
-        featured=Writing.query.\
-                order_by(Writing.publish_date.desc()).\
-                filter_by(featured=True, hidden=False).\
-                all(),
-        articles=Writing.query.\
-                order_by(Writing.publish_date.desc()).
-                filter_by(featured=False, hidden=False).\
-                limit(5),
+        featured=query_cache.all(
+            Writing.listed().
+            order_by(Writing.publish_date.desc()).
+            filter_by(featured=True, hidden=False)),
+        articles=query_cache.all(
+            Writing.listed().
+            order_by(Writing.publish_date.desc()).
+            filter_by(featured=False, hidden=False).
+            limit(5)),
         rss_url=url_for('.rss_index', _external=True))
 
 @www.route('/rss/')
+@conditional(site_freshness)
+@response_cache.cached()
 def rss_index():
+    add_surrogate_keys('writing')
     rss = RssGenerator(
         url_for('.index', _external=True),
-        Writing.query.\
-            filter_by(hidden=False).\
-            order_by(Writing.publish_date.desc()).\
-            limit(20))
+        query_cache.all(
+            Writing.listed().
+            filter_by(hidden=False).
+            order_by(Writing.publish_date.desc()).
+            limit(20)))
     return make_response(rss.rss_str())
 
 @www.route('/articles/featured/<int:page>/')
 @www.route('/articles/featured/', defaults={'page': 1})
+@conditional(site_freshness)
+@response_cache.cached()
 def featured(page):
-    featured = Writing.query.\
+    add_surrogate_keys('writing')
+    featured = Writing.listed().\
         filter_by(featured=True).\
         order_by(Writing.publish_date).\
         paginate(page)
@@ -64,10 +106,13 @@ def featured(page):
         rss_url = url_for('.rss_featured', _external=True))
 
 @www.route('/articles/featured/rss/')
+@conditional(site_freshness)
+@response_cache.cached()
 def rss_featured():
+    add_surrogate_keys('writing')
     rss = RssGenerator(
         url_for('.featured', _external=True),
-        Writing.query.filter_by(featured=True, hidden=False).order_by(Writing.publish_date.desc()).limit(10),
+        query_cache.all(Writing.listed().filter_by(featured=True, hidden=False).order_by(Writing.publish_date.desc()).limit(10)),
         title=u"Contrivers' Review Featured")
     return make_response(rss.rss_str())
 
@@ -75,21 +120,27 @@ def rss_featured():
 @www.route('/articles/<int:id_>/<slug>/', defaults={'page': 1})
 @www.route('/articles/<int:id_>/', defaults={'page': None, 'slug': None})
 @www.route('/articles/p/<int:page>/', defaults={'id_': None, 'slug': None})
+@conditional(writing_freshness)
+@response_cache.cached()
 def articles(id_, page, slug):
     if id_ is not None:
-        return render_template(
+        return render_writing(
             'article.html',
             article=Article.query.get_or_404(id_))
     else:
+        add_surrogate_keys('writing')
         return render_template(
             'articles.html',
-            paginated=Article.query.order_by(Article.publish_date.desc()).paginate(page),
+            paginated=Article.listed().order_by(Article.publish_date.desc()).paginate(page),
             endpoint='.articles',
             rss_url = url_for('.rss_articles', _external=True))
 
 @www.route('/articles/rss/')
+@conditional(site_freshness)
+@response_cache.cached()
 def rss_articles():
-    query = Article.query.order_by(Article.publish_date).limit(20)
+    add_surrogate_keys('writing')
+    query = query_cache.all(Article.listed().order_by(Article.publish_date).limit(20))
     rss = RssGenerator(url_for('.articles', _external=True), query, title=u"Contrivers’ Review Articles")
     return make_response(rss.rss_str())
 
@@ -97,23 +148,29 @@ def rss_articles():
 @www.route('/reviews/<int:id_>/<slug>/', defaults={'page': 1})
 @www.route('/reviews/<int:id_>/', defaults={'page': 1, 'slug': None})
 @www.route('/reviews/p/<int:page>/', defaults={'id_': None, 'slug': None})
+@conditional(writing_freshness)
+@response_cache.cached()
 def reviews(id_, page, slug):
     if id_ is not None:
-        return render_template(
+        return render_writing(
             'article.html',
             article=Review.query.get_or_404(id_))
     else:
+        add_surrogate_keys('writing')
         return render_template(
             'articles.html',
-            paginated=Review.query.order_by(Review.publish_date.desc()).paginate(page),
+            paginated=Review.listed().order_by(Review.publish_date.desc()).paginate(page),
             endpoint='.reviews',
             rss_url = url_for('.rss_reviews', _external=True))
 
 @www.route('/reviews/rss/')
+@conditional(site_freshness)
+@response_cache.cached()
 def rss_reviews():
+    add_surrogate_keys('writing')
     rss = RssGenerator(
         url_for('.reviews'),
-        Review.query.order_by(Review.publish_date.desc()).limit(20),
+        query_cache.all(Review.listed().order_by(Review.publish_date.desc()).limit(20)),
         title=u"Contrivers' Review Book Reviews")
     return make_response(rss.rss_str())
 
@@ -121,38 +178,50 @@ def rss_reviews():
 @www.route('/readings/<int:id_>/<slug>/', defaults={'page': 1})
 @www.route('/readings/<int:id_>/', defaults={'page': 1, 'slug': None})
 @www.route('/readings/p/<int:page>/', defaults={'id_': None, 'slug': None})
+@conditional(writing_freshness)
+@response_cache.cached()
 def readings(id_, page, slug):
     if id_ is not None:
-        return render_template(
+        return render_writing(
             'article.html',
             article=Reading.query.get_or_404(id_))
     else:
+        add_surrogate_keys('writing')
         return render_template(
             'articles.html',
-            paginated=Reading.query.order_by(Reading.publish_date.desc()).paginate(page),
+            paginated=Reading.listed().order_by(Reading.publish_date.desc()).paginate(page),
             endpoint='.readings',
             rss_url = url_for('.rss_readings', _external=True))
 
 @www.route('/readings/rss/')
+@conditional(site_freshness)
+@response_cache.cached()
 def rss_readings():
+    add_surrogate_keys('writing')
     rss = RssGenerator(
         url_for('.readings'),
-        reading.query.order_by(reading.publish_date.desc()).limit(20),
+        query_cache.all(Reading.listed().order_by(Reading.publish_date.desc()).limit(20)),
         title=u"Contrivers' reading Book readings")
     return make_response(rss.rss_str())
 
 
 @www.route('/archive/', defaults={'page': 1})
 @www.route('/archive/p/<int:page>/')
+@conditional(site_freshness)
+@response_cache.cached()
 def archive(page):
+    add_surrogate_keys('writing')
     return render_template('articles.html',
-        paginated=Writing.query.order_by(Writing.publish_date.desc()).paginate(page),
+        paginated=Writing.listed().order_by(Writing.publish_date.desc()).paginate(page),
         endpoint='.archive',
         rss_url = url_for('.rss_reviews', _external=True))
 
 @www.route('/archive/rss/')
+@conditional(site_freshness)
+@response_cache.cached()
 def rss_archive():
-    query = Writing.query.order_by(Writing.publish_date.desc()).limit(20)
+    add_surrogate_keys('writing')
+    query = query_cache.all(Writing.listed().order_by(Writing.publish_date.desc()).limit(20))
     rss = RssGenerator(url_for('.archive', _external=True), query, title=u"Contrivers' Review Recent")
     return make_response(rss.rss_str())
 
@@ -160,6 +229,8 @@ def rss_archive():
 @www.route('/authors/<int:id_>/<slug>/', defaults={'page': 1})
 @www.route('/authors/<int:id_>/', defaults={'page': 1, 'slug': None})
 @www.route('/authors/p/<int:page>/', defaults={'id_': None, 'slug': None})
+@conditional(author_freshness)
+@response_cache.cached()
 def authors(id_, page, slug):
     if id_ is not None:
         # TODO: paginate list of single author's articles
@@ -170,21 +241,26 @@ def authors(id_, page, slug):
             author=author,
             rss_url=url_for('.rss_author', id_=author.id, _external=True))
     else:
+        add_surrogate_keys('author')
         return render_template(
             'authors.html',
             paginated = Author.ordered_query(page=page),
             endpoint='.authors')
 
 @www.route('/authors/<int:id_>/rss/')
+@conditional(author_freshness)
+@response_cache.cached()
 def rss_author(id_):
     author = Author.query.get_or_404(id_)
-    rss = RssGenerator(url_for('.authors', author_id=author.id), author.writing, title=u"{} -- Contrivers' Review".format(author.name))
+    rss = RssGenerator(url_for('.authors', author_id=author.id), author.writing.options(*list_options(Writing)), title=u"{} -- Contrivers' Review".format(author.name))
     return make_response(rss.rss_str())
 
 @www.route('/categories/', defaults={'id_': None, 'page': 1, 'slug': None})
 @www.route('/categories/<int:id_>/<slug>/', defaults={'page': 2})
 @www.route('/categories/<int:id_>/', defaults={'page': 1, 'slug': None})
 @www.route('/categories/p/<int:page>/', defaults={'id_': None, 'slug': None})
+@conditional(tag_freshness)
+@response_cache.cached()
 def tags(id_, page, slug):
     if id_ is not None:
         # TODO: paginate list of single tag's articles
@@ -194,16 +270,22 @@ def tags(id_, page, slug):
             tag=tag,
             rss_url=url_for('.rss_tag', id_=tag.id, _external=True))
     else:
+        add_surrogate_keys('tag')
         return render_template(
             'tags.html',
             paginated=Tag.ordered_query(page=page))
 
 @www.route('/categories/<int:id_>/rss/')
+@conditional(tag_freshness)
+@response_cache.cached()
 def rss_tag(id_):
     tag = Tag.query.get_or_404(id_)
     rss = RssGenerator(
         url_for('.tags', id_=tag.id),
-        tag.writing,
+        Writing.listed().
+        join(tag_to_writing).
+        filter(tag_to_writing.c.tag_id == tag.id).
+        order_by(Writing.publish_date.desc()),
         title=u"Contrivers\' Review -- {}".format(tag.tag))
     return make_response(rss.rss_str())
 
@@ -219,22 +301,29 @@ def support():
 # def readings():
 #     return redirect(url_for('www.tags', id_=6, page=1))
 
-@www.route('/search/', methods=('POST', 'GET'), defaults={'page': 1})
+@www.route('/search/', methods=('GET', 'POST'), defaults={'page': 1})
 @www.route('/search/p/<int:page>/')
+@response_cache.cached()
 def search(page):
-    form = SearchForm()
-    if form.validate_on_submit():
+    if request.method == 'POST':
+        # pages cached before search was a GET form still post here
+        term = request.form.get('q') or request.form.get('search_term', '')
+        return redirect(url_for('.search', q=term), code=303)
+    form = SearchForm(request.args)
+    if form.q.data:
         # TODO: preprocess the search term?
-        g.search_term = form.data['search_term']
-        results = Writing.query.\
+        g.search_term = form.q.data
+        add_surrogate_keys('writing')
+        results = Writing.listed().\
             filter(Writing.tsvector.op('@@')(
-                func.plainto_tsquery(form.data['search_term']))).\
+                func.plainto_tsquery(form.q.data))).\
             paginate(page)
 
         return render_template(
             'search.html',
             paginated=results,
-            search=SearchForm(placeholder=form.data['search_term']))
+            endpoint='.search',
+            search=form)
     else:
         return render_template('search.html')
 
@@ -305,10 +394,13 @@ def favicon():
     return(current_app.send_static_file('images/favicon.ico'))
 
 @www.route('/sitemap.xml')
+@conditional(site_freshness)
+@response_cache.cached()
 def sitemap():
     """ Create a sitemap
     http://www.sitemaps.org/protocol.html
     """
+    add_surrogate_keys('writing', 'author')
     pages = []
     RuleTuple = namedtuple('Rule', ['loc', 'lastmod',]) #'changefreq', 'priority'])
     ten_days_ago = (datetime.now() - timedelta(days=10)).date().isoformat()
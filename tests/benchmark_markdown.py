@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    tests.benchmark_markdown
+
+    Compare the markdown backends on tests/markdown.md. Run from the repo
+    root:
+
+        $ python tests/benchmark_markdown.py -n 500
+"""
+
+import os
+import sys
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from contrivers.rendering import markdown_factory, get_backend
+
+
+def load_document(repeat):
+    path = os.path.join(os.path.dirname(__file__), 'markdown.md')
+    with open(path, encoding='utf-8') as f:
+        txt = f.read()
+    return u'\n\n'.join([txt] * repeat)
+
+
+def candidates():
+    """ yield (label, convert function) pairs """
+    yield 'factory per call', lambda txt: markdown_factory().convert(txt)
+    yield 'python-markdown (pooled)', get_backend(name='python-markdown').convert
+    try:
+        yield 'commonmark', get_backend(name='commonmark').convert
+    except ImportError:
+        print('markdown-it-py is not installed, skipping commonmark')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='markdown benchmark')
+    parser.add_argument('-n', '--number', type=int, default=200, help='conversions per backend')
+    parser.add_argument('--repeat', type=int, default=1, help='concatenate the test document this many times')
+    args = parser.parse_args()
+
+    txt = load_document(args.repeat)
+    print('{} conversions of {} characters'.format(args.number, len(txt)))
+    baseline = None
+    for label, convert in candidates():
+        convert(txt)  # warm up
+        elapsed = timeit.timeit(lambda: convert(txt), number=args.number)
+        per_call = elapsed / args.number * 1000
+        if baseline is None:
+            baseline = per_call
+        print('{:<28} {:8.3f} ms/call {:6.2f}x'.format(label, per_call, baseline / per_call))
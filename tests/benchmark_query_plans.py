@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    tests.benchmark_query_plans
+
+    Compare the queries of the archive, the main feed and the sitemap
+    when every subclass table of Writing is joined, as `with_polymorphic
+    '*'` did, with the single table queries they run now. Prints each
+    plan, then the time to run each query and load its rows. Run from the
+    repo root against a copy of the site's database:
+
+        $ python tests/benchmark_query_plans.py postgresql://localhost/contrivers -n 50
+"""
+
+import os
+import sys
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from sqlalchemy import text
+from sqlalchemy.orm import with_polymorphic
+
+from contrivers import create_app
+from contrivers.ext import db
+from contrivers.models import Writing, list_options
+
+
+def archive(entity):
+    return db.session.query(entity).\
+        options(*list_options(entity)).\
+        order_by(entity.publish_date.desc()).\
+        limit(20)
+
+
+def rss_index(entity):
+    return db.session.query(entity).\
+        options(*list_options(entity)).\
+        filter_by(hidden=False).\
+        order_by(entity.publish_date.desc()).\
+        limit(20)
+
+
+def sitemap(entity):
+    return db.session.query(entity).\
+        filter_by(hidden=False).\
+        order_by(entity.last_edited_date.desc())
+
+
+def explain(query):
+    """ Return the plan of `query` as the database reports it """
+    statement = query.statement.compile(
+        dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})
+    if db.engine.dialect.name == 'postgresql':
+        prefix = 'EXPLAIN (ANALYZE, BUFFERS) '
+    else:
+        prefix = 'EXPLAIN QUERY PLAN '
+    rows = db.session.execute(text(prefix + str(statement))).fetchall()
+    return u'\n'.join(u'    ' + u' '.join(str(col) for col in row) for row in rows)
+
+
+def load(query):
+    """ Run `query` into a fresh session """
+    db.session.expunge_all()
+    query.all()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='query plan benchmark')
+    parser.add_argument('database_url', nargs='?', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('-n', '--number', type=int, default=50, help='runs of each query')
+    args = parser.parse_args()
+    if not args.database_url:
+        sys.exit('pass a database url, or set DATABASE_URL')
+
+    app = create_app(additional_config_vars={
+        'SQLALCHEMY_DATABASE_URI': args.database_url,
+        'CACHE_TYPE': 'null',
+        'SHARED_CACHE_PATH': None,
+        'INVALIDATION_BUS': False})
+
+    every_subclass = with_polymorphic(Writing, '*')
+    results = []
+    with app.app_context():
+        for name, build in (('archive', archive), ('rss_index', rss_index), ('sitemap', sitemap)):
+            for label, entity in (('every subclass', every_subclass), ('writing only', Writing)):
+                query = build(entity)
+                print('{}, {}:\n{}\n'.format(name, label, explain(query)))
+                seconds = min(timeit.repeat(
+                    lambda: load(query), number=args.number, repeat=3)) / args.number
+                results.append((name, label, seconds * 1000))
+
+    print('{:<12} {:<16} {:>10}'.format('view', 'query', 'ms'))
+    for name, label, ms in results:
+        print('{:<12} {:<16} {:10.3f}'.format(name, label, ms))
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    tests.benchmark_s3
+
+    Compare a client per call with the shared S3 client, and one request
+    per key with the bulk helpers. Runs against a local moto server unless
+    an endpoint is given. Run from the repo root:
+
+        $ python tests/benchmark_s3.py -n 200
+        $ python tests/benchmark_s3.py --endpoint-url http://localhost:9000
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import boto3
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+BUCKET = 'contrivers-benchmark'
+
+
+def start_server():
+    """ Start a moto server in a thread and return its url """
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        sys.exit('moto[server] is not installed, pass --endpoint-url')
+    server = ThreadedMotoServer(port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    return 'http://{}:{}'.format(host, port)
+
+
+def timed(label, fn, number, baseline=None):
+    start = time.perf_counter()
+    fn()
+    per_key = (time.perf_counter() - start) / number * 1000
+    speedup = '' if baseline is None else '{:6.2f}x'.format(baseline / per_key)
+    print('{:<32} {:8.3f} ms/key {}'.format(label, per_key, speedup))
+    return per_key
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='s3 benchmark')
+    parser.add_argument('-n', '--number', type=int, default=100, help='keys per operation')
+    parser.add_argument('--endpoint-url', help='an S3 compatible server, default a local moto server')
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    # read by botocore, so the shared client uses it too
+    os.environ['AWS_ENDPOINT_URL'] = args.endpoint_url or start_server()
+
+    from contrivers import utils
+    utils.asset_cache.directory = None
+    boto3.client('s3').create_bucket(Bucket=BUCKET)
+    keys = ['benchmark/{}.md'.format(i) for i in range(args.number)]
+    body = b'# Masthead\n\n' + b'text ' * 200
+
+    print('{} keys of {} bytes'.format(args.number, len(body)))
+
+    def put_per_call():
+        for key in keys:
+            boto3.client('s3').put_object(Bucket=BUCKET, Key=key, Body=body)
+
+    def put_shared():
+        for key in keys:
+            utils.asave(key, BUCKET, body)
+
+    baseline = timed('put, client per call', put_per_call, args.number)
+    timed('put, shared client', put_shared, args.number, baseline)
+    timed('asave_many', lambda: utils.asave_many(
+        dict((key, body) for key in keys), BUCKET), args.number, baseline)
+
+    def get_per_call():
+        for key in keys:
+            boto3.client('s3').get_object(Bucket=BUCKET, Key=key)['Body'].read()
+
+    def get_shared():
+        for key in keys:
+            utils.aopen.__wrapped__(key, BUCKET)
+
+    def get_many():
+        utils.aopen.cache_clear()
+        utils.aopen_many(keys, BUCKET)
+
+    baseline = timed('get, client per call', get_per_call, args.number)
+    timed('get, shared client', get_shared, args.number, baseline)
+    timed('aopen_many', get_many, args.number, baseline)
+
+    def remove_per_call():
+        for key in keys:
+            boto3.client('s3').delete_object(Bucket=BUCKET, Key=key)
+
+    baseline = timed('remove, client per call', remove_per_call, args.number)
+    utils.asave_many(dict((key, body) for key in keys), BUCKET)
+    timed('aremove_many', lambda: utils.aremove_many(keys, BUCKET), args.number, baseline)
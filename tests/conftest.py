@@ -19,7 +19,8 @@ from flask import templating, url_for
 import jinja2
 from sqlalchemy.engine.url import make_url
 from contrivers import create_app
-from contrivers.models import Article, Author, Tag, Book, Review
+from contrivers.caching import FragmentCacheExtension
+from contrivers.models import Article, Author, Tag, Book, Review, Reading
 
 
 DATABASE_URL = make_url(os.environ.get("DATABASE_URL"))
@@ -52,8 +53,9 @@ def jinja_env(mocker):
     """ Return a mocked jinja environment with our custom globals and filters"""
     env = jinja2.Environment(
         loader=jinja2.FileSystemLoader('contrivers/templates'),
-        extensions=['jinja2.ext.with_'])
+        extensions=['jinja2.ext.with_', FragmentCacheExtension])
     env.filters['md'] = lambda x: x
+    env.filters['html'] = lambda obj, attr: getattr(obj, attr)
     env.globals['url_for'] = mocker.MagicMock(url_for)
     return env
 
@@ -189,6 +191,17 @@ class Fixtures(object):
             tags=[random.choice(self.tags())],
             responses=[])
 
+    def reading(self):
+        return Reading(
+            title='Test Reading',
+            publish_date=datetime.datetime.utcnow(),
+            text=uopen(self.path_to_data_files('markdown.md')),
+            abstract='A test [markdown file](http://www.google.com) with a very short description',
+            hidden=False,
+            featured=False,
+            authors=[self.author()],
+            tags=[random.choice(self.tags())])
+
     def articles(self, num, authors=None):
         if self._articles is None:
             self._articles = []
@@ -28,5 +28,72 @@ def test_cache(mocker):
     assert identity('blarg') == 'blarg'
     assert identity.called == 1
 
-    # TODO: refactor cache to expose the actual cache dictionary
-    # assert cache  == {expected_key: expected_value}
+    assert Identity.__call__.cache_info().hits >= 1
+
+
+def counted(**options):
+    calls = []
+
+    @cache(**options)
+    def fetch(key, bucket='assets'):
+        calls.append(key)
+        return key.upper()
+
+    return fetch, calls
+
+
+def test_equivalent_calls_share_a_key():
+    fetch, calls = counted()
+    fetch('a')
+    fetch('a', 'assets')
+    fetch(key='a', bucket='assets')
+    assert calls == ['a']
+
+
+def test_least_recently_used_is_evicted():
+    fetch, calls = counted(maxsize=2)
+    fetch('a')
+    fetch('b')
+    fetch('a')
+    fetch('c')
+    fetch('a')
+    fetch('b')
+    assert calls == ['a', 'b', 'c', 'b']
+    assert fetch.cache_info().currsize == 2
+
+
+def test_entries_expire(mocker):
+    clock = mocker.patch('contrivers.utils.time.monotonic', return_value=100)
+    fetch, calls = counted(ttl=10)
+    fetch('a')
+    clock.return_value = 105
+    fetch('a')
+    clock.return_value = 111
+    fetch('a')
+    assert calls == ['a', 'a']
+
+
+def test_invalidate_and_clear():
+    fetch, calls = counted()
+    fetch('a')
+    fetch('b')
+    assert fetch.invalidate('a', bucket='assets')
+    assert not fetch.invalidate('a')
+    fetch('a')
+    fetch('b')
+    assert calls == ['a', 'b', 'a']
+    assert fetch.cache_info() == (1, 3, 128, 2)
+    fetch.cache_clear()
+    assert fetch.cache_info() == (0, 0, 128, 0)
+
+
+def test_unhashable_arguments_are_not_cached():
+    calls = []
+
+    @cache
+    def length(items):
+        calls.append(items)
+        return len(items)
+
+    assert length([1, 2]) == length([1, 2]) == 2
+    assert len(calls) == 2
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_conditional
+
+    Tests for ETag / Last-Modified validators and 304 responses
+"""
+
+import datetime
+import pytest
+from flask import Flask, abort
+from pytz import utc
+from contrivers.www.conditional import conditional
+
+
+EDITED = datetime.datetime(2020, 5, 17, 12, 30, 15, 250000, tzinfo=utc)
+
+
+@pytest.fixture
+def cond_app():
+    app = Flask(__name__)
+    app.calls = 0
+    app.freshness = (EDITED, 3)
+
+    @app.route('/page/', methods=('GET', 'POST'))
+    @conditional(lambda **kwargs: app.freshness)
+    def page():
+        app.calls += 1
+        return u'page'
+
+    @app.route('/missing/')
+    @conditional(lambda **kwargs: app.freshness)
+    def missing():
+        abort(404)
+
+    return app
+
+
+def test_sends_validators(cond_app):
+    resp = cond_app.test_client().get('/page/')
+    assert resp.status_code == 200
+    etag, weak = resp.get_etag()
+    assert etag and weak
+    assert resp.last_modified == EDITED.replace(microsecond=0)
+
+
+def test_matching_etag_is_not_modified(cond_app):
+    client = cond_app.test_client()
+    etag = client.get('/page/').headers['ETag']
+    resp = client.get('/page/', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert resp.data == b''
+    assert resp.headers['ETag'] == etag
+    assert cond_app.calls == 1
+
+
+def test_if_modified_since(cond_app):
+    client = cond_app.test_client()
+    last_modified = client.get('/page/').headers['Last-Modified']
+    resp = client.get('/page/', headers={'If-Modified-Since': last_modified})
+    assert resp.status_code == 304
+    assert cond_app.calls == 1
+
+
+def test_edit_changes_etag(cond_app):
+    client = cond_app.test_client()
+    etag = client.get('/page/').headers['ETag']
+    cond_app.freshness = (EDITED + datetime.timedelta(seconds=5), 3)
+    resp = client.get('/page/', headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.headers['ETag'] != etag
+
+
+def test_delete_changes_etag(cond_app):
+    client = cond_app.test_client()
+    etag = client.get('/page/').headers['ETag']
+    cond_app.freshness = (EDITED, 2)
+    assert client.get('/page/', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_etag_depends_on_query_string(cond_app):
+    client = cond_app.test_client()
+    assert client.get('/page/').headers['ETag'] != \
+        client.get('/page/?p=2').headers['ETag']
+
+
+def test_no_rows_no_validators(cond_app):
+    cond_app.freshness = (None, 0)
+    resp = cond_app.test_client().get('/page/')
+    assert resp.status_code == 200
+    assert 'ETag' not in resp.headers
+
+
+def test_errors_have_no_validators(cond_app):
+    resp = cond_app.test_client().get('/missing/')
+    assert resp.status_code == 404
+    assert 'ETag' not in resp.headers
+
+
+def test_post_is_unconditional(cond_app):
+    resp = cond_app.test_client().post('/page/', headers={'If-None-Match': '*'})
+    assert resp.status_code == 200
+    assert 'ETag' not in resp.headers
+
+
+def test_article_not_modified_until_edited(client, data):
+    article = data.article()
+    data.add_and_commit(article)
+    url = '/articles/{}/'.format(article.id)
+    etag = client.get(url).headers['ETag']
+    with client.get(url, headers={'If-None-Match': etag}) as resp:
+        assert resp.status_code == 304
+    article.title = u'An Edited Title'
+    data.add_and_commit(article)
+    with client.get(url, headers={'If-None-Match': etag}) as resp:
+        assert resp.status_code == 200
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_contrive
+
+    Tests for the contrive command line tool
+"""
+
+import pytest
+from click.testing import CliRunner
+from contrivers.models import Article
+
+contrive = pytest.importorskip('contrive')
+
+
+MARKDOWN = u"""---
+type: article
+title: A Test Article
+authors:
+    - name: Écrivain Anonyme
+      email: ecrivain@example.com
+tags:
+    - Essay
+---
+Some *text*, with an accent: café.
+"""
+
+
+def test_add(app, tmpdir):
+    path = tmpdir.join('article.md')
+    path.write_text(MARKDOWN, encoding='utf-8')
+    db = app.extensions.get('sqlalchemy').db
+    result = CliRunner().invoke(
+        contrive.add, [str(path), '--no-confirm'], obj={'app': app, 'db': db})
+    assert result.exit_code == 0, result.output
+    article = Article.query.filter_by(title=u'A Test Article').one()
+    assert article.text.strip() == u'Some *text*, with an accent: café.'
+    assert u'<em>text</em>' in article.text_html
+    assert article.authors[0].name == u'Écrivain Anonyme'
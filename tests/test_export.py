@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_export
+
+    Tests for the static export of the public site
+"""
+
+import os
+import json
+import pytest
+from flask import Response
+from contrivers.export import (Page, MANIFEST, export_site, file_name,
+                               is_current, read_manifest, write_manifest)
+
+
+@pytest.mark.parametrize('path,mimetype,expected', [
+    ('/', 'text/html', 'index.html'),
+    ('/articles/1/a-title/', 'text/html', 'articles/1/a-title/index.html'),
+    ('/rss/', 'application/rss+xml', 'rss/index.xml'),
+    ('/sitemap.xml', 'application/xml', 'sitemap.xml'),
+    ('/favicon.ico', 'image/x-icon', 'favicon.ico'),
+])
+def test_file_name(path, mimetype, expected):
+    assert file_name(path, Response(mimetype=mimetype)) == expected
+
+
+def test_feeds_sent_as_html_are_xml():
+    feed = Response(u'<?xml version="1.0"?><rss></rss>')
+    assert file_name('/rss/', feed) == 'rss/index.xml'
+
+
+def test_manifest_round_trip(tmpdir):
+    assert read_manifest(str(tmpdir)) == {}
+    manifest = {'/': {'fingerprint': 'a', 'files': ['index.html']}}
+    write_manifest(str(tmpdir), manifest)
+    assert read_manifest(str(tmpdir)) == manifest
+
+
+def test_is_current(tmpdir):
+    tmpdir.join('index.html').write('')
+    entry = {'fingerprint': 'a', 'files': ['index.html']}
+    assert is_current(Page('/', '/', 'www.index', 'a'), entry, str(tmpdir))
+    assert not is_current(Page('/', '/', 'www.index', 'b'), entry, str(tmpdir))
+    # pages without freshness are always rendered
+    assert not is_current(Page('/', '/', 'www.index', None), entry, str(tmpdir))
+    tmpdir.join('index.html').remove()
+    assert not is_current(Page('/', '/', 'www.index', 'a'), entry, str(tmpdir))
+
+
+def exported(app, tmpdir, **kwargs):
+    return export_site(app, str(tmpdir), processes=1, **kwargs)
+
+
+def test_export_writes_pages_and_manifest(app, data, tmpdir):
+    article = data.article()
+    data.add_and_commit(article)
+    exported(app, tmpdir)
+    with app.test_request_context():
+        path = article.url().split('localhost', 1)[1]
+    assert tmpdir.join('index.html').check()
+    assert tmpdir.join('sitemap.xml').check()
+    assert tmpdir.join(path.lstrip('/'), 'index.html').check()
+    manifest = json.loads(tmpdir.join(MANIFEST).read())
+    assert manifest[path]['fingerprint']
+
+
+def test_second_export_only_renders_edited_pages(app, data, tmpdir):
+    article, other = data.article(), data.article()
+    # authors are unique by email
+    other.authors = article.authors
+    data.add_all_and_commit([article, other])
+    first = exported(app, tmpdir)
+    assert first.rendered > 0 and first.kept == 0
+    article.title = u'An Edited Title'
+    data.add_and_commit(article)
+    rendered = []
+    second = exported(app, tmpdir, progress=rendered.append)
+    with app.test_request_context():
+        assert article.url().split('localhost', 1)[1] in rendered
+        assert other.url().split('localhost', 1)[1] not in rendered
+    assert second.kept > 0
+
+
+def test_hidden_writing_is_removed(app, data, tmpdir):
+    article = data.article()
+    data.add_and_commit(article)
+    exported(app, tmpdir)
+    with app.test_request_context():
+        path = article.url().split('localhost', 1)[1]
+    article.hidden = True
+    data.add_and_commit(article)
+    assert exported(app, tmpdir).removed >= 1
+    assert not os.path.exists(os.path.join(str(tmpdir), path.lstrip('/'), 'index.html'))
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_fragment_cache
+
+    Tests for the {% cache %} template tag
+"""
+
+import datetime
+import pytest
+import jinja2
+from contrivers.caching import FragmentCacheExtension, SimpleCache
+
+
+class MockModel(object):
+    """ Looks enough like a saved model to build a fragment key """
+    __table__ = None
+
+    def __init__(self, id=1, last_edited_date=datetime.datetime(2020, 1, 1), **kwargs):
+        self.id = id
+        self.last_edited_date = last_edited_date
+        self.renders = 0
+        for kw in kwargs:
+            setattr(self, kw, kwargs[kw])
+
+    def render(self):
+        self.renders += 1
+        return u'<b>rendered</b>'
+
+
+@pytest.fixture
+def env():
+    _env = jinja2.Environment(extensions=[FragmentCacheExtension], autoescape=True)
+    _env.fragment_cache = SimpleCache()
+    return _env
+
+
+TEMPLATE = u"{% cache obj, flag %}{{ obj.render() | safe }}<i>{{ flag }}</i>{% endcache %}"
+
+
+def test_body_is_cached(env):
+    obj = MockModel()
+    template = env.from_string(TEMPLATE)
+    first = template.render(obj=obj, flag=True)
+    second = template.render(obj=obj, flag=True)
+    assert first == second == u'<b>rendered</b><i>True</i>'
+    assert obj.renders == 1
+
+
+def test_cached_html_is_not_escaped_again(env):
+    obj = MockModel()
+    template = env.from_string(u"{{ '<p>' }}" + TEMPLATE)
+    template.render(obj=obj, flag='<')
+    assert template.render(obj=obj, flag='<') == \
+        u'&lt;p&gt;<b>rendered</b><i>&lt;</i>'
+
+
+def test_key_follows_arguments(env):
+    obj = MockModel()
+    template = env.from_string(TEMPLATE)
+    template.render(obj=obj, flag=True)
+    template.render(obj=obj, flag=False)
+    assert obj.renders == 2
+
+
+def test_edit_changes_key(env):
+    obj = MockModel()
+    template = env.from_string(TEMPLATE)
+    template.render(obj=obj, flag=True)
+    obj.last_edited_date = datetime.datetime(2020, 1, 2)
+    template.render(obj=obj, flag=True)
+    assert obj.renders == 2
+
+
+def test_edit_of_related_model_changes_key(env):
+    author = MockModel()
+    obj = MockModel(authors=[author])
+    template = env.from_string(
+        u"{% cache obj, obj.authors %}{{ obj.render() }}{% endcache %}")
+    template.render(obj=obj)
+    author.last_edited_date = datetime.datetime(2020, 1, 2)
+    template.render(obj=obj)
+    assert obj.renders == 2
+
+
+def test_template_edit_changes_key(env):
+    obj = MockModel()
+    env.loader = jinja2.DictLoader({'macros.html': TEMPLATE})
+    assert env.get_template('macros.html').render(obj=obj, flag=True) == \
+        u'<b>rendered</b><i>True</i>'
+    # a deploy changes the template, but not the line of the tag
+    env.loader = jinja2.DictLoader({'macros.html': TEMPLATE.replace(u'i>', u'em>')})
+    env.cache.clear()
+    assert env.get_template('macros.html').render(obj=obj, flag=True) == \
+        u'<b>rendered</b><em>True</em>'
+
+
+def test_unsaved_models_are_not_cached(env):
+    obj = MockModel(id=None)
+    template = env.from_string(TEMPLATE)
+    template.render(obj=obj, flag=True)
+    template.render(obj=obj, flag=True)
+    assert obj.renders == 2
+
+
+def test_blocks_do_not_share_keys(env):
+    obj = MockModel()
+    template = env.from_string(
+        u"{% cache obj %}one{% endcache %} {% cache obj %}two{% endcache %}")
+    assert template.render(obj=obj) == u'one two'
+
+
+def test_disabled_without_a_backend():
+    env = jinja2.Environment(extensions=[FragmentCacheExtension])
+    obj = MockModel()
+    template = env.from_string(TEMPLATE)
+    template.render(obj=obj, flag=True)
+    template.render(obj=obj, flag=True)
+    assert obj.renders == 2
+
+
+def test_article_block_is_shared_between_pages(jinja_env):
+    jinja_env.fragment_cache = SimpleCache()
+    article = MockModel(
+        title=u'Title', publish_date=datetime.datetime(2020, 1, 1),
+        featured=False, hidden=False, abstract=u'abstract', authors=[], tags=[],
+        make_url=lambda: u'/articles/1/')
+    titles = []
+    index = jinja_env.from_string(
+        u"{% from 'macros.html' import render_article %}"
+        u"<h1>Index</h1>{{ render_article(article) }}")
+    archive = jinja_env.from_string(
+        u"{% from 'macros.html' import render_article %}"
+        u"<h1>Archive</h1>{{ render_article(article) }}")
+    first = index.render(article=article)
+    article.title = u'Changed, but the fragment is cached'
+    second = archive.render(article=article)
+    assert first.split(u'</h1>')[1] == second.split(u'</h1>')[1]
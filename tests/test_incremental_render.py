@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_incremental_render
+
+    Block by block rendering must match converting the whole document
+"""
+
+import os
+import random
+import pytest
+from contrivers import rendering
+from contrivers.rendering import (RenderCache, get_backend, markdown_factory,
+                                  render, render_blocks)
+
+
+DOCUMENTS = {
+    'footnotes': (
+        u'Paragraph with a note[^a] and another[^b].\n\n'
+        u'[^b]: Note B.\n\n'
+        u'    Second paragraph of B.\n\n'
+        u'> quoted[^c]\n\n'
+        u'[^a]: Note A with *emphasis*.\n\n'
+        u'[^c]: Note C.'),
+    'repeated_footnotes': (
+        u'> more quote[^b]\n\n'
+        u'Again[^b] repeated[^b].\n\n'
+        u'[^b]: Note B.'),
+    'loose_lists': (
+        u'- loose item\n\n'
+        u'[c]: http://www.contrivers.org\n\n'
+        u'1. first\n2. second\n\n'
+        u'    indented code'),
+    'raw_html': (
+        u'<div class="x">\nopen\n\nstill open\n</div>\n\n'
+        u'    indented code\n\n'
+        u'<div class="epigraph">An epigraph.</div>\n\n'
+        u'Trailing <span>inline</span> html'),
+    'links': (
+        u'Link to [Contrivers][c] and [home].\n\n'
+        u'| a | b |\n|:--|--:|\n| 1 | 2 |\n\n'
+        u'[c]: http://www.contrivers.org\n'
+        u'[home]: http://example.com "Home"'),
+    'wrapped_link_labels': (
+        u'A reference to [my\nlabel] and to [Other   Label][].\n\n'
+        u'[my label]: http://www.contrivers.org\n'
+        u'[other label]: http://example.com'),
+    'repeated_blank_lines': (
+        u'<pre>x\n\n\ny</pre>\n\n\n'
+        u'- item one\n\n\n    continued after two blank lines\n\n'
+        u'A note[^a].\n\n'
+        u'[^a]: Note A.\n\n'
+        u'[^a]: Note A again.'),
+    'html_comments': (
+        u'Intro.\n\n'
+        u'<!--\na comment\n\nspanning paragraphs\n-->\n\n'
+        u'<!-- one line -->\n\n'
+        u'Text <!-- inline\n\nspanning --> end.\n\n'
+        u'After.'),
+}
+
+
+# pieces of random documents, joined by runs of blank lines
+PIECES = [
+    lambda r: u'A paragraph with *emphasis* and a note[^{}].'.format(r.choice('abc')),
+    lambda r: u'Plain paragraph {}.'.format(r.randint(0, 9)),
+    lambda r: u'Link to [Contrivers][c] and [my\nlabel].',
+    lambda r: u'- item one\n- item two',
+    lambda r: u'1. first\n2. second',
+    lambda r: u'    indented code',
+    lambda r: u'> a quote',
+    lambda r: u'[^{}]: Note {}.'.format(r.choice('abc'), r.randint(0, 9)),
+    lambda r: u'[c]: http://www.contrivers.org',
+    lambda r: u'[my label]: http://example.com',
+    lambda r: u'<pre>x' + u'\n' * r.randint(1, 4) + u'y</pre>',
+    lambda r: u'<div class="x">\nopen' + u'\n' * r.randint(1, 3) + u'still open\n</div>',
+    lambda r: u'<!--\ncomment' + u'\n' * r.randint(1, 3) + u'more\n-->',
+    lambda r: u'| a | b |\n|:--|--:|\n| 1 | 2 |',
+    lambda r: u'Text <!-- inline' + u'\n' * r.randint(1, 3) + u'spanning --> end.',
+]
+
+
+def random_document(seed):
+    r = random.Random(seed)
+    parts = [r.choice(PIECES)(r) for _ in range(r.randint(2, 10))]
+    text = parts[0]
+    for part in parts[1:]:
+        # blank lines, sometimes holding spaces or a tab
+        text += u'\n' * r.randint(1, 4) + r.choice([u'', u'  \n', u'\t\n']) + part
+    return text
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    _cache = RenderCache()
+    monkeypatch.setattr(rendering, 'render_cache', _cache)
+    return _cache
+
+
+@pytest.mark.parametrize('name', sorted(DOCUMENTS))
+def test_matches_full_render(cache, name):
+    text = DOCUMENTS[name]
+    assert render_blocks(text, get_backend()) == markdown_factory().convert(text)
+
+
+@pytest.mark.parametrize('first', range(0, 1000, 200))
+def test_random_documents_match_full_render(monkeypatch, first):
+    for seed in range(first, first + 200):
+        monkeypatch.setattr(rendering, 'render_cache', RenderCache())
+        text = random_document(seed)
+        assert render_blocks(text, get_backend()) == \
+            markdown_factory().convert(text), 'seed {}'.format(seed)
+
+
+def test_matches_markdown_fixture(cache):
+    path = os.path.join(os.path.dirname(__file__), 'markdown.md')
+    with open(path) as f:
+        text = f.read()
+    assert render_blocks(text, get_backend()) == markdown_factory().convert(text)
+
+
+def test_edit_rerenders_changed_block(cache, mocker):
+    paragraphs = [u'Paragraph number {} with a *bit* of text.'.format(i)
+                  for i in range(20)]
+    render_blocks(u'\n\n'.join(paragraphs), get_backend())
+
+    spy = mocker.spy(get_backend(), 'convert')
+    paragraphs[7] = u'An edited paragraph.'
+    text = u'\n\n'.join(paragraphs)
+    assert render_blocks(text, get_backend()) == markdown_factory().convert(text)
+    assert spy.call_count == 1
+
+
+def test_long_documents_render_incrementally(cache, mocker, monkeypatch):
+    monkeypatch.setattr(rendering, 'INCREMENTAL_MIN_LENGTH', 0)
+    spy = mocker.spy(rendering, 'render_blocks')
+    text = DOCUMENTS['footnotes']
+    assert render(text) == markdown_factory().convert(text)
+    assert spy.call_count == 1
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_invalidation
+
+    Tests for the LISTEN/NOTIFY invalidation bus
+"""
+
+import os
+import json
+import threading
+import pytest
+from sqlalchemy import Column, Integer, String, create_engine, text
+from sqlalchemy.orm import declarative_base, sessionmaker
+from contrivers.caching import QueryCache, ResponseCache, SimpleCache, TieredCache
+from contrivers.ext import db
+from contrivers.invalidation import MAX_PAYLOAD, InvalidationBus, payloads
+
+
+Base = declarative_base()
+
+
+class Item(Base):
+    __tablename__ = 'items'
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+
+
+@pytest.fixture
+def session():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+
+@pytest.fixture
+def bus(session, mocker):
+    bus = InvalidationBus()
+    ResponseCache().watch(session, (Item,))
+    QueryCache().watch(session)
+    bus.watch(session)
+    mocker.patch.object(bus, 'publish')
+    return bus
+
+
+def test_payloads_fit_a_notify():
+    keys = set('item:{}'.format(n) for n in range(2000))
+    messages = payloads(keys, ['items'])
+    assert len(messages) > 1
+    assert all(len(message) <= MAX_PAYLOAD for message in messages)
+    decoded = [json.loads(message) for message in messages]
+    assert set(key for message in decoded for key in message['keys']) == keys
+    assert decoded[-1]['tables'] == ['items']
+
+
+def test_commit_is_published(session, bus):
+    session.add(Item(id=1, name='a'))
+    session.commit()
+    engine, keys, tables = bus.publish.call_args[0]
+    assert engine is session.get_bind()
+    assert keys == set(['item:1', 'item'])
+    assert tables == set(['items'])
+
+
+def test_commit_is_published_after_the_purge(session, mocker):
+    calls = mocker.Mock()
+    mocker.patch.object(ResponseCache, 'purge', calls.purge)
+    mocker.patch.object(QueryCache, 'bump', calls.bump)
+    bus = InvalidationBus()
+    ResponseCache().watch(session, (Item,))
+    QueryCache().watch(session)
+    bus.watch(session)
+    mocker.patch.object(bus, 'publish', calls.publish)
+    session.add(Item(id=1, name='a'))
+    session.commit()
+    assert [call[0] for call in calls.mock_calls] == ['purge', 'bump', 'publish']
+
+
+def test_rollback_is_not_published(session, bus):
+    session.add(Item(id=1, name='a'))
+    session.flush()
+    session.rollback()
+    session.commit()
+    assert not bus.publish.called
+
+
+def test_handlers_are_called_despite_failures():
+    bus = InvalidationBus()
+    received = []
+
+    @bus.subscribe
+    def broken(keys, tables):
+        raise RuntimeError
+
+    bus.subscribe(lambda keys, tables: received.append((keys, tables)))
+    bus.dispatch(json.dumps({'keys': ['item:1'], 'tables': ['items']}))
+    bus.dispatch('not json')
+    assert received == [(set(['item:1']), set(['items']))]
+
+
+def test_forget_drops_copies_of_a_shared_tier():
+    front, back = SimpleCache(), SimpleCache()
+    cache = TieredCache([front, back])
+    back.set('/a/', u'filled')
+    cache.get('/a/')
+    cache.set('/b/', u'set here')
+    cache.tag('/b/', ['item:2'])
+    cache.set('/c/', u'other')
+    cache.tag('/c/', ['item:3'])
+    cache.set('gen:items', u'1')
+    cache.forget(tags=['item:2'], keys=['gen:items'])
+    assert front.get('/a/') is None
+    assert front.get('/b/') is None
+    assert front.get('/c/') == u'other'
+    assert front.get('gen:items') is None
+    assert back.get('gen:items') == u'1'
+
+
+@pytest.mark.skipif(
+    not os.environ.get('DATABASE_URL', '').startswith('postgres'),
+    reason='LISTEN/NOTIFY needs postgres')
+def test_commit_reaches_the_listener(app):
+    bus = InvalidationBus()
+    bus.enabled = True
+    received = threading.Event()
+    bus.subscribe(lambda keys, tables: received.set())
+    bus.start(db.engine)
+    try:
+        # the listener needs a moment to connect
+        for _ in range(10):
+            bus.publish(db.engine, ['item:1'], ['items'])
+            if received.wait(0.5):
+                break
+        assert received.is_set()
+    finally:
+        bus.stop()
+
+
+def test_announce_needs_an_app(mocker):
+    bus = InvalidationBus()
+    mocker.patch.object(bus, 'publish')
+    bus.announce(set(['asset:assets/masthead.md']))
+    assert not bus.publish.called
@@ -6,3 +6,30 @@ def test_env_has_md_filter(app):
     """the jinja env should have a function called `md`"""
     env = app.jinja_env
     assert 'md' in env.filters
+
+def test_bytecode_cache_dir(tmpdir, test_config):
+    from contrivers import create_app
+    cache_dir = str(tmpdir.join('jinja'))
+    config_vars = dict(test_config, TEMPLATE_CACHE=True, TEMPLATE_CACHE_DIR=cache_dir)
+    _app = create_app('contrivers-unittests', testing=True,
+                      additional_config_vars=config_vars)
+    _app.jinja_env.get_template('layout.html')
+    assert tmpdir.join('jinja').listdir()
+    assert tmpdir.join('jinja').stat().mode & 0o777 == 0o700
+
+def test_bytecode_cache_dir_writable_by_others_is_refused(tmpdir):
+    from contrivers import private_directory
+    cache_dir = tmpdir.mkdir('jinja')
+    cache_dir.chmod(0o777)
+    with pytest.raises(RuntimeError):
+        private_directory(str(cache_dir))
+
+def test_preload_templates(test_config, mocker):
+    from contrivers import create_app
+    config_vars = dict(test_config, PRELOAD_TEMPLATES=True)
+    _app = create_app('contrivers-unittests', testing=True,
+                      additional_config_vars=config_vars)
+    # the templates are served from the environment's cache, not the loader
+    mocker.patch.object(_app.jinja_env.loader, 'get_source', side_effect=AssertionError)
+    for name in ('layout.html', 'macros.html', 'article.html'):
+        assert _app.jinja_env.get_template(name)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_list_queries
+
+    Lists of writing load their authors and tags with the rows, so the
+    number of queries doesn't grow with the list
+"""
+
+import datetime
+import pytest
+from sqlalchemy import event, text
+from contrivers.ext import db
+from contrivers.models import Article
+
+
+@pytest.fixture
+def statements(app):
+    engine = db.engine
+    executed = []
+
+    def count(conn, cursor, statement, *args):
+        executed.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', count)
+    yield executed
+    event.remove(engine, 'before_cursor_execute', count)
+
+
+def add_articles(data, start, stop):
+    authors, tags = data.authors(3), data.tags()
+    data.add_all_and_commit([
+        Article(
+            title=u'Test Article {}'.format(n),
+            publish_date=datetime.datetime.utcnow() - datetime.timedelta(days=n),
+            text=u'Some *text*',
+            abstract=u'An abstract',
+            hidden=False,
+            featured=n % 2 == 0,
+            authors=[authors[n % 3]],
+            tags=[tags[n % 3]])
+        for n in range(start, stop)])
+
+
+def count_queries(client, statements, path):
+    del statements[:]
+    with client.get(path) as resp:
+        assert resp.status_code == 200
+    return len(statements)
+
+
+@pytest.mark.parametrize('path', [
+    '/',
+    '/rss/',
+    '/articles/',
+    '/articles/rss/',
+    '/articles/featured/',
+    '/articles/featured/rss/',
+    '/archive/',
+    '/archive/rss/',
+])
+def test_queries_do_not_grow_with_the_list(client, data, statements, path):
+    add_articles(data, 0, 2)
+    short = count_queries(client, statements, path)
+    add_articles(data, 2, 12)
+    assert count_queries(client, statements, path) == short
+
+
+def index_for_search(data):
+    """ Fill in the search column, as the trigger of a migrated database
+    does """
+    data.db.session.execute(text(
+        "UPDATE writing SET tsvector = to_tsvector('english', title)"))
+    data.db.session.commit()
+
+
+def test_search_queries_do_not_grow_with_the_results(client, data, statements):
+    add_articles(data, 0, 2)
+    index_for_search(data)
+    short = count_queries(client, statements, '/search/?q=article')
+    add_articles(data, 2, 12)
+    index_for_search(data)
+    assert count_queries(client, statements, '/search/?q=article') == short
+    with client.get('/search/?q=article') as resp:
+        assert b'Test Article 11' in resp.data
+
+
+def test_loaders_are_configured(app, client, data, statements):
+    app.config['LIST_LOADERS'] = {'authors': 'lazy', 'tags': 'lazy'}
+    add_articles(data, 0, 2)
+    short = count_queries(client, statements, '/archive/')
+    add_articles(data, 2, 12)
+    assert count_queries(client, statements, '/archive/') > short
+
+
+@pytest.mark.parametrize('path', ['/rss/', '/archive/', '/sitemap.xml'])
+def test_lists_query_the_writing_table_alone(client, data, statements, path):
+    add_articles(data, 0, 2)
+    count_queries(client, statements, path)
+    assert not any(' articles' in statement or ' reviews' in statement
+                   for statement in statements)
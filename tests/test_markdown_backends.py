@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_markdown_backends
+
+    The commonmark backend should be a drop-in replacement for
+    Python-Markdown for the extensions we use.
+"""
+
+import os
+import threading
+from html import unescape
+import pytest
+from lxml import html as lxml_html
+from contrivers.rendering import get_backend, PythonMarkdownBackend
+
+pytest.importorskip('markdown_it')
+pytest.importorskip('mdit_py_plugins')
+
+fixtures = {
+    'footnotes': u'\n'.join([
+        u'Some text[^note] and again[^note], then another[^2].',
+        u'',
+        u'[^note]: The first note.',
+        u'[^2]: The *second* note.',
+    ]),
+    'smarty': u'"Double" and \'single\' quotes -- dashes --- and an ellipsis...',
+    'tables': u'\n'.join([
+        u'| Left align | Right align | Center align |',
+        u'|:-----------|------------:|:------------:|',
+        u'| This       |        This |     This     |',
+        u'| column     |      column |    column    |',
+    ]),
+}
+
+
+def convert(name, txt):
+    return unescape(get_backend(name=name).convert(txt))
+
+
+@pytest.mark.parametrize('feature', sorted(fixtures))
+def test_backends_agree(feature):
+    txt = fixtures[feature]
+    assert convert('commonmark', txt) == convert('python-markdown', txt)
+
+
+@pytest.mark.parametrize('xpath', [
+    '//table',
+    '//sup',
+    '//div[@class="footnote"]',
+])
+def test_backends_agree_on_test_document(xpath):
+    path = os.path.join(os.path.dirname(__file__), 'markdown.md')
+    with open(path, encoding='utf-8') as f:
+        txt = f.read()
+
+    def fragments(name):
+        tree = lxml_html.fromstring(convert(name, txt))
+        return [lxml_html.tostring(el, encoding='unicode') for el in tree.xpath(xpath)]
+
+    expected = fragments('python-markdown')
+    assert expected
+    assert fragments('commonmark') == expected
+
+
+def test_pooled_converters_do_not_leak_state():
+    """ reset() must clear footnotes between documents """
+    backend = PythonMarkdownBackend()
+    backend.convert(fixtures['footnotes'])
+    assert 'footnote' not in backend.convert(u'No notes here.')
+
+
+def test_pool_is_per_thread():
+    backend = PythonMarkdownBackend()
+    results = []
+
+    def worker():
+        results.append(backend.convert(fixtures['tables']))
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(results)) == 1
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_middleware
+
+    Tests for the micro cache in front of the app
+"""
+
+import time
+import pytest
+from flask import Flask, Response, request, stream_with_context
+from contrivers import configure_middleware
+from contrivers.middleware import MicroCache
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.calls = 0
+
+    @app.before_request
+    def count():
+        app.calls += 1
+
+    @app.route('/', methods=['GET', 'POST'])
+    def index():
+        return u'page {}'.format(request.args.get('page', 1))
+
+    @app.route('/cookie/')
+    def cookie():
+        response = Response(u'page')
+        response.set_cookie('seen', '1')
+        return response
+
+    @app.route('/private/')
+    def private():
+        return Response(u'page', headers={'Cache-Control': 'private'})
+
+    @app.route('/streamed/')
+    def streamed():
+        return Response(stream_with_context(iter([u'one ', u'two'])))
+
+    app.wsgi_app = MicroCache(app.wsgi_app, ttl=2)
+    return app
+
+
+@pytest.fixture
+def client(app):
+    # buffered, so the body is closed as a server would close it, and
+    # without a cookie jar, so that cookies can be sent by hand
+    client = app.test_client(use_cookies=False)
+    return lambda path, method='GET', **kwargs: client.open(
+        path, method=method, buffered=True, **kwargs)
+
+
+def test_repeated_gets_are_served_from_the_cache(app, client):
+    assert client('/').data == b'page 1'
+    assert client('/').data == b'page 1'
+    assert app.calls == 1
+    stats = app.wsgi_app.stats()
+    assert (stats['hit'], stats['miss'], stats['bytes_served']) == (1, 1, 6)
+    assert stats['hit_ratio'] == 0.5
+
+
+def test_entries_expire(app, client, monkeypatch):
+    client('/')
+    now = time.monotonic()
+    monkeypatch.setattr(time, 'monotonic', lambda: now + 3)
+    client('/')
+    assert app.calls == 2
+
+
+def test_query_string_is_part_of_the_key(app, client):
+    client('/?page=2')
+    assert client('/').data == b'page 1'
+    assert app.calls == 2
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'method': 'POST'},
+    {'headers': {'Cookie': 'session=abc'}},
+    {'headers': {'If-None-Match': '"abc"'}},
+])
+def test_bypass(app, client, kwargs):
+    client('/')
+    client('/', **kwargs)
+    assert app.calls == 2
+    assert app.wsgi_app.stats()['bypass'] == 1
+
+
+@pytest.mark.parametrize('path', ['/cookie/', '/private/', '/missing/'])
+def test_responses_that_are_not_kept(app, client, path):
+    client(path)
+    client(path)
+    assert app.calls == 2
+
+
+def test_head_is_answered_from_a_get(app, client):
+    client('/')
+    response = client('/', 'HEAD')
+    assert response.data == b''
+    assert response.headers['Content-Length'] == '6'
+    assert app.calls == 1
+
+
+def test_streamed_body_is_kept_once_sent(app, client):
+    assert client('/streamed/').data == b'one two'
+    assert client('/streamed/').data == b'one two'
+    assert app.calls == 1
+
+
+def test_configure_middleware():
+    app = Flask(__name__)
+    configure_middleware(app)
+    assert not isinstance(app.wsgi_app, MicroCache)
+    app.config['MICRO_CACHE_TTL'] = 2
+    configure_middleware(app)
+    assert isinstance(app.wsgi_app, MicroCache)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_query_cache
+
+    Tests for the query result cache and its table generations
+"""
+
+import pytest
+from flask import Flask
+from sqlalchemy import (Column, ForeignKey, Integer, String, Table,
+                        create_engine, event, func, update)
+from sqlalchemy.orm import (declarative_base, relationship, selectinload,
+                            sessionmaker)
+from werkzeug.exceptions import NotFound
+from contrivers.caching import (NullCache, QueryCache, SimpleCache,
+                                query_tables)
+
+
+Base = declarative_base()
+
+shelf_to_item = Table(
+    'shelf_to_item', Base.metadata,
+    Column('shelf_id', Integer, ForeignKey('shelves.id')),
+    Column('item_id', Integer, ForeignKey('items.id')))
+
+
+class Item(Base):
+    __tablename__ = 'items'
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+
+
+class Shelf(Base):
+    __tablename__ = 'shelves'
+    id = Column(Integer, primary_key=True)
+    items = relationship('Item', secondary=shelf_to_item)
+
+
+@pytest.fixture
+def session():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine)
+    session = factory()
+    session.add_all([Item(id=i, name=name) for i, name in enumerate('cab', 1)])
+    session.commit()
+    return session
+
+
+@pytest.fixture
+def cache(session):
+    cache = QueryCache()
+    cache.backend = SimpleCache()
+    cache.watch(session)
+    return cache
+
+
+def by_name(session):
+    return session.query(Item).order_by(Item.name)
+
+
+def names(items):
+    return [item.name for item in items]
+
+
+def test_query_tables(session):
+    query = session.query(Shelf).join(Shelf.items)
+    assert query_tables(query) == ['items', 'shelf_to_item', 'shelves']
+
+
+def test_results_keep_their_order(session, cache):
+    assert names(cache.all(by_name(session))) == ['a', 'b', 'c']
+    session.expunge_all()
+    assert names(cache.all(by_name(session))) == ['a', 'b', 'c']
+    assert cache.stats()['local_hits'] == 1
+
+
+def test_shared_tier_fills_local_tier(session, cache):
+    cache.all(by_name(session))
+    cache.clear_local()
+    assert names(cache.all(by_name(session))) == ['a', 'b', 'c']
+    assert names(cache.all(by_name(session))) == ['a', 'b', 'c']
+    assert cache.stats() == {'shared_hits': 1, 'local_hits': 1, 'local_entries': 1}
+
+
+def test_commit_retires_results(session, cache):
+    cache.all(by_name(session))
+    session.add(Item(id=4, name='0'))
+    session.commit()
+    assert names(cache.all(by_name(session))) == ['0', 'a', 'b', 'c']
+
+
+def test_commit_to_another_table_keeps_results(session, cache):
+    cache.all(by_name(session))
+    session.add(Shelf(id=1))
+    session.commit()
+    cache.all(by_name(session))
+    assert cache.stats()['local_hits'] == 1
+
+
+def test_another_worker_sees_the_commit(session, cache):
+    """ Workers share the backend, and each has its own local tier """
+    other = QueryCache()
+    other.backend = cache.backend
+    other.all(by_name(session))
+    item = session.get(Item, 1)
+    item.name = 'z'
+    session.commit()
+    assert names(other.all(by_name(session))) == ['a', 'b', 'z']
+
+
+def test_relationship_change_retires_the_secondary_table(session, cache):
+    shelf = Shelf(id=1)
+    session.add(shelf)
+    session.commit()
+    query = session.query(Item).join(shelf_to_item).filter(shelf_to_item.c.shelf_id == 1)
+    assert cache.all(query) == []
+    shelf.items.append(session.get(Item, 2))
+    session.commit()
+    assert names(cache.all(query)) == ['a']
+
+
+def test_bulk_update_retires_results(session, cache):
+    cache.all(by_name(session))
+    session.execute(update(Item).where(Item.id == 1).values(name='z'))
+    session.commit()
+    session.expire_all()
+    assert names(cache.all(by_name(session))) == ['a', 'b', 'z']
+
+
+def test_rollback_keeps_results(session, cache):
+    cache.all(by_name(session))
+    session.add(Item(id=4, name='0'))
+    session.flush()
+    session.rollback()
+    session.commit()
+    cache.all(by_name(session))
+    assert cache.stats()['local_hits'] == 1
+
+
+def test_rows_are_loaded_with_the_query_options(session, cache):
+    items = [session.get(Item, n) for n in (1, 2, 3)]
+    session.add_all([Shelf(id=1, items=items[:2]), Shelf(id=2, items=items[2:])])
+    session.commit()
+    query = session.query(Shelf).options(selectinload(Shelf.items)).order_by(Shelf.id)
+    cache.all(query)
+    session.expunge_all()
+    statements = []
+    event.listen(session.get_bind(), 'before_cursor_execute',
+                 lambda *args: statements.append(args[2]))
+    shelves = cache.all(query)
+    assert [sorted(names(shelf.items)) for shelf in shelves] == [['a', 'c'], ['b']]
+    # the shelves, then their items
+    assert len(statements) == 2
+
+
+def test_paginate(session, cache):
+    page = cache.paginate(by_name(session), page=2, per_page=2)
+    assert names(page.items) == ['c']
+    assert (page.total, page.pages, page.has_prev, page.has_next) == (3, 2, True, False)
+    assert page.prev_num == 1
+    assert names(cache.paginate(by_name(session), page=2, per_page=2).items) == ['c']
+    with pytest.raises(NotFound):
+        cache.paginate(by_name(session), page=3, per_page=2)
+
+
+def test_scalar(session, cache):
+    query = session.query(func.count(Item.id))
+    assert cache.scalar(query) == 3
+    assert cache.scalar(query) == 3
+    assert cache.stats()['local_hits'] == 1
+
+
+def test_generations_are_read_once_per_request(session, cache, mocker):
+    app = Flask(__name__)
+    get_many = mocker.spy(cache.backend, 'get_many')
+    with app.test_request_context():
+        cache.all(by_name(session))
+        cache.all(by_name(session))
+    assert get_many.call_count == 1
+
+
+def test_disabled_without_a_backend(session):
+    cache = QueryCache()
+    assert isinstance(cache.backend, NullCache)
+    assert names(cache.all(by_name(session))) == ['a', 'b', 'c']
+    assert cache.stats() == {'local_entries': 0}
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_render_cache
+
+    Tests for the content-addressed markdown render cache
+"""
+
+import pytest
+from contrivers import rendering
+from contrivers.rendering import RenderCache, get_backend, make_key, render
+
+
+class DictBackend(object):
+    """ a shared backend stand-in """
+
+    def __init__(self):
+        self.store = {}
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.store[key] = value
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    _cache = RenderCache()
+    monkeypatch.setattr(rendering, 'render_cache', _cache)
+    return _cache
+
+
+def test_render_matches_markdown(cache):
+    txt = "# Header One"
+    assert render(txt) == rendering.markdown_factory().convert(txt)
+
+
+def test_second_render_is_a_hit(cache, mocker):
+    spy = mocker.spy(get_backend(), 'convert')
+    render('Some *text*')
+    render('Some *text*')
+    assert spy.call_count == 1
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_key_depends_on_extensions():
+    assert make_key('txt', ['footnotes']) != make_key('txt', ['tables'])
+
+
+def test_empty_text(cache):
+    assert render(None) == u''
+    assert cache.stats()['misses'] == 0
+
+
+def test_evicts_least_recently_used():
+    cache = RenderCache(max_bytes=300)
+    cache.set('a', 'x' * 100)
+    cache.set('b', 'y' * 100)
+    cache.get('a')
+    cache.set('c', 'z' * 100)
+    assert cache.get('a') is not None
+    assert cache.get('b') is None
+    stats = cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['bytes'] <= stats['max_bytes']
+
+
+def test_shared_backend_fills_local_tier():
+    backend = DictBackend()
+    worker_one = RenderCache(backend=backend)
+    worker_two = RenderCache(backend=backend)
+    worker_one.set('key', '<p>html</p>')
+    assert worker_two.get('key') == '<p>html</p>'
+    assert worker_two.get('key') == '<p>html</p>'
+    stats = worker_two.stats()
+    assert stats['shared_hits'] == 1
+    assert stats['hits'] == 1
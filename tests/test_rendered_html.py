@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_rendered_html
+
+    Markdown columns should keep a rendered html copy up to date
+"""
+
+import pytest
+from contrivers.models import Article, Author
+from contrivers.www.jinja_helpers import html
+
+
+def test_text_is_rendered_on_set():
+    article = Article(text='# Header One', abstract='*short*')
+    assert article.text_html == u'<h1>Header One</h1>'
+    assert article.abstract_html == u'<p><em>short</em></p>'
+
+
+def test_rendered_html_follows_updates():
+    article = Article(text='first')
+    article.text = 'second'
+    assert article.text_html == u'<p>second</p>'
+    article.text = None
+    assert article.text_html is None
+
+
+def test_bio_is_rendered_on_set():
+    author = Author(bio='a **bold** bio')
+    assert author.bio_html == u'<p>a <strong>bold</strong> bio</p>'
+
+
+def test_html_filter_prefers_stored_html():
+    article = Article(text='# Header One')
+    article.text_html = u'<p>stored</p>'
+    assert html(article, 'text') == u'<p>stored</p>'
+
+
+def test_html_filter_falls_back_to_markdown():
+    article = Article(text='# Header One')
+    article.text_html = None
+    assert html(article, 'text') == u'<h1>Header One</h1>'
+
+
+def test_article_page_uses_stored_html(client, data):
+    article = data.article()
+    article.text_html = u'<p>prerendered body</p>'
+    data.add_and_commit(article)
+    with client.get('/articles/{}/'.format(article.id)) as resp:
+        assert b'prerendered body' in resp.data
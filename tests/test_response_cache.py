@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_response_cache
+
+    Tests for the cache backends and the full-page response cache
+"""
+
+import time
+import threading
+import pytest
+from flask import Flask, Response, g
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, create_engine
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+from contrivers.caching import (NullCache, SimpleCache, RedisCache,
+                                ResponseCache, LocalLock, RedisLock,
+                                RedisError, add_surrogate_keys,
+                                cache_from_config)
+
+
+Base = declarative_base()
+
+
+class Watched(Base):
+    __tablename__ = 'watched'
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    hidden = Column(Boolean, default=False)
+    owner_id = Column(Integer, ForeignKey('owners.id'))
+    owner = relationship('Owner')
+
+
+class Owner(Base):
+    __tablename__ = 'owners'
+    id = Column(Integer, primary_key=True)
+
+
+class Ignored(Base):
+    __tablename__ = 'ignored'
+    id = Column(Integer, primary_key=True)
+
+
+@pytest.fixture
+def cache_app():
+    app = Flask(__name__)
+    app.config.update(
+        CACHE_TYPE='simple', CACHE_KEY_PREFIX='test',
+        RESPONSE_CACHE_POLICIES={'page': {'soft': 10, 'hard': 100}})
+    cache = ResponseCache(app)
+    app.calls = 0
+
+    @app.route('/page/', methods=('GET', 'POST'))
+    @cache.cached()
+    def page():
+        app.calls += 1
+        add_surrogate_keys('watched:1', 'watched')
+        return u'page {}'.format(app.calls)
+
+    @app.route('/stream/')
+    @cache.cached()
+    def stream():
+        app.calls += 1
+        return Response(chunk for chunk in (u'one ', u'two'))
+
+    @app.route('/cookie/')
+    @cache.cached()
+    def cookie():
+        app.calls += 1
+        response = Response(u'cookie')
+        response.set_cookie('session', 'abc')
+        return response
+
+    app.started = threading.Event()
+    app.finish = threading.Event()
+
+    @app.route('/slow/')
+    @cache.cached()
+    def slow():
+        app.calls += 1
+        app.started.set()
+        app.finish.wait(5)
+        return u'slow'
+
+    app.response_cache = cache
+    return app
+
+
+@pytest.fixture
+def session_factory():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+
+def test_simple_cache_expires(mocker):
+    cache = SimpleCache(default_timeout=10)
+    clock = mocker.patch('contrivers.caching.time.time', return_value=100)
+    cache.set('key', 'value')
+    assert cache.get('key') == 'value'
+    clock.return_value = 111
+    assert cache.get('key') is None
+
+
+def test_simple_cache_threshold():
+    cache = SimpleCache(threshold=2)
+    for key in 'abc':
+        cache.set(key, key)
+    assert len(cache._entries) == 2
+
+
+def test_null_cache():
+    cache = NullCache()
+    cache.set('key', 'value')
+    assert cache.get('key') is None
+
+
+@pytest.mark.parametrize('cache_type,cls', [
+    ('null', NullCache),
+    ('simple', SimpleCache),
+    ('redis', RedisCache),
+])
+def test_cache_from_config(cache_type, cls):
+    cache = cache_from_config({
+        'CACHE_TYPE': cache_type,
+        'CACHE_KEY_PREFIX': 'contrivers-www',
+        'CACHE_REDIS_URL': 'redis://'}, ':view:')
+    assert isinstance(cache, cls)
+    assert cache.prefix in ('', 'contrivers-www:view:')
+
+
+def test_redis_cache_clears_its_prefix():
+    fakeredis = pytest.importorskip('fakeredis')
+    client = fakeredis.FakeStrictRedis()
+    client.set('other:key', 'kept')
+    cache = RedisCache(None, prefix='views:', client=client)
+    cache.set('/a/', 'page')
+    assert cache.get('/a/') == 'page'
+    cache.clear()
+    assert cache.get('/a/') is None
+    assert client.get('other:key') == b'kept'
+
+
+def test_second_get_is_a_hit(cache_app):
+    client = cache_app.test_client()
+    first = client.get('/page/')
+    second = client.get('/page/')
+    assert first.headers['X-Cache'] == 'MISS'
+    assert second.headers['X-Cache'] == 'HIT'
+    assert second.data == first.data == b'page 1'
+    assert cache_app.calls == 1
+
+
+def test_query_string_is_part_of_the_key(cache_app):
+    client = cache_app.test_client()
+    client.get('/page/')
+    assert client.get('/page/?p=2').data == b'page 2'
+
+
+def test_post_is_not_cached(cache_app):
+    client = cache_app.test_client()
+    client.post('/page/')
+    client.post('/page/')
+    assert cache_app.calls == 2
+
+
+def test_responses_setting_cookies_are_not_cached(cache_app):
+    client = cache_app.test_client()
+    client.get('/cookie/')
+    client.get('/cookie/')
+    assert cache_app.calls == 2
+
+
+def test_streamed_response_is_cached_once_sent(cache_app):
+    client = cache_app.test_client()
+    assert client.get('/stream/').data == b'one two'
+    resp = client.get('/stream/')
+    assert resp.headers['X-Cache'] == 'HIT'
+    assert resp.data == b'one two'
+    assert cache_app.calls == 1
+
+
+def test_stale_entry_is_served_while_refreshed(cache_app, mocker):
+    client = cache_app.test_client()
+    client.get('/page/')
+    mocker.patch('contrivers.caching.time.time', return_value=time.time() + 11)
+    refresh = mocker.spy(cache_app.response_cache, 'refresh')
+    resp = client.get('/page/')
+    assert resp.headers['X-Cache'] == 'STALE'
+    assert resp.data == b'page 1'
+    refresh.spy_return.join()
+    resp = client.get('/page/')
+    assert resp.headers['X-Cache'] == 'HIT'
+    assert resp.data == b'page 2'
+    assert cache_app.response_cache.stats()['page'] == {
+        'miss': 1, 'stale': 1, 'refresh': 1, 'hit': 1}
+
+
+def test_one_refresh_per_key(cache_app, mocker):
+    client = cache_app.test_client()
+    client.get('/page/')
+    cache_app.response_cache._refreshing.add('http://localhost/page/')
+    mocker.patch('contrivers.caching.time.time', return_value=time.time() + 11)
+    assert client.get('/page/').headers['X-Cache'] == 'STALE'
+    assert client.get('/page/').headers['X-Cache'] == 'STALE'
+    assert cache_app.calls == 1
+
+
+def test_routes_without_policy_are_never_stale(cache_app, mocker):
+    client = cache_app.test_client()
+    client.get('/stream/').data
+    mocker.patch('contrivers.caching.time.time', return_value=time.time() + 11)
+    assert client.get('/stream/').headers['X-Cache'] == 'HIT'
+
+
+def test_simple_cache_purges_tagged_keys():
+    cache = SimpleCache()
+    cache.set('/a/', 'a')
+    cache.set('/b/', 'b')
+    cache.tag('/a/', ['writing:1', 'writing'])
+    cache.tag('/b/', ['writing:2'])
+    assert cache.purge(['writing:1']) == 1
+    assert cache.get('/a/') is None
+    assert cache.get('/b/') == 'b'
+
+
+def test_redis_cache_purges_tagged_keys():
+    fakeredis = pytest.importorskip('fakeredis')
+    cache = RedisCache(None, prefix='views:', client=fakeredis.FakeStrictRedis())
+    cache.set('/a/', 'a')
+    cache.set('/b/', 'b')
+    cache.tag('/a/', ['writing:1'])
+    cache.tag('/b/', ['writing:2'])
+    assert cache.purge(['writing:1', 'author:3']) == 1
+    assert cache.get('/a/') is None
+    assert cache.get('/b/') == 'b'
+
+
+def test_surrogate_key_header(cache_app):
+    client = cache_app.test_client()
+    assert client.get('/page/').headers['Surrogate-Key'] == 'watched watched:1'
+    assert client.get('/page/').headers['Surrogate-Key'] == 'watched watched:1'
+
+
+def test_purge_drops_tagged_responses(cache_app):
+    client = cache_app.test_client()
+    client.get('/page/')
+    client.get('/stream/').data
+    cache_app.response_cache.purge(['watched:1'])
+    assert client.get('/page/').headers['X-Cache'] == 'MISS'
+    assert client.get('/stream/').headers['X-Cache'] == 'HIT'
+
+
+def test_local_lock_is_shared_and_expires():
+    first = LocalLock('key', timeout=0.05)
+    second = LocalLock('key', timeout=0.05)
+    assert first.acquire(blocking=False)
+    assert not second.acquire(blocking=False)
+    assert second.acquire(timeout=1)
+    first.release()
+    assert not LocalLock('key').acquire(blocking=False)
+    second.release()
+    assert LocalLock('key').acquire(blocking=False)
+
+
+def test_redis_lock_is_shared_between_backends():
+    fakeredis = pytest.importorskip('fakeredis')
+    # redis locks are released by a lua script
+    pytest.importorskip('lupa')
+    client = fakeredis.FakeStrictRedis()
+    first = RedisCache(None, prefix='views:', client=client).lock('/a/', 10)
+    second = RedisCache(None, prefix='views:', client=client).lock('/a/', 10)
+    assert first.acquire(blocking=False)
+    assert not second.acquire(blocking=False)
+    first.release()
+    assert second.acquire(blocking=False)
+    second.release()
+
+
+def test_redis_lock_falls_back_to_a_local_lock(mocker):
+    client = mocker.Mock()
+    client.lock.return_value.acquire.side_effect = RedisError('down')
+    first = RedisLock(client, 'fallback', 10)
+    assert first.acquire(blocking=False)
+    assert not RedisLock(client, 'fallback', 10).acquire(blocking=False)
+    first.release()
+
+
+def test_concurrent_misses_render_once(cache_app):
+    cache = cache_app.response_cache
+    responses = []
+
+    def get():
+        responses.append(cache_app.test_client().get('/slow/'))
+
+    first = threading.Thread(target=get)
+    first.start()
+    cache_app.started.wait(5)
+    second = threading.Thread(target=get)
+    second.start()
+    while not cache.stats()['slow'].get('contended'):
+        time.sleep(0.01)
+    cache_app.finish.set()
+    first.join()
+    second.join()
+    assert cache_app.calls == 1
+    assert [r.headers['X-Cache'] for r in responses] == ['MISS', 'HIT']
+    assert responses[1].data == b'slow'
+    assert cache.stats()['slow'] == {'miss': 1, 'contended': 1, 'coalesced': 1}
+
+
+def test_waiters_render_when_the_lock_is_not_released(cache_app):
+    cache = cache_app.response_cache
+    cache.lock_wait = 0.05
+    lock = cache.backend.lock('http://localhost/page/', 10)
+    assert lock.acquire(blocking=False)
+    try:
+        resp = cache_app.test_client().get('/page/')
+    finally:
+        lock.release()
+    assert resp.headers['X-Cache'] == 'MISS'
+    assert cache.stats()['page'] == {'contended': 1, 'lock_timeout': 1, 'miss': 1}
+
+
+def test_loaded_rows_are_recorded(session_factory):
+    app = Flask(__name__)
+    cache = ResponseCache()
+    cache.watch(session_factory, (Watched, Owner))
+    session = session_factory()
+    session.add(Watched(id=4, name='four'))
+    session.commit()
+    session.close()
+    with app.test_request_context():
+        session_factory().get(Watched, 4)
+        assert g.surrogate_keys == set(['watched:4'])
+
+
+def purged_keys(session_factory, mocker):
+    cache = ResponseCache()
+    cache.watch(session_factory, (Watched, Owner), listed_by=('hidden',))
+    return mocker.spy(cache, 'purge')
+
+
+def test_insert_purges_row_list_and_related(session_factory, mocker):
+    spy = purged_keys(session_factory, mocker)
+    session = session_factory()
+    session.add(Watched(id=1, name='new', owner=Owner(id=7)))
+    session.commit()
+    assert spy.call_args[0][0] == set(['watched:1', 'watched', 'owner:7', 'owner'])
+
+
+def test_update_purges_row(session_factory, mocker):
+    session = session_factory()
+    watched = Watched(id=1, name='old', owner=Owner(id=7))
+    session.add(watched)
+    session.commit()
+    spy = purged_keys(session_factory, mocker)
+    watched.name = 'renamed'
+    session.commit()
+    assert spy.call_args[0][0] == set(['watched:1'])
+
+
+def test_listed_by_update_purges_lists(session_factory, mocker):
+    session = session_factory()
+    watched = Watched(id=1, name='old', owner=Owner(id=7))
+    session.add(watched)
+    session.commit()
+    spy = purged_keys(session_factory, mocker)
+    watched.hidden = True
+    session.commit()
+    assert spy.call_args[0][0] == set(['watched:1', 'watched'])
+
+
+def test_unwatched_commit_does_not_purge(session_factory, mocker):
+    spy = purged_keys(session_factory, mocker)
+    session = session_factory()
+    session.add(Ignored())
+    session.commit()
+    assert spy.call_count == 0
+
+
+def test_rollback_does_not_purge(session_factory, mocker):
+    spy = purged_keys(session_factory, mocker)
+    session = session_factory()
+    session.add(Watched(name='new'))
+    session.flush()
+    session.rollback()
+    session.commit()
+    assert spy.call_count == 0
+
+
+def test_author_rename_purges_only_its_pages(client, data, monkeypatch):
+    from contrivers.ext import response_cache
+    monkeypatch.setattr(response_cache, 'backend', SimpleCache())
+    article = data.article()
+    other = data.article()
+    other.authors = [data.authors(1)[0]]
+    data.add_all_and_commit([article, other])
+    url = '/articles/{}/'.format(article.id)
+    other_url = '/articles/{}/'.format(other.id)
+    client.get(url)
+    client.get(other_url)
+    article.authors[0].name = u'Renamed Author'
+    data.add_and_commit(article)
+    with client.get(url) as resp:
+        assert resp.headers['X-Cache'] == 'MISS'
+        assert b'Renamed Author' in resp.data
+    assert client.get(other_url).headers['X-Cache'] == 'HIT'
+
+
+def test_article_page_is_cached_until_edited(client, data, monkeypatch):
+    from contrivers.ext import response_cache
+    monkeypatch.setattr(response_cache, 'backend', SimpleCache())
+    article = data.article()
+    data.add_and_commit(article)
+    url = '/articles/{}/'.format(article.id)
+    assert client.get(url).headers['X-Cache'] == 'MISS'
+    assert client.get(url).headers['X-Cache'] == 'HIT'
+    article.title = u'An Edited Title'
+    data.add_and_commit(article)
+    with client.get(url) as resp:
+        assert resp.headers['X-Cache'] == 'MISS'
+        assert b'An Edited Title' in resp.data
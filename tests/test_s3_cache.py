@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_s3_cache
+
+    Tests for the S3 client, its bulk helpers, and the on-disk cache of
+    S3 objects used by aopen
+"""
+
+import io
+import os
+import datetime
+import pytest
+import boto3
+from botocore.exceptions import EndpointConnectionError
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+from flask import Flask
+from contrivers import utils
+from contrivers.utils import AssetCache, S3
+
+
+EDITED = datetime.datetime(2020, 5, 17, 12, 30)
+
+
+@pytest.fixture
+def s3():
+    client = boto3.client(
+        's3', region_name='us-east-1',
+        aws_access_key_id='testing', aws_secret_access_key='testing')
+    with Stubber(client) as stubber:
+        client.stubber = stubber
+        yield client
+    stubber.assert_no_pending_responses()
+
+
+def get_response(body, etag):
+    return {
+        'Body': StreamingBody(io.BytesIO(body), len(body)),
+        'ETag': etag,
+        'LastModified': EDITED,
+    }
+
+
+def test_first_fetch_is_stored(s3, tmpdir):
+    cache = AssetCache(str(tmpdir))
+    s3.stubber.add_response(
+        'get_object', get_response(b'# Masthead', '"v1"'),
+        {'Bucket': 'assets', 'Key': 'masthead.md'})
+    assert cache.fetch(s3, 'assets', 'masthead.md') == b'# Masthead'
+    meta, body, _ = cache.read(cache.path('assets', 'masthead.md'))
+    assert meta == {'etag': '"v1"', 'last_modified': EDITED.isoformat()}
+    assert body == b'# Masthead'
+
+
+def test_fresh_objects_are_read_from_disk(s3, tmpdir):
+    cache = AssetCache(str(tmpdir), interval=60)
+    s3.stubber.add_response('get_object', get_response(b'# Masthead', '"v1"'))
+    cache.fetch(s3, 'assets', 'masthead.md')
+    # a second get_object would find no stubbed response
+    assert cache.fetch(s3, 'assets', 'masthead.md') == b'# Masthead'
+
+
+def test_unchanged_object_is_revalidated(s3, tmpdir):
+    cache = AssetCache(str(tmpdir), interval=0)
+    s3.stubber.add_response('get_object', get_response(b'# Masthead', '"v1"'))
+    s3.stubber.add_client_error(
+        'get_object', service_error_code='304', http_status_code=304,
+        expected_params={
+            'Bucket': 'assets', 'Key': 'masthead.md', 'IfNoneMatch': '"v1"'})
+    cache.fetch(s3, 'assets', 'masthead.md')
+    path = cache.path('assets', 'masthead.md')
+    os.utime(path, (0, 0))
+    assert cache.fetch(s3, 'assets', 'masthead.md') == b'# Masthead'
+    assert os.path.getmtime(path) > 0
+
+
+def test_changed_object_is_replaced(s3, tmpdir):
+    cache = AssetCache(str(tmpdir), interval=0)
+    s3.stubber.add_response('get_object', get_response(b'old', '"v1"'))
+    s3.stubber.add_response('get_object', get_response(b'new', '"v2"'))
+    cache.fetch(s3, 'assets', 'masthead.md')
+    assert cache.fetch(s3, 'assets', 'masthead.md') == b'new'
+    meta, _, _ = cache.read(cache.path('assets', 'masthead.md'))
+    assert meta['etag'] == '"v2"'
+
+
+def test_missing_object_raises(s3, tmpdir):
+    cache = AssetCache(str(tmpdir))
+    s3.stubber.add_client_error(
+        'get_object', service_error_code='NoSuchKey', http_status_code=404)
+    with pytest.raises(s3.exceptions.NoSuchKey):
+        cache.fetch(s3, 'assets', 'missing.md')
+
+
+def test_stored_body_is_served_when_s3_is_unreachable(s3, tmpdir, mocker):
+    cache = AssetCache(str(tmpdir), interval=0)
+    s3.stubber.add_response('get_object', get_response(b'# Masthead', '"v1"'))
+    cache.fetch(s3, 'assets', 'masthead.md')
+    mocker.patch.object(
+        s3, 'get_object',
+        side_effect=EndpointConnectionError(endpoint_url='https://s3'))
+    assert cache.fetch(s3, 'assets', 'masthead.md') == b'# Masthead'
+
+
+def test_without_a_directory_nothing_is_stored(s3):
+    cache = AssetCache(None)
+    s3.stubber.add_response('get_object', get_response(b'one', '"v1"'))
+    s3.stubber.add_response('get_object', get_response(b'two', '"v2"'))
+    assert cache.fetch(s3, 'assets', 'masthead.md') == b'one'
+    assert cache.fetch(s3, 'assets', 'masthead.md') == b'two'
+
+
+def test_directory_others_can_write_to_is_refused(tmpdir):
+    app = Flask(__name__)
+    app.config['ASSET_CACHE_DIR'] = str(tmpdir.mkdir('assets'))
+    tmpdir.join('assets').chmod(0o777)
+    with pytest.raises(RuntimeError):
+        AssetCache().init_app(app)
+
+
+def test_directory_is_made_private(tmpdir):
+    app = Flask(__name__)
+    app.config['ASSET_CACHE_DIR'] = str(tmpdir.join('assets'))
+    AssetCache().init_app(app)
+    assert tmpdir.join('assets').stat().mode & 0o777 == 0o700
+
+
+def test_revalidation_against_s3(tmpdir, mocker):
+    moto = pytest.importorskip('moto')
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket='assets')
+        client.put_object(Bucket='assets', Key='masthead.md', Body=b'# Masthead')
+        cache = AssetCache(str(tmpdir), interval=0)
+        spy = mocker.spy(client, 'get_object')
+        assert cache.fetch(client, 'assets', 'masthead.md') == b'# Masthead'
+        assert cache.fetch(client, 'assets', 'masthead.md') == b'# Masthead'
+        assert 'IfNoneMatch' in spy.call_args[1]
+        client.put_object(Bucket='assets', Key='masthead.md', Body=b'# Edited')
+        assert cache.fetch(client, 'assets', 'masthead.md') == b'# Edited'
+
+
+@pytest.fixture
+def shared_s3(s3, monkeypatch):
+    """ Make the stubbed client the process's shared client """
+    shared = S3()
+    monkeypatch.setattr(shared, '_client', s3)
+    monkeypatch.setattr(shared, '_pid', os.getpid())
+    monkeypatch.setattr(shared, '_executor', utils.ThreadPoolExecutor(1))
+    monkeypatch.setattr(utils, 's3', shared)
+    monkeypatch.setattr(utils, 'asset_cache', AssetCache(None))
+    utils.aopen.cache_clear()
+    yield shared
+    utils.aopen.cache_clear()
+
+
+def test_client_is_made_once_per_process(mocker):
+    session = mocker.patch('contrivers.utils.boto3.session.Session')
+    shared = S3(max_pool_connections=20)
+    assert shared.client is shared.client
+    assert session.call_count == 1
+    config = session.return_value.client.call_args[1]['config']
+    assert config.max_pool_connections == 20
+    mocker.patch('contrivers.utils.os.getpid', return_value=-1)
+    shared.client
+    assert session.call_count == 2
+
+
+def test_aremove_many_batches_deletes(shared_s3, monkeypatch):
+    monkeypatch.setattr(utils, 'DELETE_BATCH_SIZE', 2)
+    for keys in (['a', 'b'], ['c']):
+        shared_s3.client.stubber.add_response(
+            'delete_objects', {'Errors': [{'Key': 'b', 'Message': 'denied'}]}
+            if 'b' in keys else {}, {
+                'Bucket': 'assets', 'Delete': {
+                    'Objects': [{'Key': key} for key in keys], 'Quiet': True}})
+    errors = utils.aremove_many(['a', 'b', 'c'], 'assets')
+    assert [error['Key'] for error in errors] == ['b']
+
+
+def test_aremove_many_invalidates_aopen(shared_s3):
+    stubber = shared_s3.client.stubber
+    stubber.add_response('get_object', get_response(b'one', '"v1"'))
+    stubber.add_response('delete_objects', {})
+    stubber.add_response('get_object', get_response(b'two', '"v2"'))
+    assert utils.aopen('masthead.md', 'assets') == u'one'
+    utils.aremove_many(['masthead.md'], 'assets')
+    assert utils.aopen('masthead.md', 'assets') == u'two'
+
+
+def test_aopen_and_asave_many(shared_s3):
+    stubber = shared_s3.client.stubber
+    for key in ('a.md', 'b.md'):
+        stubber.add_response(
+            'get_object', get_response(key.encode('utf-8'), '"v1"'),
+            {'Bucket': 'assets', 'Key': key})
+    for key in ('a.md', 'b.md'):
+        stubber.add_response(
+            'put_object', {}, {'Bucket': 'assets', 'Key': key, 'Body': b'new'})
+    assert utils.aopen_many(['a.md', 'b.md'], 'assets') == {
+        'a.md': u'a.md', 'b.md': u'b.md'}
+    utils.asave_many({'a.md': b'new', 'b.md': b'new'}, 'assets')
+
+
+@pytest.fixture
+def stored_s3(shared_s3, tmpdir, monkeypatch):
+    """ The shared client, with objects stored on disk """
+    monkeypatch.setattr(utils, 'asset_cache', AssetCache(str(tmpdir), interval=60))
+    return shared_s3
+
+
+def test_asave_replaces_the_stored_copy(stored_s3):
+    stubber = stored_s3.client.stubber
+    stubber.add_response('get_object', get_response(b'old', '"v1"'))
+    stubber.add_response('put_object', {})
+    stubber.add_response('get_object', get_response(b'new', '"v2"'))
+    assert utils.aopen('masthead.md', 'assets') == u'old'
+    utils.asave('masthead.md', 'assets', body=b'new')
+    assert utils.aopen('masthead.md', 'assets') == u'new'
+
+
+def test_aremove_drops_the_stored_copy(stored_s3):
+    stubber = stored_s3.client.stubber
+    stubber.add_response('get_object', get_response(b'old', '"v1"'))
+    stubber.add_response('delete_object', {})
+    stubber.add_client_error(
+        'get_object', service_error_code='NoSuchKey', http_status_code=404)
+    assert utils.aopen('masthead.md', 'assets') == u'old'
+    utils.aremove('masthead.md', 'assets')
+    with pytest.raises(stored_s3.client.exceptions.NoSuchKey):
+        utils.aopen('masthead.md', 'assets')
+
+
+def test_aremove_many_drops_the_stored_copies(stored_s3):
+    stubber = stored_s3.client.stubber
+    stubber.add_response('get_object', get_response(b'old', '"v1"'))
+    stubber.add_response('delete_objects', {})
+    assert utils.aopen('masthead.md', 'assets') == u'old'
+    utils.aremove_many(['masthead.md'], 'assets')
+    path = utils.asset_cache.path('assets', 'masthead.md')
+    assert not os.path.exists(path)
+
+
+def test_saved_keys_are_passed_to_the_handlers(stored_s3, monkeypatch):
+    received = []
+    monkeypatch.setattr(utils, 'asset_handlers', [received.append])
+    stubber = stored_s3.client.stubber
+    for key in ('a.md', 'b.md'):
+        stubber.add_response('put_object', {})
+    utils.asave_many({'a.md': b'a', 'b.md': b'b'}, 'assets')
+    assert received == [set([u'asset:assets/a.md', u'asset:assets/b.md'])]
+
+
+def test_forget_assets_drops_the_named_objects(stored_s3):
+    stubber = stored_s3.client.stubber
+    stubber.add_response('get_object', get_response(b'old', '"v1"'))
+    stubber.add_response('get_object', get_response(b'new', '"v2"'))
+    assert utils.aopen('masthead.md', 'assets') == u'old'
+    # as another host's save arrives over the invalidation bus
+    utils.forget_assets(set(['writing:1', utils.asset_key('masthead.md', 'assets')]))
+    assert utils.aopen('masthead.md', 'assets') == u'new'
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_shared_cache
+
+    Tests for the shared memory backend and the tiered cache
+"""
+
+import os
+import time
+import multiprocessing
+import pytest
+from contrivers.caching import (SharedMemory, SharedMemoryCache, SimpleCache,
+                                TieredCache, cache_from_config)
+
+
+# two sets of two slots in one class, so eviction is easy to reach
+SMALL = ((256, 4),)
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('cache'))
+
+
+@pytest.fixture
+def cache(path):
+    return SharedMemoryCache(path, prefix='views:')
+
+
+def same_set(cache, count):
+    """ Return `count` keys stored in the same set """
+    memory = cache.memory
+    first = None
+    keys = []
+    n = 0
+    while len(keys) < count:
+        key = 'key{}'.format(n)
+        n += 1
+        offset = next(memory.sets(cache.digest(cache.make_key(key).encode())))[1]
+        if first is None:
+            first = offset
+        if offset == first:
+            keys.append(key)
+    return keys
+
+
+def test_get_and_set(cache):
+    assert cache.get('/a/') is None
+    cache.set('/a/', u'pagé')
+    assert cache.get('/a/') == u'pagé'
+    cache.set('/a/', u'page')
+    assert cache.get('/a/') == u'page'
+    cache.delete('/a/')
+    assert cache.get('/a/') is None
+
+
+def test_workers_share_entries(cache, path):
+    cache.set('/a/', u'page')
+    other = SharedMemoryCache(path, prefix='views:')
+    assert other.get('/a/') == u'page'
+    assert SharedMemoryCache(path, prefix='other:').get('/a/') is None
+
+
+def test_entries_expire(cache, monkeypatch):
+    cache.set('/a/', u'page', timeout=10)
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 11)
+    assert cache.get('/a/') is None
+
+
+def test_value_changes_size_class(cache):
+    cache.set('/a/', u'x' * 2000)
+    cache.set('/a/', u'short')
+    assert cache.get('/a/') == u'short'
+    cache.set('/a/', u'x' * 2000)
+    assert cache.get('/a/') == u'x' * 2000
+
+
+def test_large_values_are_not_stored(path):
+    cache = SharedMemoryCache(path, slots=SMALL, ways=2)
+    cache.set('/a/', u'x' * 512)
+    assert cache.get('/a/') is None
+
+
+def test_least_recently_read_is_evicted(path):
+    cache = SharedMemoryCache(path, slots=SMALL, ways=2)
+    first, second, third = same_set(cache, 3)
+    cache.set(first, u'1')
+    cache.set(second, u'2')
+    cache.get(first)
+    cache.set(third, u'3')
+    assert cache.get(first) == u'1'
+    assert cache.get(second) is None
+    assert cache.get(third) == u'3'
+
+
+def test_tag_and_purge(cache):
+    cache.set('/a/', u'a')
+    cache.tag('/a/', ['writing:1', 'writing'])
+    cache.set('/b/', u'b')
+    cache.tag('/b/', ['writing:2'])
+    assert cache.purge(['writing:1']) == 1
+    assert cache.get('/a/') is None
+    assert cache.get('/b/') == u'b'
+
+
+def test_clear_keeps_other_prefixes(cache, path):
+    other = SharedMemoryCache(path, prefix='other:')
+    cache.set('/a/', u'a')
+    other.set('/a/', u'b')
+    cache.clear()
+    assert cache.get('/a/') is None
+    assert other.get('/a/') == u'b'
+
+
+def test_changed_layout_replaces_the_file(cache, path):
+    cache.set('/a/', u'a')
+    resized = SharedMemoryCache(path, prefix='views:', slots=SMALL, ways=2)
+    assert resized.get('/a/') is None
+    assert os.path.getsize(path) == resized.memory.size
+
+
+@pytest.mark.parametrize('name', ['cache', 'cache.lock'])
+def test_files_others_can_write_to_are_refused(tmpdir, name):
+    path = tmpdir.join(name)
+    path.write('')
+    path.chmod(0o666)
+    with pytest.raises(RuntimeError):
+        SharedMemoryCache(str(tmpdir.join('cache'))).get('/a/')
+
+
+def test_files_are_private(cache, path):
+    cache.set('/a/', u'a')
+    for name in (path, path + '.lock'):
+        assert os.stat(name).st_mode & 0o777 == 0o600
+
+
+def write_many(path, worker):
+    cache = SharedMemoryCache(path, slots=SMALL, ways=2)
+    for n in range(200):
+        cache.set('key{}'.format(n % 8), u'{}:{}'.format(worker, n) * 10)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_concurrent_writers_leave_whole_entries(path):
+    # map the file before forking, as a preloaded app does
+    SharedMemoryCache(path, slots=SMALL, ways=2).get('key0')
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=write_many, args=(path, n)) for n in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+    cache = SharedMemoryCache(path, slots=SMALL, ways=2)
+    for n in range(8):
+        value = cache.get('key{}'.format(n))
+        if value is not None:
+            assert value == value[:value.index(':') + 4] * 10
+    assert SharedMemory.open(path, SMALL, 2) is cache.memory
+
+
+@pytest.fixture
+def tiers():
+    return SimpleCache(), SimpleCache(default_timeout=600)
+
+
+def test_tiered_cache_fills_the_front(tiers):
+    front, back = tiers
+    cache = TieredCache([front, back], timeout=30)
+    back.set('/a/', u'page')
+    assert cache.get_many(['/a/', '/b/']) == [u'page', None]
+    assert front.get('/a/') == u'page'
+    assert front._entries['/a/'][0] <= time.time() + 30
+
+
+def test_tiered_cache_bounds_the_front(tiers):
+    front, back = tiers
+    cache = TieredCache([front, back], timeout=30)
+    cache.set('gen:items', u'1', 0)
+    assert back._entries['gen:items'][0] == 0
+    assert 0 < front._entries['gen:items'][0] <= time.time() + 30
+
+
+def test_tiered_purge_drops_filled_entries(tiers):
+    front, back = tiers
+    cache = TieredCache([front, back])
+    back.set('/a/', u'page')
+    back.tag('/a/', ['writing:1'])
+    assert cache.get('/a/') == u'page'
+    assert cache.purge(['writing:1']) == 1
+    assert cache.get('/a/') is None
+
+
+def test_cache_from_config_puts_shared_memory_before_redis(path):
+    cache = cache_from_config({
+        'CACHE_TYPE': 'redis',
+        'CACHE_KEY_PREFIX': 'contrivers-www',
+        'CACHE_REDIS_URL': 'redis://',
+        'SHARED_CACHE_PATH': path}, ':view:')
+    shared, redis = cache.tiers
+    assert isinstance(shared, SharedMemoryCache)
+    assert shared.prefix == redis.prefix == 'contrivers-www:view:'
@@ -108,7 +108,7 @@ def test_search(client):
         assert_template('search.html', client)
 
 def test_search_with_param(client):
-    with client.post('/search/', data={'search_term': 'Habermas'}) as resp:
+    with client.get('/search/?q=Habermas') as resp:
         assert_200(resp)
         assert_template('search.html', client)
         assert_content(resp, 'Habermas')
@@ -117,6 +117,11 @@ def test_search_with_param(client):
         g = get_template('search.html', client).get('g')
         assert g.search_term == 'Habermas'
 
+def test_search_post_redirects_to_get(client):
+    with client.post('/search/', data={'search_term': 'Habermas'}) as resp:
+        assert resp.status_code == 303
+        assert resp.headers['Location'].endswith('/search/?q=Habermas')
+
 #
 # Redirects
 #
@@ -175,6 +180,25 @@ def test_article_200(client, data):
         assert_content(resp, 'Luke Thomas Mergner')
         assert_template('article.html', client)
 
+@pytest.mark.parametrize('kind,prefix', [
+    ('article', '/articles/'),
+    ('review', '/reviews/'),
+    ('reading', '/readings/'),
+])
+def test_streamed_writing_matches_buffered(app, client, data, kind, prefix):
+    writing = getattr(data, kind)()
+    data.add_and_commit(writing)
+    url = '{}{}/'.format(prefix, writing.id)
+    app.config['STREAM_TEMPLATES'] = False
+    with client.get(url) as resp:
+        assert not resp.is_streamed
+        buffered = resp.data
+    app.config['STREAM_TEMPLATES'] = True
+    with client.get(url) as resp:
+        assert_200(resp)
+        assert resp.is_streamed
+        assert resp.data == buffered
+
 def test_author_200(client, data):
     author = data.author()
     data.add_and_commit(author)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_warm
+
+    Tests for warming the caches from the sitemap
+"""
+
+import threading
+import time
+from flask import Blueprint, Flask
+from contrivers.warm import (app_fetcher, feed_paths, parse_sitemap,
+                             plan_paths, warm)
+
+
+SITEMAP = b"""<?xml version="1.0" encoding="UTF-8"?>
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+    <url><loc>/masthead/</loc><lastmod>2020-01-05</lastmod></url>
+    <url><loc>http://localhost/articles/1/old/</loc><lastmod>2019-03-01</lastmod></url>
+    <url><loc>http://localhost/articles/2/new/</loc><lastmod>2020-02-01</lastmod></url>
+    <url><loc>/</loc><lastmod>2020-01-05</lastmod></url>
+</urlset>"""
+
+
+def test_sitemap_is_read_newest_first():
+    assert parse_sitemap(SITEMAP) == [
+        ('/articles/2/new/', '2020-02-01'),
+        ('/masthead/', '2020-01-05'),
+        ('/', '2020-01-05'),
+        ('/articles/1/old/', '2019-03-01'),
+    ]
+
+
+def test_plan_puts_index_and_feeds_first():
+    assert plan_paths(SITEMAP, ['/rss/']) == [
+        '/', '/rss/', '/articles/2/new/', '/masthead/', '/articles/1/old/']
+
+
+def test_feed_paths():
+    app = Flask(__name__)
+    www = Blueprint('www', __name__)
+    www.add_url_rule('/rss/', 'rss_index', lambda: u'')
+    www.add_url_rule('/authors/<int:id_>/rss/', 'rss_author', lambda id_: u'')
+    www.add_url_rule('/articles/', 'articles', lambda: u'')
+    app.register_blueprint(www)
+    with app.test_request_context():
+        assert feed_paths() == ['/rss/']
+
+
+def test_warm_bounds_concurrency_and_keeps_order():
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def fetch(path):
+        with lock:
+            running.append(path)
+            peak.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(path)
+        return 200
+
+    paths = ['/{}/'.format(i) for i in range(12)]
+    timings = warm(fetch, paths, concurrency=3)
+    assert [timing.path for timing in timings] == paths
+    assert max(peak) <= 3
+    assert all(timing.status == 200 for timing in timings)
+
+
+def test_failures_are_reported_not_raised():
+    def fetch(path):
+        raise IOError('connection refused')
+
+    timing, = warm(fetch, ['/'])
+    assert timing.status is None
+
+
+def test_app_fetcher():
+    app = Flask(__name__)
+    app.add_url_rule('/', 'index', lambda: u'index')
+    fetch = app_fetcher(app)
+    assert fetch('/') == 200
+    assert fetch('/missing/') == 404